@@ -0,0 +1,130 @@
+import asyncio
+import socket
+
+from server import Server
+from uploader import Uploader
+from message import Message, MessageDecoder
+from config import Config
+from custom_exception import ProtocolException
+
+
+class AsyncServer(Server):
+    """
+    asyncio engine for the server. A single event loop runs the handshake and the uploader of every
+    connection as coroutines, instead of one thread per accepted client socket.
+    Memory is bounded: connections over max-connections (conf.ini) are closed right away, reads are done in
+    READ_BUFFER_SIZE chunks, and writes wait for the socket buffer to drain. Unlike the threaded engine,
+    every connection under that limit is kept, and the choker decides which ones are uploaded to.
+    USAGE: server = AsyncServer(peer_id, torrent, message, "127.0.0.1", 5000)
+           server.run()  # blocks, run it in its own thread
+    """
+    ENGINE = "asyncio"
+    READ_BUFFER_SIZE = 4096
+    HANDSHAKE_TIMEOUT = 30  # seconds
+
+    def __init__(self, peer_id, torrent, message, server_ip_address="127.0.0.1", server_port=4999,
+                 upload_limiter=None, download_limiter=None):
+        Server.__init__(self, peer_id, torrent, message, server_ip_address, server_port,
+                        upload_limiter, download_limiter)
+        self.num_connections = 0
+        network = Config().snapshot().network
+        self.max_connections = network.max_connections
+        self.backlog = network.listen_backlog
+
+    def run(self):
+        """
+        Runs the event loop of this server until it is stopped
+        :return: VOID
+        """
+        self.choker.start()
+        try:
+            asyncio.run(self._serve())
+        except socket.error as ex:
+            print(self.ERROR_TEMPLATE.format(
+                "run()", type(ex).__name__, ex.args))
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._client_handler, self.server_ip_address, self.server_port,
+                                            backlog=self.backlog, reuse_address=True)
+        print('Server listening at ', self.server_ip_address, '/', self.server_port, '(asyncio)')
+        async with server:
+            await server.serve_forever()
+
+    async def _client_handler(self, reader, writer):
+        """
+        Coroutine version of client_handler_thread()
+        :param reader: asyncio StreamReader of the accepted connection
+        :param writer: asyncio StreamWriter of the accepted connection
+        :return: VOID
+        """
+        addr = writer.get_extra_info('peername')
+        if self.num_connections >= self.max_connections:
+            writer.close()
+            return
+        self.num_connections += 1
+        decoder = MessageDecoder()
+        try:
+            peer_id = await asyncio.wait_for(self._set_client_info(reader, writer, decoder),
+                                             self.HANDSHAKE_TIMEOUT)
+            if peer_id == -1:
+                print(self.ERROR_TEMPLATE.format(
+                    "_client_handler()", "ProtocolException",
+                    "Connection attempt fail due to not_interested/choke/different info hash"))
+                return
+            client_handler = Uploader(peer_id, self, writer.get_extra_info('socket'), addr, self.torrent,
+                                      decoder=decoder)
+            self.clienthandlers[addr] = client_handler
+            try:
+                client_handler.attach(writer)
+                self.choker.connected(client_handler)
+                if self.pex:
+                    self.pex.connected(client_handler, client_handler.listen_address())
+                await client_handler.run_async(reader, writer)
+            finally:
+                if self.pex:
+                    self.pex.disconnected(client_handler)
+                self.clienthandlers.pop(addr, None)
+        except (asyncio.TimeoutError, ProtocolException, ConnectionError) as ex:
+            print(self.ERROR_TEMPLATE.format(
+                "_client_handler()", type(ex).__name__, ex.args))
+        except Exception as ex:
+            print(self.ERROR_TEMPLATE.format(
+                "_client_handler()", type(ex).__name__, ex.args))
+        finally:
+            self.num_connections -= 1
+            writer.close()
+
+    async def _set_client_info(self, reader, writer, decoder):
+        """
+        Coroutine version of set_client_info()
+        :return: the peer id of the downloader, or -1 if the connection is not needed
+        """
+        print('server connection established')
+        handshake = await self._receive_async(reader, decoder)
+        response, peer_id = self._handshake_response(handshake)
+        await self._send_async(writer, response)
+        # info hash is different
+        if peer_id == -1:
+            await self._receive_async(reader, decoder)
+            raise ProtocolException('Received different info_hash')
+        interested = await self._receive_async(reader, decoder)
+        response, peer_id = self._interested_response(interested, peer_id)
+        if response:
+            await self._send_async(writer, response)
+        # message invalid
+        if peer_id is None:
+            await self._receive_async(reader, decoder)
+            self._invalid_interested(interested)
+        return peer_id
+
+    async def _send_async(self, writer, data):
+        data = Message.encode(data)
+        await self.upload_limiter.throttle_async(len(data))
+        writer.write(data)
+        await writer.drain()
+
+    async def _receive_async(self, reader, decoder):
+        data = await decoder.receive_async(reader, self.READ_BUFFER_SIZE, self.download_limiter.throttle_async)
+        if data is None:
+            raise ConnectionError('Connection closed by downloader')
+        return data
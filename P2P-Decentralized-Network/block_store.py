@@ -0,0 +1,224 @@
+import os
+from os import path
+import struct
+import threading
+
+
+class BlockStore:
+    """
+    Append-only binary store for the blocks of pieces that are not completed yet (i.e blocks.data)
+    Blocks are kept as binary records, so any payload is safe (newlines, delimiters...)
+        data file:  <piece index><block index><length><block>
+        index file: <piece index><block index><offset of the block in the data file><length>
+    The index is loaded in memory as a dictionary (piece index, block index) -> (offset, length), so
+    looking up a block costs O(1). Records appended after the last index write are recovered on open
+    by scanning the tail of the data file. Once a piece is flushed, its blocks are discarded and the
+    data file is compacted when most of it is dead.
+    Every record and index entry is flushed to the OS as soon as it is appended, so a crash of the program
+    loses nothing. The files are synced to disk (fsync) at piece boundaries and before the compacted
+    files replace the old ones, so a crash of the OS loses at most the blocks of the pieces in progress.
+    USAGE: store = BlockStore("resources/tmp/blocks/blocks.data")
+           store.put(0, 1, block)
+           piece = store.get_piece(0, num_blocks=8)  # None until all the blocks are stored
+           store.discard_piece(0)
+    """
+    RECORD_HEADER = struct.Struct(">III")
+    INDEX_ENTRY = struct.Struct(">IIQI")
+    TOMBSTONE = 0xFFFFFFFF  # index entry length of a discarded piece
+    INDEX_EXTENSION = ".index"
+    COMPACT_MIN_DEAD_BYTES = 1 << 20  # don't bother compacting small files
+
+    def __init__(self, data_path):
+        """
+        Class constructor. Opens (or creates) the store and rebuilds the in-memory index
+        :param data_path: path to the data file
+        """
+        self.data_path = data_path
+        self.index_path = data_path + self.INDEX_EXTENSION
+        self._lock = threading.Lock()
+        self._index = {}  # (piece index, block index) -> (offset, length)
+        self._dead_bytes = 0
+        folder = path.dirname(data_path)
+        if folder and not path.exists(folder):
+            os.makedirs(folder)
+        self._data = open(data_path, "a+b")
+        self._index_file = open(self.index_path, "a+b")
+        self._load()
+
+    def _load(self):
+        """
+        Rebuilds the in-memory index from the index file, then from the records of the data file
+        that were not indexed yet
+        :return: VOID
+        """
+        self._data.seek(0, os.SEEK_END)
+        data_size = self._data.tell()
+        self._index_file.seek(0)
+        raw_index = self._index_file.read()
+        end_of_indexed = 0
+        entry_size = self.INDEX_ENTRY.size
+        valid_index_size = len(raw_index) - len(raw_index) % entry_size
+        for piece_index, block_index, offset, length in self.INDEX_ENTRY.iter_unpack(raw_index[:valid_index_size]):
+            if length == self.TOMBSTONE:
+                self._discard(piece_index)
+            elif offset + length <= data_size:
+                self._put(piece_index, block_index, offset, length)
+                end_of_indexed = max(end_of_indexed, offset + length)
+        if valid_index_size != len(raw_index):
+            # a partially written entry, drop it
+            self._index_file.truncate(valid_index_size)
+        # recover the records appended after the last index write
+        offset = end_of_indexed
+        header_size = self.RECORD_HEADER.size
+        while offset + header_size <= data_size:
+            self._data.seek(offset)
+            piece_index, block_index, length = self.RECORD_HEADER.unpack(self._data.read(header_size))
+            if offset + header_size + length > data_size:
+                break
+            self._put(piece_index, block_index, offset + header_size, length)
+            self._write_index(piece_index, block_index, offset + header_size, length)
+            offset += header_size + length
+        if offset < data_size:
+            # a partially written record, drop it
+            self._data.truncate(offset)
+        self._index_file.flush()
+
+    def _put(self, piece_index, block_index, offset, length):
+        old = self._index.get((piece_index, block_index))
+        if old is not None:
+            self._dead_bytes += self.RECORD_HEADER.size + old[1]
+        self._index[(piece_index, block_index)] = (offset, length)
+
+    def _discard(self, piece_index):
+        for key in [key for key in self._index if key[0] == piece_index]:
+            self._dead_bytes += self.RECORD_HEADER.size + self._index.pop(key)[1]
+
+    def _write_index(self, piece_index, block_index, offset, length):
+        self._index_file.write(self.INDEX_ENTRY.pack(piece_index, block_index, offset, length))
+
+    def put(self, piece_index, block_index, block):
+        """
+        Appends a block to the store. A block stored twice replaces the previous one.
+        :param piece_index:
+        :param block_index:
+        :param block: the block data (bytes-like)
+        :return: VOID
+        """
+        with self._lock:
+            self._data.seek(0, os.SEEK_END)
+            offset = self._data.tell() + self.RECORD_HEADER.size
+            self._data.write(self.RECORD_HEADER.pack(piece_index, block_index, len(block)))
+            self._data.write(block)
+            # the record goes first, so the index never points past the end of the data file
+            self._data.flush()
+            self._put(piece_index, block_index, offset, len(block))
+            self._write_index(piece_index, block_index, offset, len(block))
+            self._index_file.flush()
+
+    def has(self, piece_index, block_index):
+        return (piece_index, block_index) in self._index
+
+    def get(self, piece_index, block_index):
+        """
+        :param piece_index:
+        :param block_index:
+        :return: the block (bytes), or None if it is not in the store
+        """
+        with self._lock:
+            location = self._index.get((piece_index, block_index))
+            if location is None:
+                return None
+            return self._read(*location)
+
+    def get_piece(self, piece_index, num_blocks):
+        """
+        Assembles a piece from its blocks
+        :param piece_index:
+        :param num_blocks: the number of blocks in this piece
+        :return: the piece (bytes), or None if any of its blocks is missing
+        """
+        with self._lock:
+            locations = [self._index.get((piece_index, block_index)) for block_index in range(num_blocks)]
+            if None in locations:
+                return None
+            return b"".join(self._read(offset, length) for offset, length in locations)
+
+    def _read(self, offset, length):
+        self._data.seek(offset)
+        return self._data.read(length)
+
+    def discard_piece(self, piece_index):
+        """
+        Discards the blocks of a piece once the piece is flushed to the tmp file.
+        The data file is compacted when most of it holds discarded blocks.
+        :param piece_index:
+        :return: VOID
+        """
+        with self._lock:
+            self._discard(piece_index)
+            self._write_index(piece_index, 0, 0, self.TOMBSTONE)
+            self._sync()
+            if not self._index:
+                self._truncate()
+            elif self._dead_bytes >= self.COMPACT_MIN_DEAD_BYTES and \
+                    self._dead_bytes * 2 >= self._data.seek(0, os.SEEK_END):
+                self._compact()
+
+    def compact(self):
+        """
+        Rewrites the data and index files with the blocks that were not discarded
+        :return: VOID
+        """
+        with self._lock:
+            self._compact()
+
+    def sync(self):
+        """
+        Writes the records and the index entries appended to disk (fsync)
+        :return: VOID
+        """
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        for file in (self._data, self._index_file):
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _truncate(self):
+        self._data.truncate(0)
+        self._index_file.truncate(0)
+        self._dead_bytes = 0
+
+    def _compact(self):
+        compact_data_path = self.data_path + ".compact"
+        compact_index_path = self.index_path + ".compact"
+        index = {}
+        with open(compact_data_path, "wb") as data, open(compact_index_path, "wb") as index_file:
+            for (piece_index, block_index), (offset, length) in sorted(self._index.items()):
+                data.write(self.RECORD_HEADER.pack(piece_index, block_index, length))
+                new_offset = data.tell()
+                data.write(self._read(offset, length))
+                index_file.write(self.INDEX_ENTRY.pack(piece_index, block_index, new_offset, length))
+                index[(piece_index, block_index)] = (new_offset, length)
+            # the compacted files are on disk before they replace the old ones
+            for file in (data, index_file):
+                file.flush()
+                os.fsync(file.fileno())
+        self._data.close()
+        self._index_file.close()
+        os.replace(compact_data_path, self.data_path)
+        os.replace(compact_index_path, self.index_path)
+        self._data = open(self.data_path, "a+b")
+        self._index_file = open(self.index_path, "a+b")
+        self._index = index
+        self._dead_bytes = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._data.close()
+            self._index_file.close()
@@ -0,0 +1,118 @@
+import random
+import threading
+import time
+
+
+class Choker:
+    """
+    Tit-for-tat choking algorithm of the server
+    Every INTERVAL seconds, the interested peers are ranked by the rate they give back: the rate this peer
+    downloads from them, or the rate this peer uploads to them when seeding (so the upload slots go to the
+    peers that download the fastest). The UNCHOKE_SLOTS - 1 best peers are unchoked, plus one optimistic
+    unchoke, a random choked peer rotated every OPTIMISTIC_INTERVAL seconds, so new peers get a chance to
+    show their rate. Any other peer is choked.
+    USAGE: choker = Choker(server)
+           choker.scheduler = scheduler  # optional, rates of the downloads from each peer
+           choker.start()
+           choker.connected(uploader)  # chokes the peer right away if all the slots are taken
+    """
+    INTERVAL = 10  # seconds between evaluations
+    OPTIMISTIC_INTERVAL = 30  # seconds between rotations of the optimistic unchoke
+    UNCHOKE_SLOTS = 4  # including the optimistic unchoke
+    ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in choker.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
+
+    def __init__(self, server, scheduler=None):
+        """
+        Class constructor
+        :param server: the server, its uploaders are the connections choked and unchoked
+        :param scheduler: optional DownloadScheduler, to measure the rate downloaded from each peer
+        """
+        self.server = server
+        self.scheduler = scheduler
+        self.optimistic = None  # uploader of the optimistic unchoke
+        self._optimistic_since = 0
+        self._uploaded = {}  # uploader -> bytes uploaded at the last evaluation
+        self._downloaded = {}  # peer id -> bytes downloaded at the last evaluation
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the choker thread
+        :return: VOID
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.INTERVAL)
+            try:
+                self.evaluate()
+            except Exception as ex:
+                print(self.ERROR_TEMPLATE.format(
+                    "_run()", type(ex).__name__, ex.args))
+
+    def connected(self, uploader):
+        """
+        Chokes a new connection if all the unchoke slots are taken (connections are unchoked by the handshake)
+        :param uploader:
+        :return: VOID
+        """
+        with self._lock:
+            unchoked = [other for other in self._uploaders() if other is not uploader and not other.choked]
+        if len(unchoked) >= self.UNCHOKE_SLOTS:
+            uploader.set_choked(True)
+
+    def _uploaders(self):
+        return list(self.server.clienthandlers.values())
+
+    def _rates(self, uploaders, elapsed):
+        """
+        :return: dict uploader -> rate (bytes per second) given back by its peer since the last evaluation
+        """
+        seeding = self.server.message.progress() >= 1.0
+        downloaded = self.scheduler.downloaded_by_peer() if self.scheduler and not seeding else {}
+        rates = {}
+        for uploader in uploaders:
+            if seeding:
+                total, last = uploader.uploaded, self._uploaded.get(uploader, 0)
+            else:
+                total = downloaded.get(uploader.downloader_id, 0)
+                last = self._downloaded.get(uploader.downloader_id, 0)
+            rates[uploader] = max(0, total - last) / elapsed
+        self._uploaded = {uploader: uploader.uploaded for uploader in uploaders}
+        self._downloaded = downloaded
+        return rates
+
+    def evaluate(self):
+        """
+        Chokes and unchokes the connections. The choke and unchoke messages are sent after the lock is
+        released, so a slow connection does not hold the choker
+        :return: the uploaders unchoked
+        """
+        with self._lock:
+            now = time.monotonic()
+            elapsed = max(now - self._last, 1e-6)
+            self._last = now
+            uploaders = self._uploaders()
+            rates = self._rates(uploaders, elapsed)
+            interested = [uploader for uploader in uploaders if uploader.interested]
+            interested.sort(key=lambda uploader: rates[uploader], reverse=True)
+            unchoked = interested[:self.UNCHOKE_SLOTS - 1]
+            candidates = [uploader for uploader in interested if uploader not in unchoked]
+            if self.optimistic not in candidates or now - self._optimistic_since >= self.OPTIMISTIC_INTERVAL:
+                self.optimistic = random.choice(candidates) if candidates else None
+                self._optimistic_since = now
+            if self.optimistic is not None:
+                unchoked.append(self.optimistic)
+            decisions = [(uploader, uploader not in unchoked) for uploader in uploaders]
+        for uploader, choked in decisions:
+            try:
+                uploader.set_choked(choked)
+            except OSError as ex:
+                print(self.ERROR_TEMPLATE.format(
+                    "evaluate()", type(ex).__name__, ex.args))
+        return unchoked
@@ -1,7 +1,8 @@
 import socket
-import pickle
 
 from downloader import Downloader
+from message import Message, MessageDecoder
+from rate_limiter import RateLimiter
 from custom_exception import ClientClosedException, ProtocolException
 
 
@@ -15,29 +16,45 @@ class Client(object):
 
     ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in client.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
 
-    def __init__(self, peer_id, torrent, message):
+    def __init__(self, peer_id, torrent, message, scheduler=None, upload_limiter=None, download_limiter=None,
+                 pex=None):
         # Creates the client socket
         # AF_INET refers to the address family ipv4.
         # The SOCK_STREAM means connection oriented TCP protocol.
         self.clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # pipelined requests are small writes, sent without waiting for the ack of the previous one
+        self.clientSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.client_id = 0
         self.peer_id = peer_id
         self.torrent = torrent
+        self.message = message
+        # this connection share of the rates of the peer. By default, the rates in conf.ini
+        self.upload_rate = (upload_limiter or RateLimiter.from_config("max-upload-rate")).connection()
+        self.download_rate = (download_limiter or RateLimiter.from_config("max-download-rate")).connection()
         # first true is for interested, second is for keep alive
         self.download = Downloader(
-            self.clientSocket, self.peer_id, self.torrent, True, True)
-        self.message = message
+            self.clientSocket, self.peer_id, self.torrent, True, True, message=message, scheduler=scheduler,
+            upload_rate=self.upload_rate)
+        self.decoder = MessageDecoder()
+        self.pex = pex  # optional PeerExchange of the peer
 
     def bind(self, client_ip, client_port):
         # self.client_ip = client_ip
         # self.client_port = client_port
+        # the port of a closed connection is bound again by the next connection, while it is in TIME_WAIT
+        self.clientSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.clientSocket.bind((client_ip, client_port))
 
     def set_info(self):
         print('client connection established')
-        # sending handshake
-        self._send(self.message.handshake)
+        # sending handshake. The listen port lets the server advertise this peer with peer exchange
+        handshake = self.message.handshake
+        if self.pex:
+            handshake = dict(handshake, listen_port=self.pex.listen_port)
+        self._send(handshake)
         data = self._receive()
+        # peer id of the server, used by its choker to measure the rate downloaded from it
+        self.download.uploader_id = data.get('peer_id', -1)
         # server accepted connection
         self.handle_response(data)
         # sending interested
@@ -59,6 +76,8 @@ class Client(object):
             self.clientSocket.connect((host, port))
             print(f'Successfully connected to server: %s/%d' % (host, port))
             self.set_info()
+            if self.pex:
+                self.pex.connected(self, (host, port))
             # client is put in listening mode to retrieve data from server.
             while True:
                 try:
@@ -67,7 +86,13 @@ class Client(object):
                     if not data:
                         break
                     #    print(data)
-                    response = self.handle_response(data)
+                    if 'headers' in data:
+                        response = self.handle_response(data)
+                    else:
+                        # peer wire protocol message (i.e have, bitfield)
+                        response = self.handle_bt_protocol(data)
+                        if response == 'ignore':
+                            response = None
                     # if there is a response
                     if response:
                         self._send(response)
@@ -76,8 +101,10 @@ class Client(object):
                         '\n--------------------Client Disconnected---------------------\n')
                     break
                 except ProtocolException as ex:
+                    # the server broke the protocol (i.e malformed frame), the connection is closed
                     print(self.ERROR_TEMPLATE.format(
                         "connect()", type(ex).__name__, ex.args))
+                    break
                 except:
                     raise
         except socket.error as ex:
@@ -168,11 +195,14 @@ class Client(object):
         if 'id' in body:
             # choke
             if body['id'] == 0:
-                print('Server Choked: closing connection...')
+                print('Server Choked')
+                self.download.on_choke()
                 response = 'ignore'
             # unchoke
             elif body['id'] == 1:
                 print('Server is not choked')
+                self.download.on_unchoke()
+                self.download.request_blocks()
                 response = 'ignore'
             # interested
             elif body['id'] == 2:
@@ -180,48 +210,76 @@ class Client(object):
             # not_interested
             elif body['id'] == 3:
                 pass
-            # h ave
+            # have
             elif body['id'] == 4:
-                pass
+                self.download.on_have(body['piece_index'])
+                self.download.request_blocks()
+                response = 'ignore'
+            # bitfield
             elif body['id'] == 5:
-                pass
+                self.download.on_bitfield(body['bitfield'])
+                self.download.request_blocks()
+                response = 'ignore'
             elif body['id'] == 6:
                 pass
+            # piece
             elif body['id'] == 7:
-                pass
+                self.download.on_piece(body['index'], body['begin'], body['block'])
+                self.download.request_blocks()
+                response = 'ignore'
             elif body['id'] == 8:
                 pass
             elif body['id'] == 9:
                 pass
+            # peer exchange
+            elif body['id'] == Message.EXTENDED:
+                if self.pex:
+                    self.pex.received(self, body['added'], body['dropped'])
+                response = 'ignore'
         # message.keep_alive/tracker/handshake
         else:
             pass
 
         return response
 
+    def send_pex(self, added, dropped):
+        """
+        Sends a peer exchange message, called by the PeerExchange thread
+        :param added: compact peer list
+        :param dropped: compact peer list
+        :return: VOID
+        """
+        self._send(dict(self.message.pex, added=added, dropped=dropped))
+
     def _send(self, data):
         """
-        Serializes and then sends data to server
+        Encodes and then sends data to server
         :param data:
         :return:
         """
-        data = pickle.dumps(data)  # serialized data
-        self.clientSocket.send(data)
+        # length-prefixed frame, sent under the downloader lock since end-game cancels are sent
+        # from other threads on this socket
+        self.download.send(data)
 
     def _receive(self, MAX_BUFFER_SIZE=4090):
         """
-        Desearializes the data received by the server
-        :param MAX_BUFFER_SIZE: Max allowed allocated memory for this data
-        :return: the deserialized data.
+        Decodes the next message sent by the server. Partial and merged reads are
+        buffered by the decoder until a whole message is available.
+        :param MAX_BUFFER_SIZE: Max allowed allocated memory for each read
+        :return: the decoded data, or None if the server closed the connection.
         """
-        raw_data = self.clientSocket.recv(MAX_BUFFER_SIZE)
-        return pickle.loads(raw_data)
+        return self.decoder.receive(self.clientSocket, MAX_BUFFER_SIZE, self.download_rate.throttle)
 
     def close(self):
         """
         TODO: close the client socket
         :return: VOID
         """
+        if self.pex:
+            self.pex.disconnected(self)
+        self.download.close()
+        self.upload_rate.close()
+        self.download_rate.close()
         self.clientSocket.close()
 
 
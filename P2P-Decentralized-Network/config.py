@@ -1,18 +1,42 @@
-from configparser import ConfigParser
+from collections import namedtuple
+from configparser import ConfigParser, NoOptionError, NoSectionError
 import os
 from os import path
+import threading
+import time
+
+
+class _SnapshotEntry:
+    """A parsed configuration file, shared by all the Config objects using the same file"""
+    __slots__ = ("snapshot", "mtime", "checked")
+
+    def __init__(self, snapshot, mtime, checked):
+        self.snapshot = snapshot
+        self.mtime = mtime
+        self.checked = checked
+
+
+# conf file path -> _SnapshotEntry
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
 
 class Config():
     """
     Implements methods to get and put values in configuration files
     Config file found in path resources/configuration/conf.ini
+    The file is parsed once into an immutable snapshot shared by all the Config objects. The snapshot is
+    only parsed again when the mtime of the file changes (checked at most every RELOAD_CHECK_INTERVAL
+    seconds), when values are set from this class, or when reload() is called.
     USAGE: config = Config()
-           path_to_shared_files = config.get_value("resources", "shared-files")
-           print(path_to_shared_files) # outputs resources/shared/
-           block_size = int(config.get_value("sizes", "block_size")
-           print(block_size) # outputs 2048
+           # typed values with attribute access (dashes become underscores)
+           print(config.snapshot().sizes.block_size) # outputs 2048
+           print(config.snapshot().resources.shared_files) # outputs resources/shared/
+           # the same values as strings
+           print(config.get_value("sizes", "block-size")) # outputs 2048
     """
     DEFAULT_GENERAL_CONF_FILE = "resources/configuration/conf.ini"
+    RELOAD_CHECK_INTERVAL = 1.0  # seconds
 
     def __init__(self, conf_file=DEFAULT_GENERAL_CONF_FILE):
         self._conf_file = conf_file
@@ -24,6 +48,7 @@ class Config():
     def create_conf_file(self):
         f = open(self._conf_file, "w+")
         f.close()
+        self.reload()
 
     def config_exist(self, file_path):
         return path.exists(file_path)
@@ -42,14 +67,87 @@ class Config():
     def save_config_data(self):
         with open(self._conf_file, 'w') as configfile:
             self._parser.write(configfile)
+        self.reload()
 
     def get_value(self, section, key):
-        self._parser.read(self._conf_file)
-        return self._parser.get(section, key)
+        """
+        :param section:
+        :param key:
+        :return: the value of the key in the snapshot, as a string
+        """
+        snapshot = self.snapshot()
+        section_attribute = self._attribute(section)
+        if section_attribute not in snapshot._fields:
+            raise NoSectionError(section)
+        values = getattr(snapshot, section_attribute)
+        key_attribute = self._attribute(key)
+        if key_attribute not in values._fields:
+            raise NoOptionError(key, section)
+        return str(getattr(values, key_attribute))
+
+    def snapshot(self):
+        """
+        :return: the immutable snapshot of the configuration. Sections and keys are attributes, with
+                 dashes replaced by underscores, and values are typed (int, float, bool or str)
+        """
+        return self._entry().snapshot
+
+    def reload(self):
+        """
+        Parses the configuration file again
+        :return: the new snapshot
+        """
+        with _snapshots_lock:
+            entry = _snapshots[self._conf_file] = self._parse()
+        return entry.snapshot
 
     def delete_config(self):
         os.remove(self._conf_file)
+        with _snapshots_lock:
+            _snapshots.pop(self._conf_file, None)
+
+    def _entry(self):
+        entry = _snapshots.get(self._conf_file)
+        if entry is not None and time.monotonic() - entry.checked < self.RELOAD_CHECK_INTERVAL:
+            return entry
+        with _snapshots_lock:
+            entry = _snapshots.get(self._conf_file)
+            if entry is None or self._mtime() != entry.mtime:
+                entry = _snapshots[self._conf_file] = self._parse()
+            else:
+                entry.checked = time.monotonic()
+            return entry
 
+    def _mtime(self):
+        try:
+            return os.stat(self._conf_file).st_mtime_ns
+        except OSError:
+            return None
 
+    def _parse(self):
+        mtime = self._mtime()
+        parser = ConfigParser()
+        parser.read(self._conf_file)
+        sections = {}
+        for section in parser.sections():
+            items = parser.items(section)
+            section_type = namedtuple(self._attribute(section), [self._attribute(key) for key, _ in items])
+            sections[self._attribute(section)] = section_type(*[self._typed(value) for _, value in items])
+        snapshot = namedtuple("ConfigSnapshot", list(sections))(**sections)
+        return _SnapshotEntry(snapshot, mtime, time.monotonic())
 
+    @staticmethod
+    def _attribute(name):
+        return name.strip().replace("-", "_").replace(" ", "_")
 
+    @staticmethod
+    def _typed(value):
+        value = value.strip()
+        if value in ("True", "False"):
+            return value == "True"
+        for value_type in (int, float):
+            try:
+                return value_type(value)
+            except ValueError:
+                pass
+        return value
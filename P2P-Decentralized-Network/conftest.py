@@ -0,0 +1,9 @@
+import os
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def package_dir(monkeypatch):
+    """The paths of conf.ini and of the torrent are relative to this folder"""
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
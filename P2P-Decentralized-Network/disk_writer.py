@@ -0,0 +1,162 @@
+import os
+from os import path
+import threading
+
+
+class DiskWriter:
+    """
+    Background write-back writer for the tmp file (i.e ages.tmp)
+    Pieces are queued by the network threads and written by a dedicated disk thread. Each time the disk
+    thread wakes up, it takes all the queued pieces, sorts them by offset, and merges adjacent pieces
+    into a single write. The queue is bounded in bytes: when it is full, write() blocks until the disk
+    thread catches up (backpressure), so memory does not grow when the disk is slower than the network.
+    USAGE: writer = DiskWriter("resources/tmp/ages.tmp", file_size, 16 * 1024 * 1024)
+           writer.write(piece_offset, piece, callback=lambda: print("piece on disk"),
+                        on_error=lambda ex: print("piece lost", ex))
+           writer.close()  # writes everything still queued
+    """
+    MAX_WRITE_SIZE = 1024 * 1024  # max bytes merged into a single write
+    ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in disk_writer.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
+
+    def __init__(self, file_path, file_size, max_queue_bytes):
+        """
+        Class constructor. Starts the disk thread
+        :param file_path: path to the file written
+        :param file_size: size of the file, used to create it if it does not exist
+        :param max_queue_bytes: max bytes queued or being written before write() blocks
+        """
+        self.file_path = file_path
+        self.file_size = file_size
+        self.max_queue_bytes = max_queue_bytes
+        self._queue = []  # (offset, data, callback, on_error)
+        self._queued_bytes = 0  # queued or being written
+        self._condition = threading.Condition()
+        self._closed = False
+        self.writes = 0  # number of writes done to disk
+        self.pieces_written = 0
+        self.bytes_written = 0
+        self.write_errors = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, offset, data, callback=None, on_error=None):
+        """
+        Queues data to be written. Blocks while the queue is full
+        :param offset: offset in the file
+        :param data: the data (i.e a piece)
+        :param callback: called without arguments from the disk thread once the data is on disk
+        :param on_error: called with the OSError from the disk thread if the data could not be written
+        :return: VOID
+        """
+        with self._condition:
+            # an empty queue always accepts data, so data bigger than the queue is not blocked forever
+            while self._queued_bytes and self._queued_bytes + len(data) > self.max_queue_bytes \
+                    and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                raise ValueError("write to a closed DiskWriter")
+            self._queue.append((offset, data, callback, on_error))
+            self._queued_bytes += len(data)
+            self._condition.notify_all()
+
+    def flush(self):
+        """
+        Blocks until all the queued data is on disk
+        :return: VOID
+        """
+        with self._condition:
+            while self._queued_bytes:
+                self._condition.wait()
+
+    def close(self):
+        """
+        Writes the queued data and stops the disk thread
+        :return: VOID
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        if not path.exists(self.file_path):
+            if path.dirname(self.file_path):
+                os.makedirs(path.dirname(self.file_path), exist_ok=True)
+            with open(self.file_path, "wb") as out:
+                out.truncate(self.file_size)
+        with open(self.file_path, "r+b") as file:
+            while True:
+                with self._condition:
+                    while not self._queue and not self._closed:
+                        self._condition.wait()
+                    if not self._queue:
+                        break  # closed and nothing left to write
+                    batch, self._queue = self._queue, []
+                batch.sort(key=lambda entry: entry[0])
+                written, failed = [], []
+                for run in self._coalesce(batch):
+                    error = self._write_run(file, run)
+                    if error is None:
+                        written.extend(run)
+                    else:
+                        failed.extend((entry, error) for entry in run)
+                try:
+                    file.flush()
+                except OSError as ex:
+                    print(self.ERROR_TEMPLATE.format(
+                        "_run()", type(ex).__name__, ex.args))
+                    failed.extend((entry, ex) for entry in written)
+                    written = []
+                with self._condition:
+                    self._queued_bytes -= sum(len(data) for _, data, _, _ in batch)
+                    self._condition.notify_all()
+                # the owner of data that was not written must get it again (i.e the piece is downloaded again)
+                calls = [(callback, ()) for _, _, callback, _ in written] + \
+                        [(on_error, (error,)) for (_, _, _, on_error), error in failed]
+                for function, args in calls:
+                    if function:
+                        try:
+                            function(*args)
+                        except Exception as ex:
+                            print(self.ERROR_TEMPLATE.format(
+                                "_run()", type(ex).__name__, ex.args))
+
+    def _coalesce(self, batch):
+        """
+        Groups sorted entries that are adjacent in the file
+        :param batch: entries sorted by offset
+        :return: a list of runs (lists of adjacent entries)
+        """
+        runs = []
+        run, run_end, run_size = [], None, 0
+        for entry in batch:
+            offset, data = entry[0], entry[1]
+            if run and (offset != run_end or run_size + len(data) > self.MAX_WRITE_SIZE):
+                runs.append(run)
+                run, run_size = [], 0
+            run.append(entry)
+            run_end = offset + len(data)
+            run_size += len(data)
+        if run:
+            runs.append(run)
+        return runs
+
+    def _write_run(self, file, run):
+        """
+        Writes a run of adjacent entries with a single write
+        :param file: the file opened by the disk thread
+        :param run: list of adjacent entries
+        :return: None if the run was written. Otherwise, the OSError
+        """
+        try:
+            file.seek(run[0][0])
+            file.write(b"".join(entry[1] for entry in run) if len(run) > 1 else run[0][1])
+            self.writes += 1
+            self.pieces_written += len(run)
+            self.bytes_written += sum(len(entry[1]) for entry in run)
+            return None
+        except OSError as ex:
+            self.write_errors += len(run)
+            print(self.ERROR_TEMPLATE.format(
+                "_write_run()", type(ex).__name__, ex.args))
+            return ex
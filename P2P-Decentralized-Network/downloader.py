@@ -1,10 +1,25 @@
+import math
 import threading
+import time
 from file_manager import FileManager
+from message import Message
+from scheduler import DownloadScheduler
 
 
 class Downloader:
+    """
+    Downloads blocks from the uploader of a connection. Requests are pipelined: up to queue_depth requests
+    are kept in flight, so the link is not idle while a request travels to the uploader. The queue depth
+    follows the bandwidth-delay product of the connection, measured from the throughput and the round
+    trip time of the requests, so slow peers keep few requests and fast or distant peers keep many.
+    """
+    MIN_QUEUE_DEPTH = 2
+    MAX_QUEUE_DEPTH = 128
+    QUEUE_GAIN = 2  # requests in flight per bandwidth-delay product, leaves room for the throughput to grow
+    RATE_INTERVAL = 0.5  # seconds between throughput samples
 
-    def __init__(self, peer_downloader, peer_id, torrent, interested, keep_alive):
+    def __init__(self, peer_downloader, peer_id, torrent, interested, keep_alive, message=None, scheduler=None,
+                 upload_rate=None):
         self.peer_downloader = peer_downloader
         self.peer_id = peer_id
         self.torrent = torrent
@@ -12,7 +27,181 @@ class Downloader:
         self.info_hash = self.torrent.create_info_hash()
         self.alive = keep_alive
         self.interested = interested
-        self.file_manager = FileManager(self.torrent, self.peer_id)
+        self.message = message
+        # shared by the downloaders of all the connections. A downloader alone gets its own scheduler
+        if scheduler is None and message is not None:
+            scheduler = DownloadScheduler(torrent, message, FileManager(self.torrent, self.peer_id))
+        self.scheduler = scheduler
         self.bitfield_lock = threading.Lock()
-        self.file_lock = threading.Lock()
+        # no file lock needed: pieces are written to disk by the file manager disk writer thread
+        self.block_size = self.torrent.block_size()
+        self.send_lock = threading.Lock()  # cancels are sent from the threads of other downloaders
+        self.upload_rate = upload_rate  # optional ConnectionRateLimiter of the messages sent
+        # requests are also sent from the requester thread of the scheduler, and cancelled from the threads of
+        # other downloaders (see DownloadScheduler)
+        self.requests_lock = threading.Lock()
+        # (piece index, block index) -> (length, time sent, True if sent on an idle connection) of the
+        # requests in flight on this connection
+        self.requests = {}
+        self.queue_depth = self.MIN_QUEUE_DEPTH
+        self.rate = 0.0  # bytes per second
+        self.rtt = None  # seconds
+        self._rate_bytes = 0
+        self._rate_start = time.perf_counter()
+        self.choked = True
+        self.downloaded = 0  # bytes
+        if self.scheduler:
+            self.scheduler.register(self)
 
+    def send(self, data):
+        """
+        Encodes and sends a message to the uploader
+        :param data: the message
+        :return: VOID
+        """
+        data = Message.encode(data)
+        if self.upload_rate:
+            self.upload_rate.throttle(len(data))
+        with self.send_lock:
+            self.peer_downloader.sendall(data)
+
+    def send_have(self, have):
+        """
+        Sends a have message, called by the scheduler when a piece is available
+        :param have: the have message, with the piece index set
+        :return: VOID
+        """
+        self.send(have)
+
+    def on_bitfield(self, bitfield):
+        """
+        Records the pieces of the remote peer from its bitfield message
+        :param bitfield: the bitfield payload
+        :return: VOID
+        """
+        if self.scheduler:
+            self.scheduler.peer_bitfield(self, bitfield)
+
+    def on_have(self, piece_index):
+        """
+        Records a piece announced by the remote peer with a have message
+        :param piece_index:
+        :return: VOID
+        """
+        if self.scheduler:
+            self.scheduler.peer_have(self, piece_index)
+
+    def on_unchoke(self):
+        self.choked = False
+
+    def on_choke(self):
+        """
+        The uploader will not answer the requests sent, so their blocks are assigned to other connections
+        :return: VOID
+        """
+        self.choked = True
+        with self.requests_lock:
+            blocks = list(self.requests)
+            self.requests.clear()
+        if self.scheduler:
+            self.scheduler.release(self, blocks)
+
+    def request_blocks(self):
+        """
+        Sends requests to the uploader until queue_depth requests are in flight on this connection
+        The blocks are assigned by the scheduler. In end-game, the blocks in flight on other connections are
+        requested again from this peer.
+        :return: the number of requests sent
+        """
+        if self.choked or self.scheduler is None:
+            return 0
+        # the blocks are reserved under the lock, and the requests are sent after it is released, so
+        # on_piece(), cancel() and on_choke() never wait for the rate limiter or the socket
+        blocks = []
+        with self.requests_lock:
+            while len(self.requests) < self.queue_depth:
+                block = self.scheduler.next_block(self)
+                if block is None:
+                    break
+                length = self.scheduler.block_length(*block)
+                self.requests[block] = (length, time.perf_counter(), not self.requests)
+                blocks.append((block, length))
+        for block, length in blocks:
+            self._request(block, length)
+        return len(blocks)
+
+    def _request(self, block, length):
+        piece_index, block_index = block
+        self.send(dict(self.message.request, index=piece_index, begin=block_index * self.block_size,
+                       length=length))
+        # the round trip time is measured from the moment the request is sent
+        with self.requests_lock:
+            request = self.requests.get(block)
+            if request is not None:
+                self.requests[block] = (length, time.perf_counter(), request[2])
+
+    def cancel(self, piece_index, begin, length):
+        """
+        Cancels a request because its block was received from another peer (end-game)
+        :param piece_index:
+        :param begin:
+        :param length:
+        :return: VOID
+        """
+        with self.requests_lock:
+            self.requests.pop((piece_index, begin // self.block_size), None)
+        self.send(dict(self.message.cancel, index=piece_index, begin=begin, length=length))
+
+    def on_piece(self, piece_index, begin, block):
+        """
+        Hands a block received to the scheduler, which writes the piece once it is completed
+        :param piece_index:
+        :param begin: the offset of the block in the piece
+        :param block: the block data
+        :return: VOID
+        """
+        with self.requests_lock:
+            request = self.requests.pop((piece_index, begin // self.block_size), None)
+        self.downloaded += len(block)
+        if request is not None:
+            self._update_queue_depth(request, len(block))
+        if self.scheduler:
+            self.scheduler.block_received(self, piece_index, begin, block)
+
+    def _update_queue_depth(self, request, length):
+        """
+        Updates the throughput and round trip time of the connection with a block received, and
+        sets the queue depth to the bandwidth-delay product (in blocks)
+        :param request: (length, time sent, sent on an idle connection) of the request answered
+        :param length: the length of the block received
+        :return: VOID
+        """
+        now = time.perf_counter()
+        _, sent_at, idle = request
+        latency = now - sent_at
+        # requests sent behind others also wait for the blocks ahead of them, so only requests sent on an
+        # idle connection measure the round trip time alone. Any latency is an upper bound of it.
+        if self.rtt is None or idle or latency < self.rtt:
+            self.rtt = latency
+        self._rate_bytes += length
+        elapsed = now - self._rate_start
+        if elapsed < self.RATE_INTERVAL:
+            return
+        sample = self._rate_bytes / elapsed
+        self.rate = (self.rate + sample) / 2 if self.rate else sample
+        self._rate_bytes = 0
+        self._rate_start = now
+        bandwidth_delay = self.rate * self.rtt / self.block_size
+        self.queue_depth = max(self.MIN_QUEUE_DEPTH,
+                               min(self.MAX_QUEUE_DEPTH, math.ceil(bandwidth_delay * self.QUEUE_GAIN)))
+
+    def close(self):
+        """
+        Removes the pieces of the remote peer from the swarm availability, and assigns the blocks
+        requested from it to other connections
+        :return: VOID
+        """
+        if self.scheduler:
+            self.scheduler.unregister(self)
+        with self.requests_lock:
+            self.requests.clear()
@@ -0,0 +1,172 @@
+import threading
+
+from bitarray import bitarray
+
+
+class EndGame:
+    """
+    Registry of the block requests in flight, shared by all the downloaders of a torrent, implementing
+    the "End Game" mode of the BitTorrent protocol.
+    Outside end-game, a block is requested from a single peer at a time. Once every missing block has been
+    requested, the download would stall on the blocks requested from the slowest peers, so end-game
+    starts: the blocks still in flight are requested again from every other peer that has them. The first
+    copy received completes the block, and a cancel is sent to the other peers it was requested from.
+    Blocks received after the first copy are counted as wasted bytes, so the cost of end-game can be measured.
+    USAGE: end_game = EndGame(message)  # message with the bitfield initialized
+           block_index = end_game.assign_block(downloader, piece_index)  # records the request
+           first, piece_completed, cancels = end_game.block_received(downloader, piece_index, block_index,
+                                                                     len(block))
+           for other in cancels:
+               other.cancel(piece_index, begin, length)
+           print(end_game.stats())
+    """
+
+    def __init__(self, message):
+        """
+        Class constructor
+        :param message: the message object of the peer. Its bitfield tracks the blocks completed
+        """
+        self.message = message
+        self.blocks_per_piece = message.blocks_per_piece
+        self._requests = {}  # (piece index, block index) -> list of downloaders with the block in flight
+        self._requested = bitarray(message.num_pieces * self.blocks_per_piece)
+        self._requested.setall(False)
+        # pieces whose missing blocks are all in flight, so they are not picked again outside end-game
+        self._fully_requested = bitarray(message.num_pieces)
+        self._fully_requested.setall(False)
+        self.active = False
+        self.duplicate_requests = 0
+        self.cancels = 0
+        self.wasted_bytes = 0
+        self._lock = threading.Lock()
+
+    def fully_requested(self):
+        """
+        :return: bitarray of the pieces with all their missing blocks in flight (see PiecePicker.pick exclude)
+        """
+        return self._fully_requested
+
+    def assign_block(self, downloader, piece_index):
+        """
+        Finds a block of a piece that is neither completed nor in flight, and records its request
+        :param downloader: the downloader of the connection the request will be sent on
+        :param piece_index:
+        :return: the block index, or -1 if there is none
+        """
+        start = piece_index * self.blocks_per_piece
+        with self._lock:
+            block_index = (self.message.get_bitfield_piece(piece_index) |
+                           self._requested[start:start + self.blocks_per_piece]).find(0)
+            if block_index != -1:
+                self._add_request(downloader, piece_index, block_index)
+            return block_index
+
+    def add_request(self, downloader, piece_index, block_index):
+        """
+        Records a request sent to a peer
+        :param downloader: the downloader of the connection the request was sent on
+        :param piece_index:
+        :param block_index:
+        :return: VOID
+        """
+        with self._lock:
+            self._add_request(downloader, piece_index, block_index)
+
+    def _add_request(self, downloader, piece_index, block_index):
+        downloaders = self._requests.setdefault((piece_index, block_index), [])
+        if downloaders:
+            self.duplicate_requests += 1
+        downloaders.append(downloader)
+        start = piece_index * self.blocks_per_piece
+        self._requested[start + block_index] = True
+        blocks = self.message.get_bitfield_piece(piece_index) | \
+            self._requested[start:start + self.blocks_per_piece]
+        if blocks.all():
+            self._fully_requested[piece_index] = True
+
+    def remove_request(self, downloader, piece_index, block_index):
+        """
+        Forgets a request that will not be answered (i.e the peer choked or disconnected), so the block
+        can be requested from another peer
+        :param downloader:
+        :param piece_index:
+        :param block_index:
+        :return: VOID
+        """
+        with self._lock:
+            key = (piece_index, block_index)
+            downloaders = self._requests.get(key)
+            if downloaders is None or downloader not in downloaders:
+                return
+            downloaders.remove(downloader)
+            if not downloaders:
+                del self._requests[key]
+                self._requested[piece_index * self.blocks_per_piece + block_index] = False
+                self._fully_requested[piece_index] = False
+                self.active = False
+
+    def block_received(self, downloader, piece_index, block_index, length):
+        """
+        Records a block received, and sets it to completed in the bitfield if this is the first copy
+        :param downloader: the downloader that received the block
+        :param piece_index:
+        :param block_index:
+        :param length: the length of the block, counted as wasted if the block was already completed
+        :return: True if this is the first copy of the block, True if the block completed its piece, and
+                 the list of other downloaders the block is still requested from (they must send a cancel)
+        """
+        with self._lock:
+            downloaders = self._requests.pop((piece_index, block_index), [])
+            self._requested[piece_index * self.blocks_per_piece + block_index] = False
+            if not self.message.is_block_missing(piece_index, block_index):
+                self.wasted_bytes += length
+                return False, False, []
+            self.message.set_block_to_completed(piece_index, block_index)
+            cancels = [other for other in downloaders if other is not downloader]
+            self.cancels += len(cancels)
+            return True, not self.message.is_piece_missing(piece_index), cancels
+
+    def piece_failed(self, piece_index):
+        """
+        Sets a piece that failed the hash validation to missing, so its blocks are requested again
+        :param piece_index:
+        :return: VOID
+        """
+        with self._lock:
+            self.message.set_piece_to_missing(piece_index)
+            self._fully_requested[piece_index] = False
+            self.active = False
+
+    def enter(self):
+        """
+        Starts end-game if every missing piece has all its missing blocks in flight
+        :return: True if end-game is active
+        """
+        with self._lock:
+            if not self.active and self._requests:
+                self.active = (self.message.get_bitfield() | self._fully_requested).all()
+            return self.active
+
+    def assign_duplicate(self, downloader, peer_pieces):
+        """
+        Finds a block in flight to request again from another peer, and records its request (end-game only)
+        :param downloader: the downloader of the connection the duplicate request will be sent on
+        :param peer_pieces: bitarray of the pieces the peer has
+        :return: (piece index, block index), or None if there is no block to request from this peer
+        """
+        with self._lock:
+            if not self.active or peer_pieces is None:
+                return None
+            for (piece_index, block_index), downloaders in self._requests.items():
+                if peer_pieces[piece_index] and downloader not in downloaders:
+                    self._add_request(downloader, piece_index, block_index)
+                    return piece_index, block_index
+            return None
+
+    def stats(self):
+        """
+        :return: dict with the end-game counters
+        """
+        return {'active': self.active, 'in-flight': len(self._requests),
+                'duplicate-requests': self.duplicate_requests, 'cancels': self.cancels,
+                'wasted-bytes': self.wasted_bytes}
@@ -0,0 +1,149 @@
+import os
+from os import path
+import threading
+import time
+
+import bencodepy
+from bitarray import bitarray
+
+from verifier import PieceVerifier
+
+
+class FastResume:
+    """
+    Fast-resume sidecar of a downloaded file (i.e resources/tmp/ages.tmp.resume)
+    The sidecar keeps the bitfield of the pieces verified and written to the file, together with the
+    size and mtime the file had when the sidecar was saved. On startup:
+        * file unchanged (same size and mtime): the bitfield is trusted, nothing is re-hashed.
+        * file modified (same size, other mtime): the file may have been written by another program,
+          so no piece is trusted and every piece is re-verified before it is announced.
+        * no sidecar, different torrent or different size: every piece is re-verified.
+    USAGE: resume = FastResume(torrent, file_manager)
+           completed = resume.load()  # bitarray, one bit per piece
+           resume.piece_completed(piece_index)  # saves at most every SAVE_INTERVAL seconds
+           resume.save()
+    """
+    EXTENSION = ".resume"
+    SAVE_INTERVAL = 30  # seconds
+    ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in fast_resume.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
+
+    def __init__(self, torrent, file_manager, file_path=None):
+        """
+        Class constructor
+        :param torrent:
+        :param file_manager: used to find the file downloaded
+        :param file_path: the file downloaded. By default, the file returned by file_manager.upload_path()
+        """
+        self.torrent = torrent
+        self.file_manager = file_manager
+        self.file_path = file_path or file_manager.upload_path()
+        self.resume_path = self.file_path + self.EXTENSION
+        self.num_pieces = torrent.num_pieces()
+        self.completed = bitarray(self.num_pieces)
+        self.completed.setall(False)
+        self._lock = threading.Lock()
+        self._last_save = time.time()
+
+    def load(self, progress=None):
+        """
+        Loads the sidecar and re-verifies the pieces whose state is uncertain
+        :param progress: optional callable(pieces_verified, pieces_to_verify). See also PieceVerifier
+        :return: a copy of the bitfield of completed pieces (bitarray with one bit per piece)
+        """
+        if not path.exists(self.file_path):
+            return self.completed.copy()
+        stat = os.stat(self.file_path)
+        trusted, uncertain = self._trusted_pieces(stat)
+        verified = self.verify(uncertain, progress)
+        with self._lock:
+            self.completed = trusted | verified
+            completed = self.completed.copy()
+        if uncertain.any():
+            self.save()
+        return completed
+
+    def recheck(self, progress=None):
+        """
+        Force recheck: ignores the sidecar and re-verifies every piece of the file
+        :param progress: optional callable(pieces_verified, pieces_to_verify)
+        :return: a copy of the bitfield of completed pieces
+        """
+        all_pieces = bitarray(self.num_pieces)
+        all_pieces.setall(True)
+        verified = self.verify(all_pieces, progress)
+        with self._lock:
+            self.completed = verified
+            completed = self.completed.copy()
+        self.save()
+        return completed
+
+    def _trusted_pieces(self, stat):
+        """
+        :param stat: os.stat() of the file
+        :return: the bitfield of pieces trusted, and the bitfield of pieces that need to be re-verified
+        """
+        trusted = bitarray(self.num_pieces)
+        trusted.setall(False)
+        uncertain = bitarray(self.num_pieces)
+        uncertain.setall(True)
+        data = self._read_sidecar()
+        if data is None or data.get(b'info_hash') != self.torrent.create_info_hash().encode() \
+                or data.get(b'num_pieces') != self.num_pieces or data.get(b'file_size') != stat.st_size:
+            return trusted, uncertain
+        if data.get(b'mtime') != stat.st_mtime_ns:
+            return trusted, uncertain
+        trusted = bitarray()
+        trusted.frombytes(data[b'bitfield'])
+        del trusted[self.num_pieces:]
+        uncertain.setall(False)
+        return trusted, uncertain
+
+    def verify(self, pieces, progress=None):
+        """
+        Validates pieces of the file with their hashes, in parallel
+        :param pieces: bitarray with the pieces to verify set
+        :param progress: optional callable(pieces_verified, pieces_to_verify)
+        :return: bitarray with the pieces that are valid set
+        """
+        return PieceVerifier(self.torrent, self.file_path).verify(pieces, progress)
+
+    def _read_sidecar(self):
+        if not path.exists(self.resume_path):
+            return None
+        try:
+            with open(self.resume_path, "rb") as file:
+                return bencodepy.decode(file.read())
+        except Exception as ex:
+            print(self.ERROR_TEMPLATE.format(
+                "_read_sidecar()", type(ex).__name__, ex.args))
+            return None
+
+    def piece_completed(self, piece_index):
+        """
+        Records a piece that was validated and written to the file
+        The sidecar is saved if the last save is older than SAVE_INTERVAL seconds, or if the file is completed
+        :param piece_index:
+        :return: VOID
+        """
+        with self._lock:
+            self.completed[piece_index] = True
+            due = time.time() - self._last_save >= self.SAVE_INTERVAL or self.completed.all()
+        if due:
+            self.save()
+
+    def save(self):
+        """
+        Saves the sidecar. The file is replaced atomically, so a crash never leaves a half written sidecar
+        :return: VOID
+        """
+        if not path.exists(self.file_path):
+            return
+        with self._lock:
+            stat = os.stat(self.file_path)
+            data = {'info_hash': self.torrent.create_info_hash(), 'num_pieces': self.num_pieces,
+                    'file_size': stat.st_size, 'mtime': stat.st_mtime_ns, 'bitfield': self.completed.tobytes()}
+            tmp_path = self.resume_path + ".tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(bencodepy.encode(data))
+            os.replace(tmp_path, self.resume_path)
+            self._last_save = time.time()
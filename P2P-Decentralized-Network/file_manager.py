@@ -1,21 +1,29 @@
 import hashlib
+import os
 from os import path
 import shutil
+import threading
+
+from block_store import BlockStore
+from disk_writer import DiskWriter
+from config import Config
 
 
 class FileManager:
     """
     The file manager class handles writes and reads from tmp, original and routing table.
-    It also creates pointers to routing table, as well as read and write blocks/pieces of data.
+    It also keeps the blocks of incomplete pieces in a block store, as well as read and write blocks/pieces of data.
     """
     TMP_FILE = "resources/tmp/ages.tmp"
+    BLOCKS_FILE = "blocks.data"
     ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in file_manager.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
 
-    def __init__(self, torrent, peer_id):
+    def __init__(self, torrent, peer_id, piece_cache=None):
         """
         Class constructor
         :param torrent:
         :param peer_id:
+        :param piece_cache: PieceCache shared with other file managers (i.e all the uploaders of a server)
         """
         self.torrent = torrent
         self.peer_id = peer_id
@@ -25,6 +33,11 @@ class FileManager:
         self.piece_size = self.torrent.piece_size()
         self.block_size = self.torrent.block_size()
         self.hash_info = self.torrent.create_info_hash()
+        self._fds = {}  # path -> fd kept open for positioned reads
+        self._fds_lock = threading.Lock()
+        self._block_stores = {}  # file name -> BlockStore, opened on first use
+        self.piece_cache = piece_cache
+        self._disk_writer = None  # started on the first piece flushed
 
     def create_tmp_file(self):
         """
@@ -55,139 +68,205 @@ class FileManager:
 
     def get_block(self, piece_index, offset, length, path=None):
         """
-        TODO: gets a block from the file in the path given as parameter
+        Gets a block from the file in the path given as parameter. Only the block is read from disk.
         :param piece_index: the index of the piece
         :param offset: the begin offset of the block in that piece
         :param length: the length of the block
         :param path: Note that paths may be only the original file (i.e ages.txt) or
-                     the tmp file (i.e ages.tmp)
-        :return:
+                     the tmp file (i.e ages.tmp). By default, the file returned by upload_path()
+        :return: the block (bytes)
         """
-        block = None
-        # your code here
         try:
             # ! WARNING: This assumed the pieces and blocks were sorted in tmp file
-            with open("resources/tmp/" + path, "rb") as file:
-                piece_offset = self.piece_offset(piece_index)
-                piece = file.read()[piece_offset:piece_offset+self.piece_size]
-                block = piece[offset:offset+length].decode("utf8")
+            return self._read(self.piece_offset(piece_index) + offset, length, path)
         except FileNotFoundError as ex:
             print(self.ERROR_TEMPLATE.format(
                 "get_block()", type(ex).__name__, ex.args))
             raise
-        return block
+
+    def read_piece(self, piece_index, path=None):
+        """
+        Reads a whole piece from the file in the path given as parameter
+        Use memoryview(piece)[begin:begin + length] to get its blocks without copying them.
+        :param piece_index: the index of the piece
+        :param path: see get_block()
+        :return: the piece (bytes). The last piece of the file may be shorter than the piece size
+        """
+        try:
+            return self._read(self.piece_offset(piece_index), self.piece_size, path)
+        except FileNotFoundError as ex:
+            print(self.ERROR_TEMPLATE.format(
+                "read_piece()", type(ex).__name__, ex.args))
+            raise
+
+    def get_cached_block(self, piece_index, offset, length):
+        """
+        Gets a block of a verified piece through the piece cache. On a miss, the whole piece is
+        read from upload_path() and cached, since the next blocks of that piece are likely to be requested too.
+        Only call it for available pieces (see Message.is_piece_available()). The piece read is validated
+        with its hash before it is cached anyway, so a piece that is not on disk yet is never cached.
+        :param piece_index: the index of the piece
+        :param offset: the begin offset of the block in that piece
+        :param length: the length of the block
+        :return: the block (memoryview of the cached piece), or None if the piece read is not valid
+        """
+        piece = self.piece_cache.get(piece_index)
+        if piece is None:
+            piece = self.read_piece(piece_index)
+            if not self.piece_validated(piece, piece_index):
+                return None
+            self.piece_cache.put(piece_index, piece)
+        return memoryview(piece)[offset:offset + length]
+
+    def _read(self, file_offset, length, path=None):
+        """
+        Positioned read on a cached file descriptor, so the cost depends on the length read
+        and not on the file size.
+        :param file_offset: offset in the file
+        :param length: number of bytes to read
+        :param path: see get_block()
+        :return: the bytes read
+        """
+        fd = self._fd(self._resolve_path(path))
+        if hasattr(os, "pread"):
+            return os.pread(fd, length, file_offset)
+        # os.pread is not available on Windows
+        with self._fds_lock:
+            os.lseek(fd, file_offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+    def _resolve_path(self, file_path):
+        if file_path is None:
+            return self.upload_path()
+        if not path.dirname(file_path):
+            # file names alone are looked up in the tmp folder (i.e ages.tmp)
+            return path.join(path.dirname(self.path), file_path)
+        return file_path
+
+    def _fd(self, file_path):
+        with self._fds_lock:
+            fd = self._fds.get(file_path)
+            if fd is None:
+                flags = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+                fd = self._fds[file_path] = os.open(file_path, flags)
+            return fd
+
+    def close(self):
+        """
+        Writes the pieces still queued, then closes the file descriptors cached for reading and the block stores
+        :return: VOID
+        """
+        if self._disk_writer is not None:
+            self._disk_writer.close()
+            self._disk_writer = None
+        with self._fds_lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+            for store in self._block_stores.values():
+                store.close()
+            self._block_stores.clear()
 
     def get_piece(self, blocks):
         """
-        TODO: Converts a list of blocks in a piece
+        Converts a list of blocks in a piece
         :param blocks: a list of blocks
         :return: the piece
         """
-        # your code here
-        piece = "\n".join(blocks)
-        return piece
+        return b"".join(blocks)
 
-    def flush_block(self, piece_index, block_index, block, path="blocks.data"):
+    def flush_block(self, piece_index, block_index, block, path=BLOCKS_FILE):
         """
-        TODO: writes a block in blocks.data
-              Each entry in routing table has the following format:
-              <pointer><delimiter><block>
-              pointer: A SHA1 hash of the hash info of the torrent file, piece index and block index
-              delimiter: $$$
-              block: the data of the block
-
+        Writes a block in the block store (i.e blocks.data) until its piece is completed
+        See also BlockStore
         :param piece_index:
         :param block_index:
-        :param block:
+        :param block: the data of the block (bytes)
+        :param path: file name of the block store in the tmp blocks folder
         :return: VOID
         """
-        # your code here
-        entry = self.pointer(self.hash_info, piece_index, block_index)
-        entry += "$$$"
-        entry += block
-        entry += "\n"
-        with open("resources/tmp/blocks/" + path, "ab") as file:
-            file.write(entry.encode("utf8"))
+        if isinstance(block, str):
+            block = block.encode("utf8")
+        self.block_store(path).put(piece_index, block_index, block)
 
-    def pointer(self, hash_info, piece_index, block_index):
+    def block_store(self, path=BLOCKS_FILE):
         """
-        Creates a pointer for a specific block
-        :param hash_info:
-        :param piece_index:
-        :param block_index:
-        :return:
+        :param path: file name of the block store in the tmp blocks folder
+        :return: the BlockStore, opened and indexed on first use
         """
-        data = str(piece_index) + str(block_index) + hash_info
-        data_encoded = str.encode(data)
-        return str.encode(self.hash(data_encoded))
+        with self._fds_lock:
+            store = self._block_stores.get(path)
+            if store is None:
+                store = self._block_stores[path] = BlockStore(
+                    self.torrent.path_to_tmp_blocks() + path)
+            return store
 
-    def flush_piece(self, piece_index, piece):
+    def flush_piece(self, piece_index, piece, callback=None, on_error=None):
         """
-        TODO: write a piece in tmp file once the piece is validated with the hash of the piece
+        Writes a piece in tmp file once the piece is validated with the hash of the piece.
+        The write is queued to the disk writer thread, so the caller only blocks if the write queue is full.
+        Once the piece is on disk, its blocks are discarded from the block store.
         :param piece_index:
-        :param piece:
-        :return: VOID
+        :param piece: the piece (bytes)
+        :param callback: called without arguments once the piece is on disk
+        :param on_error: called with the OSError if the piece could not be written
+        :return: True if the piece was valid and queued. Otherwise, returns False
         """
-        if self.piece_validated(piece, piece_index):
-            if not self.path_exist(self.path):
-                self.create_tmp_file()
-            with open(self.path, "r+b") as file:
-                file.seek(self.piece_offset(piece_index))
-                file.write(piece.encode("utf-8"))
-        else:
+        if isinstance(piece, str):
+            piece = piece.encode("utf8")
+        if not self.piece_validated(piece, piece_index):
             print(self.ERROR_TEMPLATE.format(
                 "flush_piece()", "InvalidPieceError", "Unable to flush piece due to piece is invalid"))
-        # your code here
+            return False
+
+        def on_written():
+            for store in list(self._block_stores.values()):
+                store.discard_piece(piece_index)
+            if callback:
+                callback()
 
-    def get_pointers(self, hash_info, piece_index):
+        self.disk_writer().write(self.piece_offset(piece_index), piece, on_written, on_error)
+        return True
+
+    def disk_writer(self):
         """
-        TODO: gets all the pointers representing a piece in the routing table
-        :param hash_info:
-        :param piece_index:
-        :return: a list of pointers to the blocks in the same piece
+        :return: the DiskWriter of the tmp file, started on first use
         """
-        # your code here
-        pointers = [self.pointer(hash_info, piece_index, block_index)
-                    for block_index in range(self.piece_size/self.block_size)]
-        return pointers
+        with self._fds_lock:
+            if self._disk_writer is None:
+                max_queue_bytes = Config().snapshot().cache.disk_write_queue_size
+                self._disk_writer = DiskWriter(self.path, self.file_size, max_queue_bytes)
+            return self._disk_writer
 
-    def extract_piece(self, piece_index):
+    def extract_piece(self, piece_index, path=BLOCKS_FILE):
         """
-        TODO: extract a piece from the routing table once all the blocks from that piece are completed
+        Extracts a piece from the block store once all the blocks from that piece are completed
         :param piece_index:
-        :return: the piece
+        :param path: file name of the block store in the tmp blocks folder
+        :return: the piece (bytes)
         """
-        piece = ""
-        # your code here
-        try:
-            pointers = self.get_pointers(self.hash_info, piece_index)
-            blocks = None
-            with open(self.path, "rb") as file:
-                blocks = [block.decode("utf8") for block in file.readlines()]
-            blocks_pointers = [block.split("$$$")[0] for block in blocks]
-            for p in pointers:
-                index = blocks_pointers.index(p)
-                piece += blocks[index]
-        except FileNotFoundError as ex:
-            print(self.ERROR_TEMPLATE.format(
-                "extract_piece()", type(ex).__name__, ex.args))
-            raise
-        except ValueError as ex:
+        piece = self.block_store(path).get_piece(piece_index, self.num_blocks(piece_index))
+        if piece is None:
+            ex = ValueError("piece %d is not complete" % piece_index)
             print(self.ERROR_TEMPLATE.format(
                 "extract_piece()", type(ex).__name__, ex.args))
-            print("piece is not complete, pointer could not be found")
-            raise
-        except IndexError as ex:
-            print(self.ERROR_TEMPLATE.format(
-                "extract_piece()", type(ex).__name__, ex.args))
-            print("block_pointers are not extracted correctly")
-            raise
-        except Exception as ex:
-            print(self.ERROR_TEMPLATE.format(
-                "extract_piece()", type(ex).__name__, ex.args))
-            raise
+            raise ex
         return piece
 
+    def piece_length(self, piece_index):
+        """
+        :param piece_index:
+        :return: the length of the piece. The last piece of the file may be shorter than the piece size
+        """
+        return min(self.piece_size, self.file_size - self.piece_offset(piece_index))
+
+    def num_blocks(self, piece_index):
+        """
+        :param piece_index:
+        :return: the number of blocks in the piece
+        """
+        return -(-self.piece_length(piece_index) // self.block_size)
+
     def piece_offset(self, piece_index):
         """
         :param piece_index:
@@ -207,9 +286,7 @@ class FileManager:
         return begin/self.torrent.block_size()
 
     def piece_validated(self, piece, piece_index):
-        hashed_torrent_piece = self.torrent.piece(piece_index)
-        hashed_piece = self.hash(piece)
-        return hashed_torrent_piece == hashed_piece
+        return self.torrent.verify_piece(piece_index, piece)
 
     def move_tmp_to_shared(self):
         """
@@ -218,7 +295,36 @@ class FileManager:
         """
         file_shared_path = "resources/shared/" + self.torrent.file_name()
         if not path.exists(file_shared_path):
+            self.close()
             shutil.move(self.path, file_shared_path)
 
+    def upload_path(self):
+        """
+        Path of the file blocks are uploaded from: the original file if this peer has it
+        (i.e resources/shared/age.txt), otherwise the tmp file (i.e ages.tmp)
+        :return: the path
+        """
+        if self.path_to_original_file:
+            return self.path_to_original_file
+        file_shared_path = "resources/shared/" + self.torrent.file_name()
+        if path.exists(file_shared_path):
+            return file_shared_path
+        return self.path
+
+    def block_file_range(self, piece_index, offset, length):
+        """
+        Computes where a block is located in the file
+        :param piece_index: the index of the piece
+        :param offset: the begin offset of the block in that piece
+        :param length: the requested length of the block
+        :return: the offset of the block in the file, and its length (the last block may be shorter)
+        """
+        if offset < 0 or length < 0 or offset + length > self.piece_size:
+            raise ValueError("block out of piece bounds: %d/%d" % (offset, length))
+        file_offset = self.piece_offset(piece_index) + offset
+        if file_offset >= self.file_size:
+            raise ValueError("piece %d out of file bounds" % piece_index)
+        return file_offset, min(length, self.file_size - file_offset)
+
     def path_exist(self, path_to_file):
         return path.exists(path_to_file)
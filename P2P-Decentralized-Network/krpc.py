@@ -0,0 +1,192 @@
+import asyncio
+import struct
+import threading
+
+
+class KRPCProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram endpoint of a DHT node, running on an asyncio event loop
+    All the messages go in and out of the same bound socket. Incoming queries are answered by the query
+    handler, and the response is sent right away from the socket. Outgoing queries get a transaction id
+    ("t"): the response with the same transaction id resolves the query, so any number of queries can be
+    in flight at the same time. A query is sent again if there is no response within TIMEOUT seconds,
+    up to RETRIES times.
+    USAGE: see KRPCEndpoint
+    """
+    TIMEOUT = 1.0  # seconds
+    RETRIES = 2
+
+    ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in krpc.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
+
+    def __init__(self, encode, decode, on_query, on_response=None):
+        """
+        Class constructor
+        :param encode: encodes a message dictionary (bencode)
+        :param decode: decodes a datagram into a message dictionary
+        :param on_query: on_query(message, ip, port) -> the response to send, or None
+        :param on_response: optional on_response(message, ip, port), for the responses and errors that do not
+                            match a query in flight (i.e answers to a broadcast)
+        """
+        self.encode = encode
+        self.decode = decode
+        self.on_query = on_query
+        self.on_response = on_response
+        self.transport = None
+        self._pending = {}  # transaction id -> future of the response
+        self._next_transaction = 0
+        self.queries_received = 0
+        self.queries_sent = 0
+        self.retries = 0
+        self.timeouts = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, raw_data, addr):
+        try:
+            message = self.decode(raw_data)
+        except Exception:
+            return  # not a KRPC message
+        if not isinstance(message, dict):
+            return
+        ip, port = addr[0], addr[1]
+        try:
+            if message.get("y") == "q":
+                self.queries_received += 1
+                response = self.on_query(message, ip, port)
+                if response is not None:
+                    self.transport.sendto(self.encode(response), addr)
+                return
+            t = message.get("t", b"")
+            future = self._pending.get(t.encode() if isinstance(t, str) else t)
+            if future is not None and not future.done():
+                future.set_result(message)
+            elif self.on_response:
+                self.on_response(message, ip, port)
+        except Exception as ex:
+            print(self.ERROR_TEMPLATE.format(
+                "datagram_received()", type(ex).__name__, ex.args))
+
+    def error_received(self, exc):
+        pass  # i.e ICMP port unreachable, the query times out
+
+    def _transaction_id(self):
+        for _ in range(0x10000):
+            self._next_transaction = (self._next_transaction + 1) & 0xFFFF
+            t = struct.pack("!H", self._next_transaction)
+            if t not in self._pending:
+                return t
+        raise OverflowError("too many queries in flight")
+
+    def send(self, message, addr):
+        try:
+            self.transport.sendto(self.encode(message), addr)
+        except OSError as ex:
+            print(self.ERROR_TEMPLATE.format(
+                "send()", type(ex).__name__, ex.args))
+
+    async def query(self, message, addr, timeout=TIMEOUT, retries=RETRIES):
+        """
+        Sends a query and waits for the message with its transaction id
+        :param message: the query, without "t"
+        :param addr: (ip, port) of the node
+        :param timeout: seconds before each retry
+        :param retries: times the query is sent again
+        :return: the response (or error) message, or None if the node did not answer
+        """
+        t = self._transaction_id()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[t] = future
+        data = self.encode(dict(message, t=t))
+        try:
+            for attempt in range(retries + 1):
+                if attempt:
+                    self.retries += 1
+                self.queries_sent += 1
+                self.transport.sendto(data, addr)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    continue
+            self.timeouts += 1
+            return None
+        finally:
+            del self._pending[t]
+
+    def stats(self):
+        """
+        :return: dict with the counters of the endpoint
+        """
+        return {'queries-received': self.queries_received, 'queries-sent': self.queries_sent,
+                'in-flight': len(self._pending), 'retries': self.retries, 'timeouts': self.timeouts}
+
+
+class KRPCEndpoint:
+    """
+    Runs a KRPCProtocol on a bound socket, in an event loop of its own, and lets other threads send
+    queries through it (i.e the threads of a NodeLookup)
+    USAGE: endpoint = KRPCEndpoint(udp_socket, encode, decode, on_query, on_response)
+           threading.Thread(target=endpoint.run).start()  # or endpoint.start()
+           response = endpoint.query({"y": "q", "q": "ping", "a": {"id": node_id}}, (ip, port))
+           endpoint.send(message, (ip, port))
+    """
+
+    def __init__(self, sock, encode, decode, on_query, on_response=None):
+        """
+        Class constructor
+        :param sock: the bound datagram socket
+        :param encode: see KRPCProtocol
+        :param decode: see KRPCProtocol
+        :param on_query: see KRPCProtocol
+        :param on_response: see KRPCProtocol
+        """
+        self.sock = sock
+        self.protocol = KRPCProtocol(encode, decode, on_query, on_response)
+        self.loop = None
+        self._ready = threading.Event()
+
+    def start(self):
+        """
+        Runs the endpoint in a daemon thread
+        :return: VOID
+        """
+        threading.Thread(target=self.run, daemon=True).start()
+        self._ready.wait()
+
+    def run(self):
+        """
+        Runs the event loop of the endpoint (blocking)
+        :return: VOID
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.sock.setblocking(False)
+        self.loop.run_until_complete(self.loop.create_datagram_endpoint(lambda: self.protocol, sock=self.sock))
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def wait_ready(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def query(self, message, addr, timeout=KRPCProtocol.TIMEOUT, retries=KRPCProtocol.RETRIES):
+        """
+        Blocking version of KRPCProtocol.query(), for threads other than the endpoint thread
+        """
+        self._ready.wait()
+        future = asyncio.run_coroutine_threadsafe(self.protocol.query(message, addr, timeout, retries), self.loop)
+        return future.result()
+
+    def send(self, message, addr):
+        """
+        Sends a message (i.e a broadcast) from any thread
+        :return: VOID
+        """
+        self._ready.wait()
+        self.loop.call_soon_threadsafe(self.protocol.send, message, addr)
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
@@ -1,6 +1,11 @@
-import math
+import struct
+import uuid
+from collections import deque
 from bitarray import bitarray  # you must install this library
 import unittest
+import bencodepy
+
+from custom_exception import ProtocolException
 
 
 class Message:
@@ -17,6 +22,35 @@ class Message:
     X_BITFIELD_LENGTH = b'0000'
     X_PIECE_LENGTH = b'0000'
 
+    # message ids
+    CHOKE = 0
+    UNCHOKE = 1
+    INTERESTED = 2
+    NOT_INTERESTED = 3
+    HAVE = 4
+    BITFIELD = 5
+    REQUEST = 6
+    PIECE = 7
+    CANCEL = 8
+    PORT = 9
+    # extension message (BEP 10 id). The only extension is the peer exchange (BEP 11), see PeerExchange.
+    # There is no extension handshake: the extended message id of the peer exchange is fixed
+    EXTENDED = 20
+    UT_PEX = 1  # extended message id of the peer exchange
+    # messages that are not part of the PWP (handshake, headers protocol, status...) travel
+    # bencoded inside a control frame, see _to_bencode()
+    CONTROL = 255
+
+    # wire format: <length prefix><message id><payload>
+    LENGTH_PREFIX = struct.Struct(">I")
+    MESSAGE_ID = struct.Struct(">B")
+    HAVE_PAYLOAD = struct.Struct(">I")
+    REQUEST_PAYLOAD = struct.Struct(">III")  # also used by cancel
+    PIECE_HEADER = struct.Struct(">II")  # followed by the block
+    PORT_PAYLOAD = struct.Struct(">H")
+    COMPACT_PEER_SIZE = 6  # ipv4 address and port of a peer in the added and dropped lists of the peer exchange
+    MAX_MESSAGE_LENGTH = 2 ** 17
+
     def __init__(self, peer_id, info_hash):
         # A keep-alive message must be sent to maintain the connection alive if no command
         # have been sent for a given amount of time. This amount of time is generally two minutes.
@@ -41,9 +75,8 @@ class Message:
         # The high bit in the first byte corresponds to piece index 0.
         # Bits that are cleared indicated a missing piece, and set bits indicate a valid and available piece.
         # Spare bits at the end are set to zero.
-        # [[0,0,0,0,0,0,0,0],[1,1,1,1,1,1,1,1],[1,1,1,1,1,1,1,1]]
         self._bitfield = {'len': b'0013' +
-                          self.X_BITFIELD_LENGTH, 'id': 5, 'bitfield': []}
+                          self.X_BITFIELD_LENGTH, 'id': 5, 'bitfield': bitarray()}
         # The request message is fixed length, and is used to request a block.
         # The payload contains the following information:
         #     index: integer specifying the zero-based piece index
@@ -70,6 +103,10 @@ class Message:
         # This peer should be inserted in the local routing table (if DHT tracker is supported).
         self.port = {'index': b'0003', 'id': 9, 'listen-port': None}
 
+        # The peer exchange message is sent periodically on each connection with the peers this peer connected
+        # to (added) and disconnected from (dropped) since the last one, as compact peer lists (6 bytes per peer)
+        self.pex = {'len': None, 'id': 20, 'added': b'', 'dropped': b''}
+
         # The handshake message
         # This message is the first message sent to a peer once trackers from both peers shared the DHT, and there is
         # a reliable connection active.
@@ -146,113 +183,206 @@ class Message:
 
     #############################  Bitfield Methods ####################################################
 
-    def init_bitfield(self, num_pieces):
+    def init_bitfield(self, num_pieces, completed=None, blocks_per_piece=1, last_piece_blocks=None):
         """
-        TODO: Initializes the bitfield with all the pieces set to missing: b'00000000'
-        NOTE: Initialization of the bitarry must be in bytes. You can use the
-        library bitarray to create pieces like this: bitarray(8)
+        Initializes the bitfield with all the pieces set to missing: b'00000000'
+        The bitfield is kept as flat bitarrays:
+            * the piece bitfield (one bit per piece), set once all the blocks of a piece are received
+            * the block bitfield (blocks_per_piece bits per piece), which tracks the blocks downloaded
+            * the available pieces (one bit per piece), verified and written to disk, so they can be
+              uploaded. This is the payload of the bitfield message
+        A piece is completed when all its blocks are completed.
         :param num_pieces: the number of pieces defined in the .torrent file
+        :param completed: optional bitarray with one bit per piece, set for the pieces already
+                          completed (i.e loaded from the fast-resume file). See also FastResume
+        :param blocks_per_piece: the number of blocks in a piece
+        :param last_piece_blocks: the number of blocks in the last piece, which may be shorter.
+                                  By default, blocks_per_piece
         :return: Void
         """
-        size_bitfield = math.ceil(num_pieces / 8)
-        spare_bits = (8 * size_bitfield) - num_pieces
-        # self._bitfield['bitfield'] = [[0, 0, 0, 0, 0, 0, 0, 0], [
-        #    1, 1, 1, 1, 1, 1, 1, 1], [1, 1, 1, 1, 1, 1, 1, 1]]
-        # print(self._bitfield)
-
-        for i in range(size_bitfield - 1):
-            # create a bitarray (piece) of 8 bits size
-            # set all the bits to 0 (missing piece)
-            # add the new piece to the bitfield (self._bitfield['bitfield])
-            p = bitarray(8)
-            p.setall(False)
-            self._bitfield['bitfield'].append(p)
-
-        # create a new bitarray (piece) of spare bits size
-        # # set all the bits to 0 (missing piece)
-        # add the new piece to the bitfield (self._bitfield['bitfield])
-        s = bitarray(spare_bits)
-        s.setall(False)
-        self._bitfield['bitfield'].append(s)
-        # print(self._bitfield)
+        self.num_pieces = num_pieces
+        self.blocks_per_piece = blocks_per_piece
+        self.last_piece_blocks = blocks_per_piece if last_piece_blocks is None else last_piece_blocks
+        pieces = bitarray(num_pieces)
+        pieces.setall(False)
+        self._blocks = bitarray(num_pieces * blocks_per_piece)
+        self._blocks.setall(False)
+        if num_pieces:
+            # blocks past the end of the file are never downloaded
+            self._blocks[(num_pieces - 1) * blocks_per_piece + self.last_piece_blocks:] = True
+        self._bitfield['bitfield'] = pieces
+        self._completed_pieces = 0
+        if completed is not None:
+            piece_index = completed.find(1)
+            while piece_index != -1:
+                self.set_piece_to_completed(piece_index)
+                piece_index = completed.find(1, piece_index + 1)
+        # the pieces completed by a previous run are on disk already
+        self._available = pieces.copy()
 
     def get_bitfield(self):
         """
-        TODO: get the bitfield payload
-        :return: the bitfield payload
+        Gets the bitfield payload
+        :return: the piece bitfield (bitarray with one bit per piece)
         """
         return self._bitfield['bitfield']
 
+    def get_bitfield_message(self):
+        """
+        :return: the bitfield message with the available pieces, ready to be encoded
+        """
+        return dict(self._bitfield, bitfield=self._available.copy())
+
+    def bitfield_to_bytes(self):
+        """
+        :return: the wire form of the bitfield. Spare bits at the end are set to zero.
+        """
+        return self._bitfield['bitfield'].tobytes()
+
+    def bitfield_from_bytes(self, data):
+        """
+        Sets the pieces of the bitfield from its wire form (i.e the payload of a bitfield message)
+        :param data: the bitfield bytes
+        :return: VOID
+        """
+        pieces = bitarray()
+        pieces.frombytes(bytes(data))
+        del pieces[self.num_pieces:]
+        pieces.extend([False] * (self.num_pieces - len(pieces)))
+        current = self._bitfield['bitfield']
+        for changed, update in ((pieces & ~current, self.set_piece_to_completed),
+                                (current & ~pieces, self.set_piece_to_missing)):
+            piece_index = changed.find(1)
+            while piece_index != -1:
+                update(piece_index)
+                piece_index = changed.find(1, piece_index + 1)
+
+    def _block_range(self, piece_index):
+        start = piece_index * self.blocks_per_piece
+        return start, start + self.blocks_per_piece
+
     def get_bitfield_piece(self, piece_index):
         """
-        TODO: gets a piece from the bitfield
+        Gets a piece from the bitfield
         :param piece_index:
-        :return: the piece bitfield located at index 'piece_index'
+        :return: the blocks of the piece located at index 'piece_index' (bitarray)
         """
-        return self._bitfield['bitfield'][piece_index]
+        start, end = self._block_range(piece_index)
+        return self._blocks[start:end]
 
     def get_bitfield_block(self, piece_index, block_index):
         """
-        TODO: gets a block from the bitfield
+        Gets a block from the bitfield
         :param piece_index:
         :param block_index:
         :return: the block bit located at index 'block_index'
         """
-        return self._bitfield['bitfield'][piece_index][block_index]
+        return self._blocks[piece_index * self.blocks_per_piece + block_index]
 
     def is_block_missing(self, piece_index, block_index):
         """
-        TODO: determines if a block is missing (missing blocks are set to bit 0)
+        Determines if a block is missing (missing blocks are set to bit 0)
         :param piece_index:
         :param block_index:
         :return: True if the block is missing. Otherwise, returns False
         """
-        return False if self._bitfield['bitfield'][piece_index][block_index] else True
+        return not self._blocks[piece_index * self.blocks_per_piece + block_index]
 
     def is_piece_missing(self, piece_index):
         """
-        TODO: determines if a piece is missing (missing pieces has at least one block set to bit 0)
+        Determines if a piece is missing (missing pieces has at least one block set to bit 0)
         :param piece_index:
         :return: True if the piece is missing. Otherwise, returns False
         """
-        for b in self._bitfield['bitfield'][piece_index]:
-            if b == 0:
-                return True
-        return False
+        return not self._bitfield['bitfield'][piece_index]
+
+    def is_piece_available(self, piece_index):
+        """
+        Determines if a piece can be uploaded: it passed the hash validation and it is written to disk
+        :param piece_index:
+        :return: True if the piece is available. Otherwise, returns False
+        """
+        return self._available[piece_index]
+
+    def set_piece_available(self, piece_index):
+        """
+        Sets a completed piece to available, once it is verified and written to disk (see DownloadScheduler)
+        :param piece_index:
+        :return: VOID
+        """
+        self._available[piece_index] = True
 
     def next_missing_block_index(self, piece_index):
         """
-        TODO: finds the next missing block
+        Finds the next missing block
         :param piece_index:
-        :return: the next missing block index
+        :return: the next missing block index, or -1 if the piece is completed
         """
-        i = 0
-        for b in self._bitfield['bitfield'][piece_index]:
-            if b == 0:
-                return i
-            i += 1
-        return -1
+        start, end = self._block_range(piece_index)
+        block_index = self._blocks.find(0, start, end)
+        return block_index - start if block_index != -1 else -1
 
-    def next_missing_piece_index(self):
+    def next_missing_piece_index(self, start=0):
         """
-        TODO: finds the next missing piece
-        :return: the next missing piece index
+        Finds the next missing piece
+        :param start: the piece index where the search starts
+        :return: the next missing piece index, or -1 if all the pieces are completed
         """
-        i = 0
-        for p in self._bitfield['bitfield']:
-            if self.is_piece_missing(i):
-                return i
-            i += 1
-        return -1
+        return self._bitfield['bitfield'].find(0, start)
 
     def set_block_to_completed(self, piece_index, block_index):
         """
-        TODO: set the block represented by the piece_index and block_index to b'1' or True
+        Set the block represented by the piece_index and block_index to True
+        The piece is set to completed when this was its last missing block
         :param piece_index:
         :param block_index:
         :return: VOID
         """
-        self._bitfield['bitfield'][piece_index][block_index] = b'1'
+        start, end = self._block_range(piece_index)
+        self._blocks[start + block_index] = True
+        if not self._bitfield['bitfield'][piece_index] and self._blocks.count(1, start, end) == end - start:
+            self._bitfield['bitfield'][piece_index] = True
+            self._completed_pieces += 1
+
+    def set_piece_to_completed(self, piece_index):
+        """
+        Sets a piece and all its blocks to completed
+        :param piece_index:
+        :return: VOID
+        """
+        start, end = self._block_range(piece_index)
+        self._blocks[start:end] = True
+        if not self._bitfield['bitfield'][piece_index]:
+            self._bitfield['bitfield'][piece_index] = True
+            self._completed_pieces += 1
+
+    def set_piece_to_missing(self, piece_index):
+        """
+        Sets a piece and its blocks to missing (i.e the piece failed the hash validation)
+        :param piece_index:
+        :return: VOID
+        """
+        start, end = self._block_range(piece_index)
+        self._blocks[start:end] = False
+        if piece_index == self.num_pieces - 1:
+            # keep the blocks past the end of the file completed
+            self._blocks[start + self.last_piece_blocks:end] = True
+        self._available[piece_index] = False
+        if self._bitfield['bitfield'][piece_index]:
+            self._bitfield['bitfield'][piece_index] = False
+            self._completed_pieces -= 1
+
+    def num_completed_pieces(self):
+        """
+        :return: the number of pieces completed (maintained count, no scan)
+        """
+        return self._completed_pieces
+
+    def progress(self):
+        """
+        :return: the fraction of pieces completed, from 0.0 to 1.0
+        """
+        return self._completed_pieces / self.num_pieces if self.num_pieces else 1.0
 
     def get_tracker_with_ip_port(self, ip, port):
         '''
@@ -262,3 +392,296 @@ class Message:
         self.tracker["ip"] = ip
         self.tracker["port"] = port
         return self.tracker
+
+    #############################  Wire Format Methods ####################################################
+
+    @classmethod
+    def encode(cls, data):
+        """
+        Encodes a message in its wire form: <length prefix (4 bytes)><message id (1 byte)><payload>
+        PWP messages are struct packed. Any other message is bencoded inside a control frame.
+        :param data: the message (i.e message.request with index, begin and length set)
+        :return: the encoded message
+        """
+        message_id = data.get('id') if isinstance(data, dict) else None
+        if message_id in (cls.CHOKE, cls.UNCHOKE, cls.INTERESTED, cls.NOT_INTERESTED):
+            payload = b''
+        elif message_id == cls.HAVE:
+            payload = cls.HAVE_PAYLOAD.pack(data['piece_index'])
+        elif message_id == cls.BITFIELD:
+            payload = cls._bitfield_to_bytes(data['bitfield'])
+        elif message_id in (cls.REQUEST, cls.CANCEL):
+            payload = cls.REQUEST_PAYLOAD.pack(
+                data['index'], data['begin'], data['length'])
+        elif message_id == cls.PIECE:
+            block = data['block']
+            if isinstance(block, str):
+                block = block.encode("utf8")
+            return cls.piece_header(data['index'], data['begin'], len(block)) + block
+        elif message_id == cls.PORT:
+            payload = cls.PORT_PAYLOAD.pack(data['listen-port'])
+        elif message_id == cls.EXTENDED:
+            # <extended message id><bencoded ut_pex dictionary>, as in BEP 11. No flags are known for the peers
+            added, dropped = cls._compact_peers(data['added']), cls._compact_peers(data['dropped'])
+            pex = {'added': added, 'added.f': bytes(len(added) // cls.COMPACT_PEER_SIZE), 'dropped': dropped}
+            payload = cls.MESSAGE_ID.pack(cls.UT_PEX) + bencodepy.encode(pex)
+        elif isinstance(data, dict) and set(data) == {'len'}:
+            # keep alive has no id and no payload
+            return cls.LENGTH_PREFIX.pack(0)
+        else:
+            message_id = cls.CONTROL
+            payload = bencodepy.encode(cls._to_bencode(data))
+        return b''.join((cls.LENGTH_PREFIX.pack(1 + len(payload)),
+                         cls.MESSAGE_ID.pack(message_id), payload))
+
+    @classmethod
+    def piece_header(cls, index, begin, block_length):
+        """
+        Encodes the part of a piece message that goes before the block, so the block can be
+        sent right after it straight from the file (see Uploader)
+        :param index: the piece index
+        :param begin: the offset of the block in the piece
+        :param block_length: the length of the block that follows the header
+        :return: the encoded header
+        """
+        return b''.join((cls.LENGTH_PREFIX.pack(1 + cls.PIECE_HEADER.size + block_length),
+                         cls.MESSAGE_ID.pack(cls.PIECE), cls.PIECE_HEADER.pack(index, begin)))
+
+    @classmethod
+    def decode(cls, frame):
+        """
+        Decodes a single frame (without its length prefix) into a message dictionary
+        Piece blocks are returned as memoryview slices of the frame, so no copy is made.
+        :param frame: the bytes of the frame
+        :return: the message
+        """
+        if not frame:
+            return {'len': 0}  # keep alive
+        message_id = frame[0]
+        length = len(frame)
+        try:
+            if message_id in (cls.CHOKE, cls.UNCHOKE, cls.INTERESTED, cls.NOT_INTERESTED):
+                if length != 1:
+                    raise ProtocolException(
+                        'Unexpected payload in message id %d' % message_id)
+                return {'len': length, 'id': message_id}
+            if message_id == cls.HAVE:
+                (piece_index,) = cls.HAVE_PAYLOAD.unpack_from(frame, 1)
+                return {'len': length, 'id': message_id, 'piece_index': piece_index}
+            if message_id == cls.BITFIELD:
+                return {'len': length, 'id': message_id, 'bitfield': bytes(frame[1:])}
+            if message_id in (cls.REQUEST, cls.CANCEL):
+                index, begin, block_length = cls.REQUEST_PAYLOAD.unpack_from(
+                    frame, 1)
+                return {'len': length, 'id': message_id, 'index': index, 'begin': begin,
+                        'length': block_length}
+            if message_id == cls.PIECE:
+                index, begin = cls.PIECE_HEADER.unpack_from(frame, 1)
+                block = memoryview(frame)[1 + cls.PIECE_HEADER.size:]
+                return {'len': length, 'id': message_id, 'index': index, 'begin': begin,
+                        'block': block}
+            if message_id == cls.PORT:
+                (listen_port,) = cls.PORT_PAYLOAD.unpack_from(frame, 1)
+                return {'len': length, 'id': message_id, 'listen-port': listen_port}
+            if message_id == cls.EXTENDED:
+                if length < 2 or frame[1] != cls.UT_PEX:
+                    raise ProtocolException('Unknown extended message')
+                pex = bencodepy.decode(bytes(frame[2:]))
+                if not isinstance(pex, dict):
+                    raise ProtocolException('Malformed peer exchange message')
+                added, dropped = pex.get(b'added', b''), pex.get(b'dropped', b'')
+                if not isinstance(added, bytes) or not isinstance(dropped, bytes):
+                    raise ProtocolException('Malformed peer exchange message')
+                return {'len': length, 'id': message_id, 'added': cls._compact_peers(added),
+                        'dropped': cls._compact_peers(dropped)}
+            if message_id == cls.CONTROL:
+                return cls._from_bencode(bencodepy.decode(bytes(frame[1:])))
+        except (struct.error, bencodepy.BencodeDecodeError, UnicodeDecodeError, ValueError, TypeError) as ex:
+            raise ProtocolException(
+                'Malformed message id %d: %s' % (message_id, ex))
+        raise ProtocolException('Unknown message id %d' % message_id)
+
+    @classmethod
+    def _compact_peers(cls, peers):
+        """
+        :param peers: a compact peer list of the peer exchange (6 bytes per peer)
+        :return: the compact peer list (bytes)
+        :raise ValueError: if it is not a whole number of compact peers
+        """
+        peers = bytes(peers)
+        if len(peers) % cls.COMPACT_PEER_SIZE != 0:
+            raise ValueError('Compact peer list of %d bytes' % len(peers))
+        return peers
+
+    # type tags of the strings of a control frame. Bencode only has strings, integers, lists and dictionaries
+    STR_TAG, BYTES_TAG, UUID_TAG = b's', b'b', b'u'
+    NONE, TRUE, FALSE = b'n', b't', b'f'
+
+    @classmethod
+    def _to_bencode(cls, value):
+        """
+        Converts a control message to bencodable values. Strings, bytes, peer ids (uuid), None and booleans
+        become tagged byte strings, so they are decoded back to the same type. Nothing else is accepted: the
+        decoder only ever builds plain data from the bytes of the network.
+        :param value: the message, or any value in it
+        :return: the bencodable value
+        """
+        if value is None:
+            return cls.NONE
+        if isinstance(value, bool):
+            return cls.TRUE if value else cls.FALSE
+        if isinstance(value, int):
+            return value
+        if isinstance(value, str):
+            return cls.STR_TAG + value.encode("utf8")
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return cls.BYTES_TAG + bytes(value)
+        if isinstance(value, uuid.UUID):
+            return cls.UUID_TAG + value.bytes
+        if isinstance(value, (list, tuple)):
+            return [cls._to_bencode(item) for item in value]
+        if isinstance(value, dict):
+            return {str(key).encode("utf8"): cls._to_bencode(item) for key, item in value.items()}
+        raise TypeError('Type %s cannot be sent in a control frame' % type(value).__name__)
+
+    @classmethod
+    def _from_bencode(cls, value):
+        """
+        Converts a decoded bencode value back to the control message, see _to_bencode()
+        :param value: the value decoded by bencodepy (byte strings, integers, lists and dictionaries)
+        :return: the message, or the value in it
+        """
+        if isinstance(value, int):
+            return value
+        if isinstance(value, list):
+            return [cls._from_bencode(item) for item in value]
+        if isinstance(value, dict):
+            return {key.decode("utf8"): cls._from_bencode(item) for key, item in value.items()}
+        tag, payload = value[:1], value[1:]
+        if tag == cls.STR_TAG:
+            return payload.decode("utf8")
+        if tag == cls.BYTES_TAG:
+            return payload
+        if tag == cls.UUID_TAG:
+            return uuid.UUID(bytes=payload)
+        if value in (cls.NONE, cls.TRUE, cls.FALSE):
+            return None if value == cls.NONE else value == cls.TRUE
+        raise ValueError('Unknown type tag %r' % tag)
+
+    @staticmethod
+    def _bitfield_to_bytes(bitfield):
+        """
+        Converts a bitfield payload to bytes
+        :param bitfield: bytes or a bitarray
+        :return: the bitfield bytes. Spare bits at the end are set to zero.
+        """
+        if isinstance(bitfield, (bytes, bytearray)):
+            return bytes(bitfield)
+        return bitfield.tobytes()
+
+
+class MessageDecoder:
+    """
+    Incremental decoder for the length-prefixed wire format implemented in Message.encode()
+    A single recv() may return part of a message, or several messages merged together, so
+    the received bytes are buffered until complete frames are available.
+    USAGE: decoder = MessageDecoder()
+           for message in decoder.feed(sock.recv(4096)):
+               print(message)
+           # or, to block until the next message arrives
+           message = decoder.receive(sock)
+           pipelined = decoder.drain()  # messages received together with it
+    """
+
+    def __init__(self, max_message_length=Message.MAX_MESSAGE_LENGTH):
+        self.max_message_length = max_message_length
+        self._buffer = bytearray()
+        self._pending = deque()  # messages decoded but not retrieved yet by receive()
+
+    def feed(self, data):
+        """
+        Adds received data to the buffer and decodes all the complete frames
+        :param data: the bytes received
+        :return: a list with the decoded messages (may be empty)
+        """
+        buffer = self._buffer
+        buffer += data
+        messages = []
+        offset = 0
+        prefix_size = Message.LENGTH_PREFIX.size
+        while len(buffer) - offset >= prefix_size:
+            (length,) = Message.LENGTH_PREFIX.unpack_from(buffer, offset)
+            if length > self.max_message_length:
+                # the end of the frame cannot be trusted, so the stream cannot be read any further
+                buffer.clear()
+                self._pending.extend(messages)
+                raise ProtocolException(
+                    'Message length %d exceeds the max allowed' % length)
+            end = offset + prefix_size + length
+            if end > len(buffer):
+                break  # partial message, wait for more data
+            try:
+                messages.append(Message.decode(
+                    bytes(buffer[offset + prefix_size:end])))
+            except ProtocolException:
+                # skips the bad frame. The messages decoded before it are kept for receive()
+                del buffer[:end]
+                self._pending.extend(messages)
+                raise
+            offset = end
+        del buffer[:offset]
+        return messages
+
+    def receive(self, sock, max_buffer_size=4096, throttle=None):
+        """
+        Blocks until the next complete message is received from the socket
+        :param sock: the socket to read from
+        :param max_buffer_size: max bytes read by each recv() call
+        :param throttle: optional callable(num_bytes) called after each recv() (i.e to limit the download rate)
+        :return: the message, or None if the connection was closed
+        """
+        while not self._decode_buffered():
+            data = sock.recv(max_buffer_size)
+            if not data:
+                return None
+            if throttle:
+                throttle(len(data))
+            self._pending.extend(self.feed(data))
+        return self._pending.popleft()
+
+    def _decode_buffered(self):
+        """
+        Decodes the complete frames left in the buffer when a bad frame was skipped, so they are not kept
+        waiting for more data from the peer
+        :return: True if a message is pending
+        """
+        if not self._pending and len(self._buffer) >= Message.LENGTH_PREFIX.size:
+            self._pending.extend(self.feed(b''))
+        return bool(self._pending)
+
+    def drain(self):
+        """
+        Retrieves the messages already decoded without reading from the socket
+        (i.e the requests pipelined behind the message returned by receive())
+        :return: a list with the messages (may be empty)
+        """
+        messages = list(self._pending)
+        self._pending.clear()
+        return messages
+
+    async def receive_async(self, reader, max_buffer_size=4096, throttle=None):
+        """
+        Coroutine version of receive() for asyncio streams
+        :param reader: the asyncio StreamReader to read from
+        :param max_buffer_size: max bytes read by each read() call
+        :param throttle: optional coroutine function(num_bytes) awaited after each read()
+        :return: the message, or None if the connection was closed
+        """
+        while not self._decode_buffered():
+            data = await reader.read(max_buffer_size)
+            if not data:
+                return None
+            if throttle:
+                await throttle(len(data))
+            self._pending.extend(self.feed(data))
+        return self._pending.popleft()
@@ -1,10 +1,21 @@
 from server import Server  # assumes that your Tracker file is in this folder
+from async_server import AsyncServer
+from config import Config
 from client import Client
 from message import Message
 from tracker import Tracker  # assumes that your Tracker file is in this folder
 from torrent import Torrent  # assumes that your Torrent file is in this folder
+from file_manager import FileManager
+from fast_resume import FastResume
+from piece_picker import PiecePicker
+from rate_limiter import RateLimiter
+from scheduler import DownloadScheduler
+from udp_tracker import UDPTrackerClient
+from custom_exception import ProtocolException
+from pex import PeerExchange
 
-from threading import Thread
+from threading import Event, Lock, Thread
+import atexit
 import time
 import uuid
 
@@ -15,8 +26,9 @@ class Peer:
     CLIENT_MAX_PORT_RANGE = 5010
 
     MAX_NUM_CONNECTIONS = 10
-    MAX_UPLOAD_RATE = 100
-    MAX_DOWNLOAD_RATE = 1000
+    ANNOUNCE_RETRY_INTERVAL = 60  # seconds before announcing again when the tracker does not answer
+    COMPLETED_CHECK_INTERVAL = 5  # seconds between checks of the download, to announce completed
+    TRACKER_START_TIMEOUT = 30  # seconds waiting for the first DHT lookup
 
     PEER = 'peer'
     LEECHER = 'leecher'
@@ -39,16 +51,80 @@ class Peer:
         self.DHT = None
         self.torrent = Torrent(self.TORRENT_PATH)
         self.message = Message(self.id, self.torrent.create_info_hash())
+        # pieces already downloaded by a previous run are loaded from the fast-resume file
+        self.file_manager = FileManager(self.torrent, self.id)
+        self.fast_resume = FastResume(self.torrent, self.file_manager)
+        self._init_bitfield(self.fast_resume.load(self._verify_progress))
+        # availability of the pieces in the swarm, shared by all the clients
+        self.piece_picker = PiecePicker(self.torrent.num_pieces(),
+                                        Config().snapshot().download.piece_picker)
+        # assigns the blocks to request to all the clients
+        self.scheduler = DownloadScheduler(self.torrent, self.message, self.file_manager,
+                                           self.piece_picker, self.fast_resume)
+        # token buckets shared by the server and the clients of this peer, with the rates of conf.ini
+        self.upload_limiter = RateLimiter.from_config("max-upload-rate")
+        self.download_limiter = RateLimiter.from_config("max-download-rate")
         # peer_id, torrent, message, server_ip_address="127.0.0.1", server_port=12000
-        self.server = Server(
+        engine = Config().snapshot().network.server_engine
+        server_class = AsyncServer if engine == AsyncServer.ENGINE else Server
+        self.server = server_class(
             peer_id=self.id,
             torrent=self.torrent,
             message=self.message,
             server_ip_address=server_ip_address,
-            server_port=self.SERVER_PORT)
+            server_port=self.SERVER_PORT,
+            upload_limiter=self.upload_limiter,
+            download_limiter=self.download_limiter)
+        # the choker ranks the peers by the rate this peer downloads from them
+        self.server.choker.scheduler = self.scheduler
+        # the pieces downloaded are announced to the peers connected to the server too
+        self.scheduler.server = self.server
+        # peers learned from the connected peers are connected to, so they do not all go to the tracker
+        self.pex = PeerExchange((server_ip_address, int(self.SERVER_PORT)), on_peers=self.connect)
+        self.server.pex = self.pex
         self.tracker = None
+        # client ports not bound, a port is free again once its connection is closed. connect() is called by
+        # the main thread, the announce thread, and the peer exchange thread
+        self.client_ports = set(range(self.CLIENT_MIN_PORT_RANGE, self.CLIENT_MAX_PORT_RANGE + 1))
+        self._connect_lock = Lock()
+        self.udp_tracker = None  # client of the UDP tracker, see announce_to_tracker()
+        self.tracker_interval = None  # seconds between announces returned by the tracker, None if no answer
+        self._announce_thread = None
+        self._stop_announces = Event()
         #Server.__init__(self, self.id, self.torrent, server_ip_address, self.SERVER_PORT)
 
+    def _verify_progress(self, pieces_verified, pieces_to_verify):
+        end = "\n" if pieces_verified == pieces_to_verify else ""
+        print("\rVerifying pieces: %d/%d" % (pieces_verified, pieces_to_verify), end=end)
+
+    def force_recheck(self):
+        """
+        Re-verifies every piece of the file, and advertises the resulting bitfield
+        :return: VOID
+        """
+        self._init_bitfield(self.fast_resume.recheck(self._verify_progress))
+        # the cached pieces were read before the recheck
+        if self.server.piece_cache is not None:
+            self.server.piece_cache.clear()
+
+    def _init_bitfield(self, completed):
+        num_pieces = self.torrent.num_pieces()
+        self.message.init_bitfield(num_pieces, completed,
+                                   blocks_per_piece=self.file_manager.num_blocks(0),
+                                   last_piece_blocks=self.file_manager.num_blocks(num_pieces - 1))
+
+    def set_rates(self, max_upload_rate=None, max_download_rate=None):
+        """
+        Changes the rates shared by all the connections at runtime
+        :param max_upload_rate: KiB per second, 0 for unlimited. None keeps the current rate
+        :param max_download_rate: KiB per second, 0 for unlimited. None keeps the current rate
+        :return: VOID
+        """
+        if max_upload_rate is not None:
+            self.upload_limiter.set_rate(int(max_upload_rate * 1024))
+        if max_download_rate is not None:
+            self.download_limiter.set_rate(int(max_download_rate * 1024))
+
     def MOD_SERVER_PORT(self, value):
         self.SERVER_PORT = str(value)
 
@@ -63,6 +139,8 @@ class Peer:
         try:
             # must thread the server, otherwise it will block the main thread
             Thread(target=self.server.run, daemon=False).start()
+            self.pex.start()
+            self.start_announces()
             print("Server started.........")
         except Exception as ex:
             print(self.ERROR_TEMPLATE.format(
@@ -78,14 +156,86 @@ class Peer:
             if self.server:
                 self.tracker = Tracker(self.server, self.torrent, announce)
                 Thread(target=self.tracker.run, daemon=False).start()
-                while not self.DHT:
-                    self.DHT = self.tracker.get_DHT()
-                    time.sleep(.5)  # optional
+                # the DHT may have no other peer, so this waits for the first lookup, not for peers
+                if not self.tracker.started.wait(self.TRACKER_START_TIMEOUT):
+                    print("DHT lookup not done after %d seconds....." % self.TRACKER_START_TIMEOUT)
+                self.DHT = self.tracker.get_DHT()
                 print("Tracker running and DHT tables created.....")
         except Exception as ex:
             print(self.ERROR_TEMPLATE.format(
                 "run_tracker()", type(ex).__name__, ex.args))
 
+    def announce_to_tracker(self, event=None, url=None):
+        """
+        Announces this peer to the UDP tracker (BEP 15), and gets peers of the swarm
+        :param event: "started", "completed", "stopped", or None for the announces done at regular intervals
+        :param url: the tracker url (udp://host:port/announce). By default, the tracker announce url in conf.ini
+        :return: the compact peer list of the swarm (see connect()), empty if the tracker did not answer
+        """
+        try:
+            if self.udp_tracker is None:
+                self.udp_tracker = UDPTrackerClient(*UDPTrackerClient.address(url))
+            left = sum(self.file_manager.piece_length(index) for index in range(self.message.num_pieces)
+                       if self.message.is_piece_missing(index))
+            announce = dict(self.message.tracker, port=int(self.SERVER_PORT), left=left, event=event,
+                            uploaded=self.server.uploaded, downloaded=self.scheduler.downloaded())
+            interval, leechers, seeders, peers = self.udp_tracker.announce(announce)
+            self.tracker_interval = interval
+            print("Tracker: %d seeders, %d leechers, next announce in %ds" % (seeders, leechers, interval))
+            return peers
+        except (OSError, ProtocolException) as ex:
+            self.tracker_interval = None
+            print(self.ERROR_TEMPLATE.format(
+                "announce_to_tracker()", type(ex).__name__, ex.args))
+            return b""
+
+    def start_announces(self):
+        """
+        Starts the announce thread: announces started to the UDP tracker and connects to the peers returned,
+        then announces again every interval returned by the tracker, and announces completed once the
+        download completes. Stopped is announced when the program exits (see stop_announces())
+        :return: VOID
+        """
+        if self._announce_thread is None:
+            self._announce_thread = Thread(target=self._announce_run, daemon=True)
+            self._announce_thread.start()
+            atexit.register(self.stop_announces)
+
+    def _announce_run(self):
+        event = "started"
+        # a peer that starts with the whole file never announces completed
+        completed = self.scheduler.completed()
+        while not self._stop_announces.is_set():
+            peers = self.announce_to_tracker(event)
+            if self.tracker_interval is None:
+                wait = self.ANNOUNCE_RETRY_INTERVAL  # the same event is announced again
+            else:
+                event, wait = None, self.tracker_interval
+                if peers:
+                    self.connect(peers)
+            next_announce = time.monotonic() + wait
+            while time.monotonic() < next_announce:
+                timeout = min(self.COMPLETED_CHECK_INTERVAL, next_announce - time.monotonic())
+                if self._stop_announces.wait(max(timeout, 0)):
+                    return
+                if not completed and self.scheduler.completed():
+                    completed, event = True, "completed"
+                    break
+
+    def stop_announces(self):
+        """
+        Stops the announce thread and announces stopped, so the tracker removes this peer from the swarm
+        :return: VOID
+        """
+        if self._announce_thread is None or self._stop_announces.is_set():
+            return
+        self._stop_announces.set()
+        # the thread may be waiting for the tracker, the client of the tracker is not shared between threads
+        self._announce_thread.join()
+        if self.udp_tracker is not None:
+            self.announce_to_tracker("stopped")
+            self.udp_tracker.close()
+
     def _connect_to_peer(self, client_port_to_bind, peer_ip_address, peer_port):
         """
         TODO: * Create a new client object and bind the port given as a
@@ -100,12 +250,14 @@ class Peer:
         :return: VOID
         """
         print('Trying ', peer_ip_address, '/', client_port_to_bind)
-        client = Client(peer_id=self.id, torrent=self.torrent, message=self.message)
+        client = Client(peer_id=self.id, torrent=self.torrent, message=self.message,
+                        scheduler=self.scheduler, upload_limiter=self.upload_limiter,
+                        download_limiter=self.download_limiter, pex=self.pex)
         try:
             client.bind('0.0.0.0', client_port_to_bind)
             # must thread the client too, otherwise it will block the main thread
-            Thread(target=client.connect, args=(
-                peer_ip_address, peer_port)).start()
+            Thread(target=self._run_client, args=(
+                client, client_port_to_bind, peer_ip_address, peer_port)).start()
             print("Client started.........")
             return True
             # ! Need to run downloader
@@ -116,25 +268,42 @@ class Peer:
             client.close()
             return False
 
+    def _run_client(self, client, client_port, peer_ip_address, peer_port):
+        """
+        Runs a client until its connection is closed, then frees its port for the next connections
+        :return: VOID
+        """
+        try:
+            client.connect(peer_ip_address, peer_port)
+        finally:
+            with self._connect_lock:
+                self.client_ports.add(client_port)
+
     def connect(self, peers_ip_addresses):
         """
-        TODO: Initialize a temporal variable to the min client port range, then
-              For each peer ip address, call the method _connect_to_peer()
-              method, and then increment the client´s port range that
-              needs to be bind to the next client. Break the loop when the
-              port value is greater than the max client port range.
-        :param peers: list of peer´s ip addresses in the network
+        TODO: For each peer ip address not connected yet, take the lowest free client port (see
+              self.client_ports) and call the method _connect_to_peer(). The port is free again once the
+              connection is closed. Break the loop when there is no free client port.
+        :param peers: the compact peer list (6 bytes per peer) of the peers in the network, or a list of
+                      (ip address, port)
         :return: VOID
         """
-        client_port = self.CLIENT_MIN_PORT_RANGE
-        for ip_address in peers_ip_addresses:
-            if client_port > self.CLIENT_MAX_PORT_RANGE:
-                print("Connected max Peer ports...")
-                break
-            if '/' in ip_address:
-                peer_ip, peer_port = ip_address.split('/')
-            if self._connect_to_peer(client_port, peer_ip, int(peer_port)):
-                client_port += 1
+        if isinstance(peers_ip_addresses, (bytes, bytearray)):
+            peers_ip_addresses = Tracker.decode_peers(peers_ip_addresses)
+        with self._connect_lock:
+            connected = self.pex.connected_addresses()
+            failed = []  # ports that could not be bound are not tried again for the next peers
+            for peer_ip, peer_port in peers_ip_addresses:
+                if not self.client_ports:
+                    print("Connected max Peer ports...")
+                    break
+                if (peer_ip, int(peer_port)) in connected:
+                    continue
+                client_port = min(self.client_ports)
+                self.client_ports.remove(client_port)
+                if not self._connect_to_peer(client_port, peer_ip, int(peer_port)):
+                    failed.append(client_port)
+            self.client_ports.update(failed)
 
 
 if __name__ == '__main__':
@@ -153,4 +322,5 @@ if __name__ == '__main__':
     if peer.role == peer.SEEDER:
         # this list will be sent by the tracker in your P2P assignment
         peer_ips = peer.get_DHT()
-        peer.connect(peer_ips)
+        if peer_ips:
+            peer.connect(peer_ips)
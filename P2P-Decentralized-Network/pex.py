@@ -0,0 +1,174 @@
+import threading
+import time
+
+from tracker import Tracker
+
+
+class PeerExchange:
+    """
+    Peer exchange (PEX, BEP 11): peers learn about each other through the connections they already hold,
+    so only the first peers of a swarm come from the tracker.
+    Every INTERVAL seconds, each connection is sent the diff between the peers this peer is connected to
+    and the peers already advertised on that connection: the peers added since the last message and the
+    peers dropped. A message carries at most MAX_ADDED added and MAX_DROPPED dropped peers, the rest is
+    sent in the next messages. Messages received more often than MIN_RECEIVE_INTERVAL on a connection are
+    ignored, and at most MAX_KNOWN peers learned are kept to connect to.
+    Peers are advertised by their listen address (ip, server port): the address connected to for the
+    client connections, and the listen port sent in the handshake for the connections accepted by the server.
+    USAGE: pex = PeerExchange(("127.0.0.1", 5000), on_peers=peer.connect)
+           pex.start()
+           pex.connected(connection, (ip, port))  # connection.send_pex(added, dropped), compact peer lists
+           pex.received(connection, added, dropped)  # on a pex message
+           pex.disconnected(connection)
+    """
+    INTERVAL = 60  # seconds between the messages sent on a connection
+    MIN_RECEIVE_INTERVAL = 30  # seconds
+    TICK = 1  # seconds between checks of the connections due for a message
+    MAX_ADDED = 50
+    MAX_DROPPED = 50
+    MAX_KNOWN = 200
+
+    ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in pex.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
+
+    def __init__(self, listen_address, on_peers=None):
+        """
+        Class constructor
+        :param listen_address: (ip, port) of the server of this peer, never advertised nor connected to
+        :param on_peers: optional on_peers(compact peer list), called with the new peers learned
+        """
+        self.listen_address = listen_address
+        self.listen_port = listen_address[1]
+        self.on_peers = on_peers
+        self._connections = {}  # connection -> listen address of the remote peer, or None if not known
+        self._advertised = {}  # connection -> set of the addresses advertised on it
+        self._last_sent = {}  # connection -> time of the last message sent
+        self._last_received = {}  # connection -> time of the last message received
+        self.known = {}  # listen address -> time learned, of the peers learned that are not connected
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.messages_ignored = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the thread that sends the messages
+        :return: VOID
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.TICK)
+            try:
+                self.send_due()
+            except Exception as ex:
+                print(self.ERROR_TEMPLATE.format(
+                    "_run()", type(ex).__name__, ex.args))
+
+    def connected(self, connection, address=None):
+        """
+        Adds a connection. Its first message is sent at the next tick
+        :param connection: an object with a send_pex(added, dropped) method
+        :param address: listen address (ip, port) of the remote peer, None if not known
+        :return: VOID
+        """
+        with self._lock:
+            self._connections[connection] = tuple(address) if address else None
+            self._advertised[connection] = set()
+            self._last_sent[connection] = 0
+            if address:
+                self.known.pop(tuple(address), None)
+
+    def disconnected(self, connection):
+        """
+        Removes a connection. Its peer is advertised as dropped on the other connections
+        :param connection:
+        :return: VOID
+        """
+        with self._lock:
+            self._connections.pop(connection, None)
+            self._advertised.pop(connection, None)
+            self._last_sent.pop(connection, None)
+            self._last_received.pop(connection, None)
+
+    def connected_addresses(self):
+        with self._lock:
+            return {address for address in self._connections.values() if address}
+
+    def send_due(self, now=None):
+        """
+        Sends the diffs to the connections that were not sent a message for INTERVAL seconds
+        :param now: time.monotonic(). By default, now
+        :return: the number of messages sent
+        """
+        now = time.monotonic() if now is None else now
+        messages = []
+        with self._lock:
+            current = {address for address in self._connections.values() if address}
+            for connection, address in self._connections.items():
+                if now - self._last_sent[connection] < self.INTERVAL:
+                    continue
+                advertised = self._advertised[connection]
+                peers = current - {address}
+                added = list(peers - advertised)[:self.MAX_ADDED]
+                dropped = list(advertised - peers)[:self.MAX_DROPPED]
+                if not added and not dropped:
+                    continue
+                advertised.update(added)
+                advertised.difference_update(dropped)
+                self._last_sent[connection] = now
+                messages.append((connection, Tracker.encode_peers(added), Tracker.encode_peers(dropped)))
+        for connection, added, dropped in messages:
+            try:
+                connection.send_pex(added, dropped)
+                self.messages_sent += 1
+            except OSError as ex:
+                print(self.ERROR_TEMPLATE.format(
+                    "send_due()", type(ex).__name__, ex.args))
+        return len(messages)
+
+    def received(self, connection, added, dropped, now=None):
+        """
+        Records the peers advertised by the remote peer of a connection, and hands the new ones to on_peers
+        :param connection:
+        :param added: compact peer list of the peers added
+        :param dropped: compact peer list of the peers dropped
+        :param now: see send_due()
+        :return: the compact peer list of the new peers
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            last = self._last_received.get(connection)
+            if connection not in self._connections or (last is not None and
+                                                       now - last < self.MIN_RECEIVE_INTERVAL):
+                self.messages_ignored += 1
+                return b""
+            self._last_received[connection] = now
+            self.messages_received += 1
+            connected = set(self._connections.values())
+            for address in Tracker.decode_peers(dropped[:self.MAX_DROPPED * Tracker.COMPACT_PEER.size]):
+                self.known.pop(address, None)
+            new = []
+            for address in Tracker.decode_peers(added[:self.MAX_ADDED * Tracker.COMPACT_PEER.size]):
+                if address in connected or address in self.known or address == tuple(self.listen_address):
+                    continue
+                if len(self.known) >= self.MAX_KNOWN:
+                    # forgets the peer learned first
+                    self.known.pop(next(iter(self.known)))
+                self.known[address] = now
+                new.append(address)
+        new = Tracker.encode_peers(new)
+        if new and self.on_peers:
+            self.on_peers(new)
+        return new
+
+    def stats(self):
+        """
+        :return: dict with the counters of the peer exchange
+        """
+        return {'connections': len(self._connections), 'known': len(self.known),
+                'messages-sent': self.messages_sent, 'messages-received': self.messages_received,
+                'messages-ignored': self.messages_ignored}
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+import threading
+
+
+class PieceCache:
+    """
+    Bounded LRU cache of verified pieces, shared by all the uploaders of a server.
+    Many downloaders request the same pieces at the same time (i.e the first and the rarest ones),
+    so those are served from memory instead of going back to disk for every block.
+    The cache is budgeted in bytes: the least recently used pieces are evicted when
+    the pieces stored exceed max_bytes.
+    USAGE: cache = PieceCache(4 * 1024 * 1024)
+           piece = cache.get(piece_index)
+           if piece is None:
+               piece = file_manager.read_piece(piece_index)
+               cache.put(piece_index, piece)
+           print(cache.stats())  # {'hits': 0, 'misses': 1, 'evictions': 0, ...}
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Class constructor
+        :param max_bytes: max number of bytes kept in the cache. 0 disables the cache
+        """
+        self.max_bytes = max_bytes
+        self._pieces = OrderedDict()  # piece index -> piece, from least to most recently used
+        self._size = 0  # bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, piece_index):
+        """
+        :param piece_index:
+        :return: the piece, or None if it is not cached
+        """
+        with self._lock:
+            piece = self._pieces.get(piece_index)
+            if piece is None:
+                self.misses += 1
+                return None
+            self._pieces.move_to_end(piece_index)
+            self.hits += 1
+            return piece
+
+    def put(self, piece_index, piece):
+        """
+        Caches a piece. Only pieces validated with their hash must be cached
+        :param piece_index:
+        :param piece: the piece (bytes)
+        :return: VOID
+        """
+        if len(piece) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._pieces.pop(piece_index, None)
+            if old is not None:
+                self._size -= len(old)
+            self._pieces[piece_index] = piece
+            self._size += len(piece)
+            while self._size > self.max_bytes:
+                _, evicted = self._pieces.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._pieces.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        :return: the cache counters
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'pieces': len(self._pieces), 'bytes': self._size, 'max_bytes': self.max_bytes}
+
+    def __len__(self):
+        return len(self._pieces)
@@ -0,0 +1,153 @@
+import random
+import threading
+
+from bitarray import bitarray
+from bitarray.util import count_n
+
+
+class PiecePicker:
+    """
+    Chooses the next piece to download from a peer, shared by all the connections of a torrent
+    The picker keeps the availability of every piece (how many connected peers have it), updated from the
+    bitfield and have messages of each peer.
+        * rarest-first: picks one of the rarest pieces the peer has and we miss, breaking ties at random,
+          so leechers spread over different pieces and rare pieces get replicated first.
+        * sequential: always picks the lowest piece index (the behavior of Message.next_missing_piece_index)
+    Pieces are grouped by availability in one bitarray per count, so a pick is done with a few C-level
+    bitarray operations instead of a scan over all the pieces.
+    USAGE: picker = PiecePicker(num_pieces)
+           picker.peer_bitfield(peer, bitfield_payload)
+           picker.peer_have(peer, piece_index)
+           piece_index = picker.pick(peer, message.get_bitfield())  # -1 if nothing to download
+           picker.peer_disconnected(peer)
+    """
+    RAREST_FIRST = "rarest-first"
+    SEQUENTIAL = "sequential"
+
+    def __init__(self, num_pieces, mode=RAREST_FIRST):
+        """
+        Class constructor
+        :param num_pieces: the number of pieces of the torrent
+        :param mode: RAREST_FIRST or SEQUENTIAL
+        """
+        if mode not in (self.RAREST_FIRST, self.SEQUENTIAL):
+            raise ValueError("unknown piece picker mode: " + str(mode))
+        self.num_pieces = num_pieces
+        self.mode = mode
+        self._availability = [0] * num_pieces
+        # _by_availability[count] has the bits set for the pieces owned by 'count' peers
+        self._by_availability = [self._empty()]
+        self._by_availability[0].setall(True)
+        self._peers = {}  # peer -> bitarray of the pieces the peer has
+        self._lock = threading.Lock()
+
+    def _empty(self):
+        pieces = bitarray(self.num_pieces)
+        pieces.setall(False)
+        return pieces
+
+    def _to_bitarray(self, bitfield):
+        if isinstance(bitfield, bitarray):
+            pieces = bitfield.copy()
+        else:
+            pieces = bitarray()
+            pieces.frombytes(bytes(bitfield))
+        del pieces[self.num_pieces:]
+        pieces.extend([False] * (self.num_pieces - len(pieces)))
+        return pieces
+
+    def _move(self, piece_index, delta):
+        count = self._availability[piece_index]
+        self._by_availability[count][piece_index] = False
+        count += delta
+        if count == len(self._by_availability):
+            self._by_availability.append(self._empty())
+        self._by_availability[count][piece_index] = True
+        self._availability[piece_index] = count
+
+    def peer_bitfield(self, peer, bitfield):
+        """
+        Records the pieces a peer has (i.e from its bitfield message). Replaces any previous bitfield
+        :param peer: any hashable object identifying the connection
+        :param bitfield: the bitfield payload (bytes) or a bitarray
+        :return: VOID
+        """
+        pieces = self._to_bitarray(bitfield)
+        with self._lock:
+            self._remove_peer(peer)
+            self._peers[peer] = pieces
+            piece_index = pieces.find(1)
+            while piece_index != -1:
+                self._move(piece_index, 1)
+                piece_index = pieces.find(1, piece_index + 1)
+
+    def peer_have(self, peer, piece_index):
+        """
+        Records a piece announced by a peer with a have message
+        :param peer:
+        :param piece_index:
+        :return: VOID
+        """
+        with self._lock:
+            pieces = self._peers.get(peer)
+            if pieces is None:
+                pieces = self._peers[peer] = self._empty()
+            if not pieces[piece_index]:
+                pieces[piece_index] = True
+                self._move(piece_index, 1)
+
+    def peer_disconnected(self, peer):
+        """
+        Removes the pieces of a peer from the availability counts
+        :param peer:
+        :return: VOID
+        """
+        with self._lock:
+            self._remove_peer(peer)
+
+    def _remove_peer(self, peer):
+        pieces = self._peers.pop(peer, None)
+        if pieces is not None:
+            piece_index = pieces.find(1)
+            while piece_index != -1:
+                self._move(piece_index, -1)
+                piece_index = pieces.find(1, piece_index + 1)
+
+    def peer_pieces(self, peer):
+        """
+        :param peer:
+        :return: bitarray of the pieces the peer has, or None if the peer is unknown
+        """
+        return self._peers.get(peer)
+
+    def availability(self, piece_index):
+        """
+        :param piece_index:
+        :return: the number of connected peers that have this piece
+        """
+        return self._availability[piece_index]
+
+    def pick(self, peer, have, exclude=None):
+        """
+        Picks the next piece to download from a peer
+        :param peer: the peer to download from
+        :param have: bitarray of the pieces we already have (i.e message.get_bitfield())
+        :param exclude: optional bitarray of pieces that must not be picked (i.e pieces being downloaded)
+        :return: the piece index, or -1 if the peer has no piece we need
+        """
+        with self._lock:
+            pieces = self._peers.get(peer)
+            if pieces is None:
+                return -1
+            candidates = pieces & ~have
+            if exclude is not None:
+                candidates &= ~exclude
+            if self.mode == self.SEQUENTIAL:
+                return candidates.find(1)
+            for count in range(1, len(self._by_availability)):
+                rarest = candidates & self._by_availability[count]
+                num_rarest = rarest.count()
+                if num_rarest:
+                    # random tie-break among the rarest pieces
+                    return count_n(rarest, random.randrange(num_rarest) + 1) - 1
+            return -1
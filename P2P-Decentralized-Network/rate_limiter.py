@@ -0,0 +1,219 @@
+import asyncio
+import threading
+import time
+
+from config import Config
+
+
+class TokenBucket:
+    """
+    Token bucket: tokens (bytes) are added at 'rate' bytes per second, up to 'burst' bytes.
+    Sending or receiving n bytes takes n tokens. When there are not enough tokens, the bucket goes into
+    debt and the caller waits until the debt is paid, so the average rate never exceeds the rate.
+    USAGE: bucket = TokenBucket(16 * 1024)
+           time.sleep(bucket.reserve(len(data)))
+    """
+    BURST_SECONDS = 1.0  # default burst, in seconds of rate
+
+    def __init__(self, rate, burst=None):
+        """
+        Class constructor
+        :param rate: bytes per second. 0 for unlimited
+        :param burst: max tokens saved while idle. By default, BURST_SECONDS of rate
+        """
+        self._lock = threading.Lock()
+        self._tokens = 0
+        self.set_rate(rate, burst)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def set_rate(self, rate, burst=None):
+        """
+        Changes the rate at runtime
+        :param rate: bytes per second. 0 for unlimited
+        :param burst: see constructor
+        :return: VOID
+        """
+        with self._lock:
+            self.rate = max(0, rate)
+            self.burst = burst if burst is not None else self.rate * self.BURST_SECONDS
+            self._tokens = min(self._tokens, self.burst)
+
+    def reserve(self, num_bytes):
+        """
+        Takes the tokens for num_bytes
+        :param num_bytes:
+        :return: the seconds to wait before the bytes are sent or received (0 if they can go now)
+        """
+        with self._lock:
+            if not self.rate:
+                return 0
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= num_bytes
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class RateLimiter:
+    """
+    Limits the upload (or download) rate of a peer with a global token bucket, plus a token bucket per
+    connection. The rate of the global bucket is shared fairly among the active connections, the ones that
+    transferred data in the last ACTIVE_WINDOW seconds: each connection bucket gets an equal share of the
+    global rate (capped by the per-connection rate), so a single fast connection cannot take the whole
+    bandwidth, and idle connections do not keep a share they do not use. The shares are computed again
+    when a connection becomes active, and at most every ACTIVE_WINDOW seconds otherwise.
+    Rates can be changed at runtime with set_rate() and set_connection_rate().
+    USAGE: limiter = RateLimiter.from_config("max-upload-rate")
+           connection = limiter.connection()
+           connection.throttle(len(data))  # sleeps if needed, then send the data
+           await connection.throttle_async(len(data))  # asyncio version
+           connection.close()
+    """
+
+    ACTIVE_WINDOW = 1.0  # seconds
+
+    def __init__(self, rate=0, connection_rate=0):
+        """
+        Class constructor
+        :param rate: global rate in bytes per second. 0 for unlimited
+        :param connection_rate: max rate of each connection in bytes per second. 0 for unlimited
+        """
+        self.global_bucket = TokenBucket(rate)
+        self.connection_rate = connection_rate
+        self._connections = []
+        self._shared_at = 0  # time.monotonic() of the last _share()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, key):
+        """
+        :param key: the rate key in the network section of conf.ini (i.e max-upload-rate), in KiB per second.
+                    The max rate of each connection is the key followed by -per-connection, 0 if not set
+        :return: a rate limiter with the rates configured
+        """
+        network = Config().snapshot().network
+        attribute = key.replace("-", "_")
+        rate = getattr(network, attribute)
+        connection_rate = getattr(network, attribute + "_per_connection", 0)
+        return cls(int(rate * 1024), int(connection_rate * 1024))
+
+    def connection(self):
+        """
+        :return: the ConnectionRateLimiter of a new connection
+        """
+        connection = ConnectionRateLimiter(self)
+        with self._lock:
+            self._connections.append(connection)
+            self._share()
+        return connection
+
+    def remove(self, connection):
+        with self._lock:
+            if connection in self._connections:
+                self._connections.remove(connection)
+                self._share()
+
+    def set_rate(self, rate):
+        """
+        Changes the global rate at runtime
+        :param rate: bytes per second. 0 for unlimited
+        :return: VOID
+        """
+        with self._lock:
+            self.global_bucket.set_rate(rate)
+            self._share()
+
+    def set_connection_rate(self, connection_rate):
+        """
+        Changes the max rate of each connection at runtime
+        :param connection_rate: bytes per second. 0 for unlimited
+        :return: VOID
+        """
+        with self._lock:
+            self.connection_rate = connection_rate
+            self._share()
+
+    def _share(self, now=None):
+        """
+        Sets the rate of each connection bucket to its fair share of the global rate: the global rate divided
+        by the number of active connections
+        """
+        now = time.monotonic() if now is None else now
+        self._shared_at = now
+        rate = self.global_bucket.rate
+        active = sum(1 for connection in self._connections if now - connection.last_active <= self.ACTIVE_WINDOW)
+        share = rate / max(1, active) if rate else 0
+        if self.connection_rate:
+            share = min(share, self.connection_rate) if share else self.connection_rate
+        for connection in self._connections:
+            connection.bucket.set_rate(share)
+
+    def throttle(self, num_bytes):
+        """
+        Blocks until num_bytes can be transferred within the global rate (i.e messages sent before the
+        connection has its own ConnectionRateLimiter)
+        :param num_bytes:
+        :return: VOID
+        """
+        delay = self.global_bucket.reserve(num_bytes)
+        if delay:
+            time.sleep(delay)
+
+    async def throttle_async(self, num_bytes):
+        """
+        Coroutine version of throttle()
+        :param num_bytes:
+        :return: VOID
+        """
+        delay = self.global_bucket.reserve(num_bytes)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def reserve(self, connection, num_bytes):
+        """
+        :param connection: the ConnectionRateLimiter transferring the bytes
+        :param num_bytes:
+        :return: the seconds to wait so both the global rate and the connection rate are respected
+        """
+        now = time.monotonic()
+        with self._lock:
+            idle = now - connection.last_active > self.ACTIVE_WINDOW
+            connection.last_active = now
+            if idle or now - self._shared_at > self.ACTIVE_WINDOW:
+                self._share(now)
+        return max(self.global_bucket.reserve(num_bytes), connection.bucket.reserve(num_bytes))
+
+
+class ConnectionRateLimiter:
+    """
+    Rate limit of a single connection. See RateLimiter
+    """
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.bucket = TokenBucket(0)
+        self.last_active = float("-inf")  # time.monotonic() of the last transfer
+
+    def throttle(self, num_bytes):
+        """
+        Blocks until num_bytes can be transferred
+        :param num_bytes:
+        :return: VOID
+        """
+        delay = self.limiter.reserve(self, num_bytes)
+        if delay:
+            time.sleep(delay)
+
+    async def throttle_async(self, num_bytes):
+        """
+        Coroutine version of throttle()
+        :param num_bytes:
+        :return: VOID
+        """
+        delay = self.limiter.reserve(self, num_bytes)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def close(self):
+        self.limiter.remove(self)
@@ -0,0 +1,240 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Node:
+    """A node of the DHT: its 160-bit id and the address of its DHT socket"""
+    __slots__ = ("id", "ip", "port", "last_seen", "failures")
+
+    def __init__(self, node_id, ip, port):
+        self.id = node_id  # raw 20 bytes
+        self.ip = ip
+        self.port = port
+        self.last_seen = time.monotonic()
+        self.failures = 0
+
+    def __repr__(self):
+        return "Node(%s, %s/%d)" % (self.id.hex(), self.ip, self.port)
+
+
+def distance(id_a, id_b):
+    """
+    :return: the XOR distance between two node ids (or a node id and an info hash), as an integer
+    """
+    return int.from_bytes(id_a, "big") ^ int.from_bytes(id_b, "big")
+
+
+class RoutingTable:
+    """
+    Kademlia routing table of a DHT node
+    The nodes are kept in ID_BITS k-buckets: bucket i holds the nodes at an XOR distance in [2^i, 2^(i+1))
+    from this node, so the table knows many nodes close to this node and a few far away, and each hop of a
+    lookup halves the distance to the target. Each bucket keeps at most K nodes, least recently seen first.
+    When a bucket is full, a new node replaces a node that failed or was not seen for STALE_TIME seconds.
+    Otherwise, the new node waits in the replacement cache of the bucket until a node is removed.
+    USAGE: table = RoutingTable(node_id)
+           table.add(node_id, ip, port)  # on every response (or query) received from a node
+           table.failed(node_id)  # on every query that timed out
+           nodes = table.closest(target)  # the K nodes closest to the target
+    """
+    ID_BITS = 160
+    K = 8
+    STALE_TIME = 15 * 60  # seconds
+    MAX_FAILURES = 2  # queries timed out in a row before a node is removed
+
+    def __init__(self, node_id, k=K):
+        """
+        Class constructor
+        :param node_id: the id of this node (raw 20 bytes)
+        :param k: max nodes per bucket
+        """
+        self.node_id = node_id
+        self.k = k
+        self._buckets = [OrderedDict() for _ in range(self.ID_BITS)]  # node id -> Node, least recent first
+        self._replacements = [OrderedDict() for _ in range(self.ID_BITS)]
+        self._lock = threading.Lock()
+
+    def bucket_index(self, node_id):
+        """
+        :return: the index of the bucket of a node id, -1 for the id of this node
+        """
+        return distance(self.node_id, node_id).bit_length() - 1
+
+    def add(self, node_id, ip, port):
+        """
+        Adds a node that answered (or sent a query), or marks it as seen if it is already in the table
+        :param node_id: raw 20 bytes
+        :param ip:
+        :param port:
+        :return: True if the node is in the table. False if the bucket is full (the node is kept as a
+                 replacement) or the node id is invalid
+        """
+        index = self.bucket_index(node_id)
+        if index < 0 or len(node_id) * 8 != self.ID_BITS:
+            return False
+        with self._lock:
+            bucket = self._buckets[index]
+            node = bucket.get(node_id)
+            if node is not None:
+                node.ip, node.port = ip, port
+                node.last_seen = time.monotonic()
+                node.failures = 0
+                bucket.move_to_end(node_id)
+                return True
+            if len(bucket) >= self.k:
+                oldest = next(iter(bucket.values()))
+                if not oldest.failures and time.monotonic() - oldest.last_seen < self.STALE_TIME:
+                    replacements = self._replacements[index]
+                    replacements[node_id] = Node(node_id, ip, port)
+                    replacements.move_to_end(node_id)
+                    if len(replacements) > self.k:
+                        replacements.popitem(last=False)
+                    return False
+                del bucket[oldest.id]
+            bucket[node_id] = Node(node_id, ip, port)
+            return True
+
+    def failed(self, node_id):
+        """
+        Records a query to a node that timed out. The node is removed after MAX_FAILURES in a row
+        :param node_id:
+        :return: VOID
+        """
+        index = self.bucket_index(node_id)
+        with self._lock:
+            node = self._buckets[index].get(node_id) if index >= 0 else None
+            if node is None:
+                return
+            node.failures += 1
+            if node.failures >= self.MAX_FAILURES:
+                self._remove(index, node_id)
+
+    def remove(self, node_id):
+        """
+        Removes a node, and replaces it with the most recent node of the replacement cache
+        :param node_id:
+        :return: VOID
+        """
+        index = self.bucket_index(node_id)
+        if index >= 0:
+            with self._lock:
+                self._remove(index, node_id)
+
+    def _remove(self, index, node_id):
+        if self._buckets[index].pop(node_id, None) is not None and self._replacements[index]:
+            _, node = self._replacements[index].popitem()
+            self._buckets[index][node.id] = node
+
+    def get(self, node_id):
+        index = self.bucket_index(node_id)
+        with self._lock:
+            return self._buckets[index].get(node_id) if index >= 0 else None
+
+    def closest(self, target, count=None):
+        """
+        :param target: a node id or an info hash
+        :param count: max nodes returned. By default, K
+        :return: list of the nodes closest to the target, closest first
+        """
+        with self._lock:
+            nodes = [node for bucket in self._buckets for node in bucket.values()]
+        return heapq.nsmallest(count or self.k, nodes, key=lambda node: distance(node.id, target))
+
+    def nodes(self):
+        """
+        :return: list of all the nodes of the table
+        """
+        with self._lock:
+            return [node for bucket in self._buckets for node in bucket.values()]
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(bucket) for bucket in self._buckets)
+
+
+class NodeLookup:
+    """
+    Kademlia iterative lookup of the nodes closest to a target (find_node), or of the peers of an info
+    hash (get_peers). The ALPHA closest nodes known are queried in parallel. Each response brings nodes
+    closer to the target, which are queried as soon as a query finishes, so there are always ALPHA queries
+    in flight. The lookup ends when the K closest nodes found have all answered (or failed), which takes
+    O(log n) hops in a network of n nodes.
+    USAGE: lookup = NodeLookup(routing_table.closest(target), target, query)
+           # query(node) -> (list of (node id, ip, port), list of peers) or None if the node did not answer
+           nodes, peers = lookup.run()
+    """
+    ALPHA = 3
+
+    def __init__(self, nodes, target, query, k=RoutingTable.K, alpha=ALPHA):
+        """
+        Class constructor
+        :param nodes: the nodes the lookup starts from (i.e the closest nodes of the routing table)
+        :param target: the node id or info hash looked up
+        :param query: callable sending the query to a node, see USAGE
+        :param k: number of closest nodes to find
+        :param alpha: number of queries in flight
+        """
+        self.target = target
+        self.query = query
+        self.k = k
+        self.alpha = alpha
+        self._candidates = {node.id: node for node in nodes}  # node id -> Node, known not queried yet
+        self._queried = set()
+        self._responded = {}  # node id -> Node
+        self.peers = []
+
+    def _closest_candidate(self):
+        """
+        :return: the closest node not queried yet, or None if the K closest nodes responded already
+        """
+        if not self._candidates:
+            return None
+        node = min(self._candidates.values(), key=lambda node: distance(node.id, self.target))
+        if len(self._responded) >= self.k:
+            furthest = max(distance(node_id, self.target) for node_id in
+                           heapq.nsmallest(self.k, self._responded, key=lambda node_id: distance(node_id, self.target)))
+            if distance(node.id, self.target) >= furthest:
+                return None
+        del self._candidates[node.id]
+        self._queried.add(node.id)
+        return node
+
+    def run(self):
+        """
+        Runs the lookup until it converges
+        :return: the K closest nodes that responded (closest first), and the peers found (get_peers)
+        """
+        with ThreadPoolExecutor(max_workers=self.alpha) as executor:
+            in_flight = {}
+            while True:
+                while len(in_flight) < self.alpha:
+                    node = self._closest_candidate()
+                    if node is None:
+                        break
+                    in_flight[executor.submit(self.query, node)] = node
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._response(in_flight.pop(future), future)
+        nodes = sorted(self._responded.values(), key=lambda node: distance(node.id, self.target))
+        return nodes[:self.k], self.peers
+
+    def _response(self, node, future):
+        try:
+            result = future.result()
+        except Exception:
+            result = None
+        if result is None:
+            return
+        nodes, peers = result
+        self._responded[node.id] = node
+        for peer in peers:
+            if peer not in self.peers:
+                self.peers.append(peer)
+        for node_id, ip, port in nodes:
+            if node_id not in self._queried and node_id not in self._candidates:
+                self._candidates[node_id] = Node(node_id, ip, port)
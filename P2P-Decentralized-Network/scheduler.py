@@ -0,0 +1,279 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from end_game import EndGame
+from piece_picker import PiecePicker
+
+
+class DownloadScheduler:
+    """
+    Download scheduler of a torrent, shared by the downloaders of all the connections
+    The scheduler decides which block each connection requests, so the blocks of the file are spread
+    over all the peers and the download rate grows with the number of peers:
+        * pieces are picked by the piece picker (rarest first) among the pieces the peer has
+        * each connection keeps downloading the same piece while it has blocks that are not in flight,
+          and other connections may help with the remaining blocks of that piece
+        * outside end-game, a block is never requested from two peers at the same time
+        * the blocks in flight on a connection that is choked or closed are assigned to other connections:
+          the connections with requests in flight take them with their next requests, and the idle
+          connections are woken up from the requester thread, never from the thread that released them
+        * completed pieces are validated and written by FileManager.flush_piece, then made available to the
+          uploaders, recorded in the fast-resume file and announced with a have message on every connection
+    USAGE: scheduler = DownloadScheduler(torrent, message, file_manager, piece_picker, fast_resume)
+           scheduler.server = server  # optional, its uploaders are sent the have messages too
+           scheduler.register(downloader)
+           block = scheduler.next_block(downloader)  # (piece index, block index) or None
+           scheduler.block_received(downloader, piece_index, begin, block)
+           scheduler.unregister(downloader)
+    """
+    ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in scheduler.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
+
+    def __init__(self, torrent, message, file_manager, piece_picker=None, fast_resume=None):
+        """
+        Class constructor
+        :param torrent:
+        :param message: the message object of the peer, with the bitfield initialized
+        :param file_manager: the file manager the blocks and pieces are written with
+        :param piece_picker: the piece picker. By default, a rarest-first piece picker
+        :param fast_resume: optional FastResume recording the pieces written
+        """
+        self.torrent = torrent
+        self.message = message
+        self.file_manager = file_manager
+        self.piece_picker = piece_picker or PiecePicker(message.num_pieces)
+        self.fast_resume = fast_resume
+        self.end_game = EndGame(message)
+        self.block_size = torrent.block_size()
+        self._downloaders = []
+        self._pieces = {}  # downloader -> piece index being downloaded from its peer
+        self._lock = threading.Lock()
+        self.pieces_completed = 0
+        self.pieces_failed = 0
+        self._downloaded_closed = 0  # bytes downloaded on the connections already closed
+        self.server = None  # optional Server, its uploaders are sent the have messages too
+        # have messages are sent from this thread, so the disk writer thread never waits for the network
+        self._announcer = ThreadPoolExecutor(max_workers=1)
+        # idle connections request the blocks released from this thread (see _reassign())
+        self._requester = ThreadPoolExecutor(max_workers=1)
+
+    def register(self, downloader):
+        """
+        Adds the downloader of a new connection
+        :param downloader:
+        :return: VOID
+        """
+        with self._lock:
+            self._downloaders.append(downloader)
+
+    def unregister(self, downloader):
+        """
+        Removes the downloader of a closed connection. Its requests are assigned to other connections
+        :param downloader:
+        :return: VOID
+        """
+        with self._lock:
+            if downloader in self._downloaders:
+                self._downloaders.remove(downloader)
+                self._downloaded_closed += downloader.downloaded
+            self._pieces.pop(downloader, None)
+        self.piece_picker.peer_disconnected(downloader)
+        with downloader.requests_lock:
+            blocks = list(downloader.requests)
+        self.release(downloader, blocks)
+
+    def release(self, downloader, blocks):
+        """
+        Makes blocks requested on a connection that will not answer them (choked or closed) available
+        again, and lets the other connections request them right away
+        :param downloader:
+        :param blocks: list of (piece index, block index)
+        :return: VOID
+        """
+        for piece_index, block_index in blocks:
+            self.end_game.remove_request(downloader, piece_index, block_index)
+        if blocks:
+            self._reassign(downloader)
+
+    def _reassign(self, downloader):
+        """
+        Lets the other connections request the blocks released. A connection with requests in flight
+        requests them when its next block is received, from its own thread. Idle connections are not
+        receiving anything, so they request them from the requester thread.
+        :param downloader: the connection that released the blocks, or None
+        :return: VOID
+        """
+        with self._lock:
+            idle = [other for other in self._downloaders
+                    if other is not downloader and not other.choked and not other.requests]
+        if idle:
+            self._requester.submit(self._request_blocks, idle)
+
+    def _request_blocks(self, downloaders):
+        for downloader in downloaders:
+            try:
+                downloader.request_blocks()
+            except OSError as ex:
+                print(self.ERROR_TEMPLATE.format(
+                    "_request_blocks()", type(ex).__name__, ex.args))
+
+    def peer_bitfield(self, downloader, bitfield):
+        self.piece_picker.peer_bitfield(downloader, bitfield)
+
+    def peer_have(self, downloader, piece_index):
+        self.piece_picker.peer_have(downloader, piece_index)
+
+    def next_block(self, downloader):
+        """
+        Assigns the next block to request on a connection, and records it as in flight. Called from the
+        thread of the connection and from the requester thread
+        :param downloader:
+        :return: (piece index, block index), or None if the peer has no block to request
+        """
+        with self._lock:
+            piece_index = self._pieces.get(downloader, -1)
+            block_index = self.end_game.assign_block(downloader, piece_index) if piece_index != -1 else -1
+            if block_index == -1:
+                piece_index = self.piece_picker.pick(
+                    downloader, self.message.get_bitfield(), self.end_game.fully_requested())
+                self._pieces[downloader] = piece_index
+                if piece_index != -1:
+                    block_index = self.end_game.assign_block(downloader, piece_index)
+            if block_index != -1:
+                return piece_index, block_index
+            if self.end_game.enter():
+                return self.end_game.assign_duplicate(downloader, self.piece_picker.peer_pieces(downloader))
+            return None
+
+    def block_length(self, piece_index, block_index):
+        """
+        :return: the length of a block. The last block of the file may be shorter than the block size
+        """
+        begin = block_index * self.block_size
+        return min(self.block_size, self.file_manager.piece_length(piece_index) - begin)
+
+    def block_received(self, downloader, piece_index, begin, block):
+        """
+        Stores a block received. Once all the blocks of its piece are received, the piece is validated and
+        written to the file. In end-game, a cancel is sent to the other peers the block was requested from.
+        :param downloader: the downloader that received the block
+        :param piece_index:
+        :param begin: the offset of the block in the piece
+        :param block: the block data
+        :return: VOID
+        """
+        block_index = begin // self.block_size
+        if self.message.is_block_missing(piece_index, block_index):
+            # stored before it is set to completed, so the piece never completes without it
+            self.file_manager.flush_block(piece_index, block_index, block)
+        _, piece_completed, cancels = self.end_game.block_received(
+            downloader, piece_index, block_index, len(block))
+        for other in cancels:
+            try:
+                other.cancel(piece_index, begin, len(block))
+            except OSError as ex:
+                print(self.ERROR_TEMPLATE.format(
+                    "block_received()", type(ex).__name__, ex.args))
+        if piece_completed:
+            self._complete_piece(piece_index)
+
+    def _complete_piece(self, piece_index):
+        piece = self.file_manager.extract_piece(piece_index)
+        if self.flush_piece(piece_index, piece):
+            with self._lock:
+                self.pieces_completed += 1
+        else:
+            self._piece_failed(piece_index)
+
+    def _piece_failed(self, piece_index):
+        """
+        Sets a piece that failed the hash validation (or could not be written) to missing, so it is
+        downloaded again
+        """
+        with self._lock:
+            self.pieces_failed += 1
+        self.file_manager.block_store().discard_piece(piece_index)
+        self.end_game.piece_failed(piece_index)
+
+    def _write_failed(self, piece_index, ex):
+        """
+        Called from the disk writer thread when a completed piece could not be written. The piece is
+        downloaded again. The disk writer thread does not send the requests (see _reassign())
+        """
+        print(self.ERROR_TEMPLATE.format(
+            "_write_failed()", type(ex).__name__, ex.args))
+        with self._lock:
+            self.pieces_completed -= 1
+        self._piece_failed(piece_index)
+        self._reassign(None)
+
+    def flush_piece(self, piece_index, piece):
+        """
+        Validates and writes a completed piece. Once it is on disk, it is available to the uploaders and it is
+        recorded in the fast-resume file. If it cannot be written, it is set to missing again
+        :param piece_index:
+        :param piece: the piece (bytes)
+        :return: True if the piece was valid. Otherwise, returns False
+        """
+        def callback():
+            self.message.set_piece_available(piece_index)
+            if self.fast_resume:
+                self.fast_resume.piece_completed(piece_index)
+            self._announcer.submit(self.broadcast_have, piece_index)
+        return self.file_manager.flush_piece(piece_index, piece, callback,
+                                             lambda ex: self._write_failed(piece_index, ex))
+
+    def broadcast_have(self, piece_index):
+        """
+        Announces an available piece on every open connection: to the uploaders of the connections of this
+        peer (clients), and to the downloaders connected to the server (uploaders), so the remote peers
+        count it in their piece availability
+        :param piece_index:
+        :return: VOID
+        """
+        have = dict(self.message.have, piece_index=piece_index)
+        with self._lock:
+            connections = list(self._downloaders)
+        if self.server is not None:
+            connections += list(self.server.clienthandlers.values())
+        for connection in connections:
+            try:
+                connection.send_have(have)
+            except OSError as ex:
+                print(self.ERROR_TEMPLATE.format(
+                    "broadcast_have()", type(ex).__name__, ex.args))
+
+    def downloaded_by_peer(self):
+        """
+        :return: dict peer id -> bytes downloaded from that peer on all its connections (see Choker)
+        """
+        with self._lock:
+            downloaders = list(self._downloaders)
+        downloaded = {}
+        for downloader in downloaders:
+            downloaded[downloader.uploader_id] = downloaded.get(downloader.uploader_id, 0) + downloader.downloaded
+        return downloaded
+
+    def downloaded(self):
+        """
+        :return: bytes downloaded since this peer started, on all the connections, including the closed ones
+        """
+        with self._lock:
+            return self._downloaded_closed + sum(downloader.downloaded for downloader in self._downloaders)
+
+    def completed(self):
+        """
+        :return: True if all the pieces are downloaded
+        """
+        return self.message.num_completed_pieces() == self.message.num_pieces
+
+    def stats(self):
+        """
+        :return: dict with the download counters of the torrent and of each connection
+        """
+        with self._lock:
+            downloaders = list(self._downloaders)
+        return {'pieces-completed': self.pieces_completed, 'pieces-failed': self.pieces_failed,
+                'progress': self.message.progress(), 'end-game': self.end_game.stats(),
+                'connections': [{'downloaded': downloader.downloaded, 'rate': downloader.rate,
+                                 'queue-depth': downloader.queue_depth, 'in-flight': len(downloader.requests)}
+                                for downloader in downloaders]}
@@ -1,9 +1,13 @@
 import socket
-import pickle
 import threading
 
 from torrent import Torrent
 from uploader import Uploader
+from message import Message, MessageDecoder
+from piece_cache import PieceCache
+from rate_limiter import RateLimiter
+from choker import Choker
+from config import Config
 from custom_exception import ProtocolException
 
 
@@ -15,25 +19,52 @@ class Server(object):
     server must not be stopped when a exception occurs. A proper message needs to be show in the
     server console.
     """
+    ENGINE = "threaded"  # one thread per accepted connection. See also AsyncServer
     MAX_NUM_CONN = 10  # keeps 10 clients in queue
     TORRENT_PATH = 'age.torrent'
     ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in server.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
 
-    def __init__(self,  peer_id, torrent, message, server_ip_address="127.0.0.1", server_port=4999):
+    def __init__(self,  peer_id, torrent, message, server_ip_address="127.0.0.1", server_port=4999,
+                 upload_limiter=None, download_limiter=None):
         """
         Class constructor
         :param server_ip_address: by default localhost. Note that '0.0.0.0' takes LAN ip address.
         :param server_port: by default 12000
+        :param upload_limiter: RateLimiter shared by all the uploads. By default, max-upload-rate in conf.ini
+        :param download_limiter: RateLimiter shared by all the downloads. By default, max-download-rate in conf.ini
         """
         self.server_ip_address = server_ip_address
         self.server_port = server_port
         self.serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.clienthandlers = {}  # a list of uploaders
         self.threadStarted = {}  # DEBUGGING ONLY. keeping track of thread started
+        self.decoders = {}  # clientsocket -> MessageDecoder used until the uploader takes over
         self.lock = threading.Lock()
         self.peer_id = peer_id
         self.torrent = torrent
         self.message = message
+        # hot pieces are served from memory to all the uploaders of this server
+        cache_size = Config().snapshot().cache.piece_cache_size
+        self.piece_cache = PieceCache(cache_size) if cache_size > 0 else None
+        self.upload_limiter = upload_limiter or RateLimiter.from_config("max-upload-rate")
+        self.download_limiter = download_limiter or RateLimiter.from_config("max-download-rate")
+        # chokes and unchokes the uploaders (tit-for-tat)
+        self.choker = Choker(self)
+        self.pex = None  # optional PeerExchange, the uploaders are added to it
+        self.listen_ports = {}  # peer id -> listen port sent in the handshake, until its uploader is created
+        # connections accepted beyond max_connections are choked and closed. See AsyncServer
+        self.max_connections = self.MAX_NUM_CONN
+        self.backlog = self.MAX_NUM_CONN
+        self.uploaded = 0  # bytes uploaded by all the uploaders, including the closed ones (see add_uploaded)
+
+    def add_uploaded(self, num_bytes):
+        """
+        Counts bytes uploaded by an uploader. Called by the uploaders, from their own threads
+        :param num_bytes:
+        :return: VOID
+        """
+        with self.lock:
+            self.uploaded += num_bytes
 
     def _bind(self):
         """
@@ -50,7 +81,7 @@ class Server(object):
         """
         try:
             self._bind()
-            self.serversocket.listen(self.MAX_NUM_CONN)
+            self.serversocket.listen(self.backlog)
             with self.lock:
                 print('Server listening at ',
                       self.server_ip_address, '/', self.server_port)
@@ -96,13 +127,16 @@ class Server(object):
     def client_handler_thread(self, clientsocket, addr):
         """
         Sends the client id assigned to this clientsocket and
-        Creates a new ClientHandler object
+        Creates a new ClientHandler object that serves the downloader until it disconnects
         See also ClientHandler Class
         :param clientsocket:
         :param address:
         :return: a client handler object.
         """
-        peer_id = self.set_client_info(clientsocket)
+        try:
+            peer_id = self.set_client_info(clientsocket)
+        finally:
+            decoder = self.decoders.pop(clientsocket, None)
         if peer_id == -1:
             with self.lock:
                 print(self.ERROR_TEMPLATE.format(
@@ -111,85 +145,118 @@ class Server(object):
             return
 
         client_handler = Uploader(
-            peer_id, self, clientsocket, addr, self.torrent)
+            peer_id, self, clientsocket, addr, self.torrent, decoder=decoder)
+        self.clienthandlers[addr] = client_handler
+        try:
+            self.choker.connected(client_handler)
+            if self.pex:
+                self.pex.connected(client_handler, client_handler.listen_address())
+            client_handler.run()
+        finally:
+            if self.pex:
+                self.pex.disconnected(client_handler)
+            self.clienthandlers.pop(addr, None)
+            clientsocket.close()
         return client_handler
 
     def set_client_info(self, clientsocket):
         """
         Communicate with downloader to determine whether connection is neccessary
         :param clientsocket:
-        :return:
+        :return: the peer id of the downloader, or -1 if the connection is not needed
         """
         print('server connection established')
         handshake = self._receive(clientsocket)
-        # {'info_hash', 'peer_id','pstr', 'pstrlen'}
-        #print(handshake)
-        info_hash = handshake['info_hash']
-        peer_id = handshake['peer_id']
+        response, peer_id = self._handshake_response(handshake)
+        self._send(clientsocket, response)
         # info hash is different
-        if not self.torrent.validate_hash_info(info_hash):
-            self._send(clientsocket, {'headers': [
+        if peer_id == -1:
+            self._receive(clientsocket)
+            raise Exception('Received different info_hash')
+        interested = self._receive(clientsocket)
+        response, peer_id = self._interested_response(interested, peer_id)
+        if response:
+            self._send(clientsocket, response)
+        # message invalid
+        if peer_id is None:
+            self._receive(clientsocket)
+            self._invalid_interested(interested)
+        return peer_id
+
+    def _handshake_response(self, handshake):
+        """
+        Validates the handshake sent by the downloader
+        :param handshake: {'info_hash', 'peer_id','pstr', 'pstrlen'}
+        :return: the response to send, and the peer id of the downloader (-1 if the info hash is different)
+        """
+        if not self.torrent.validate_hash_info(handshake['info_hash']):
+            return {'headers': [
                 {
                     'type': 'print',
                     'body': {'message': 'Different info hash'}
                 },
                 {'type': 'close'}
-            ]})
-            self._receive(clientsocket)
-            raise Exception('Received different info_hash')
-        # info hash is valid
-        self._send(clientsocket, {'headers': [{'type': 'ignore'}]})
-        interested = self._receive(clientsocket)
-        #print(interested)
+            ]}, -1
+        # info hash is valid. The peer id lets the downloader match this connection with its own uploader
+        if handshake.get('listen_port'):
+            self.listen_ports[handshake['peer_id']] = handshake['listen_port']
+        return {'headers': [{'type': 'ignore'}], 'peer_id': self.peer_id}, handshake['peer_id']
+
+    def _interested_response(self, interested, peer_id):
+        """
+        Decides whether the downloader is unchoked
+        :param interested: the interested/not_interested message sent by the downloader
+        :param peer_id: the peer id of the downloader
+        :return: the response to send (None if there is nothing to send), and the peer id of the
+                 downloader (-1 if the connection is not needed, None if the message is invalid)
+        """
+        message_id = interested.get('id') if isinstance(interested, dict) else None
         # interested
-        if interested['id'] == 2:
+        if message_id == Message.INTERESTED:
             # too many parallel connection
-            if len(self.clienthandlers) >= self.MAX_NUM_CONN:
-                self._send(clientsocket, {'headers': [
+            if len(self.clienthandlers) >= self.max_connections:
+                return {'headers': [
                     {
                         'type': 'bittorrent',
                         'body': self.message.choke
                     },
                     {'type': 'close'}
-                ]})
-                return -1
-            else:
-                self._send(clientsocket, {'headers':[
-                    {
-                        'type': 'bittorrent',
-                        'body': self.message.unchoke
-                    }]})
-                print(self._receive(clientsocket))
-                return peer_id
+                ]}, -1
+            return {'headers': [
+                {
+                    'type': 'bittorrent',
+                    'body': self.message.unchoke
+                }]}, peer_id
         # not interested
-        elif interested['id'] == 3:
-            return -1
+        elif message_id == Message.NOT_INTERESTED:
+            return None, -1
         # message invalid
-        else:
-            self._send(clientsocket, {'headers': [
-                {
-                    'type': 'print',
-                    'body': {'message': 'Message invalid'}
-                },
-                {'type': 'close'}
-            ]})
-            self._receive(clientsocket)
-            with self.lock:
-                print(self.ERROR_TEMPLATE.format(
-                    "set_client_info()", "ProtocolException",
-                    "Expecting interested/not_insterested from downloader but received" + str(interested)))
-            raise ProtocolException(
-                'Protocol received from downloader is invalid')
+        return {'headers': [
+            {
+                'type': 'print',
+                'body': {'message': 'Message invalid'}
+            },
+            {'type': 'close'}
+        ]}, None
+
+    def _invalid_interested(self, interested):
+        with self.lock:
+            print(self.ERROR_TEMPLATE.format(
+                "set_client_info()", "ProtocolException",
+                "Expecting interested/not_insterested from downloader but received" + str(interested)))
+        raise ProtocolException(
+            'Protocol received from downloader is invalid')
 
     def _send(self, clientsocket, data):
         """
-        TODO: Serializes the data with pickle, and sends using the accepted client socket.
+        TODO: Encodes the data in its wire form, and sends using the accepted client socket.
         :param data:
         :return:
         """
         try:
-            serialized_data = pickle.dumps(data)
-            clientsocket.send(serialized_data)
+            data = Message.encode(data)
+            self.upload_limiter.throttle(len(data))
+            clientsocket.sendall(data)
         except socket.error as ex:
             with self.lock:
                 print(self.ERROR_TEMPLATE.format(
@@ -203,15 +270,14 @@ class Server(object):
 
     def _receive(self, clientsocket, MAX_BUFFER_SIZE=4096):
         """
-        TODO: Deserializes the data with pickle
+        TODO: Decodes the next message sent by this client socket
         :param clientsocket:
         :param MAX_BUFFER_SIZE:
-        :return: the deserialized data
+        :return: the decoded data
         """
         try:
-            # print('_receive: ' + str(pickle.loads(data)))
-            data = clientsocket.recv(MAX_BUFFER_SIZE)
-            return pickle.loads(data)
+            decoder = self.decoders.setdefault(clientsocket, MessageDecoder())
+            return decoder.receive(clientsocket, MAX_BUFFER_SIZE, self.download_limiter.throttle)
         except Exception as ex:
             with self.lock:
                 print(self.ERROR_TEMPLATE.format(
@@ -223,6 +289,7 @@ class Server(object):
         Run the server.
         :return: VOID
         """
+        self.choker.start()
         self._listen()
         self._accept_clients()
 
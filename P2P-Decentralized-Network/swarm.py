@@ -0,0 +1,184 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class SwarmPeer:
+    """A peer of a swarm, and the time it was last announced"""
+    __slots__ = ("peer_id", "ip", "port", "last_seen", "expires", "seeder")
+
+    def __init__(self, peer_id, ip, port, last_seen, expires, seeder=False):
+        self.peer_id = peer_id
+        self.ip = ip
+        self.port = port
+        self.last_seen = last_seen
+        self.expires = expires
+        self.seeder = seeder  # True if the peer has the whole file
+
+
+class SwarmRegistry:
+    """
+    Registry of the peers of each swarm (info hash), indexed by info hash and peer id
+    Each peer expires TTL seconds after it was last announced, so the peers that left without removing
+    themselves (i.e internet connection dropped) are forgotten. The expiry times are kept in a min-heap:
+    expire() pops only the peers that expired, in O(log n) each. Announcing a peer again pushes a new
+    expiry time, and the old one is skipped when it is popped.
+    The peers of a swarm are kept in a list (the position of each peer is indexed by its peer id, and
+    removals swap the last peer into the hole), so N random peers are sampled in O(N) whatever the size of
+    the swarm.
+    USAGE: swarms = SwarmRegistry()
+           swarms.add(info_hash, peer_id, ip, port)  # on every announce
+           peers = swarms.sample(info_hash, 50)  # list of SwarmPeer
+           swarms.remove_peer(peer_id)  # from every swarm
+    """
+    TTL = 30 * 60  # seconds
+
+    def __init__(self, ttl=TTL):
+        """
+        Class constructor
+        :param ttl: seconds a peer stays in its swarms after its last announce
+        """
+        self.ttl = ttl
+        self._swarms = {}  # info hash -> list of SwarmPeer
+        self._positions = {}  # info hash -> {peer id -> position in the list of the swarm}
+        self._info_hashes = {}  # peer id -> set of the info hashes of its swarms
+        self._seeders = {}  # info hash -> number of seeders in the swarm
+        self._expiries = []  # min-heap of (expiry time, sequence, info hash, peer id)
+        self._sequence = itertools.count()  # breaks ties, so info hashes and peer ids are never compared
+        self._lock = threading.Lock()
+
+    def add(self, info_hash, peer_id, ip, port, now=None, seeder=False):
+        """
+        Adds a peer to a swarm, or refreshes its address and expiry time if it is already there
+        :param info_hash:
+        :param peer_id:
+        :param ip:
+        :param port:
+        :param now: time.monotonic() of the announce. By default, now
+        :param seeder: True if the peer has the whole file (see counts())
+        :return: VOID
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            swarm = self._swarms.setdefault(info_hash, [])
+            positions = self._positions.setdefault(info_hash, {})
+            position = positions.get(peer_id)
+            if position is None:
+                positions[peer_id] = len(swarm)
+                swarm.append(SwarmPeer(peer_id, ip, port, now, now + self.ttl, seeder))
+                self._info_hashes.setdefault(peer_id, set()).add(info_hash)
+                self._seeders[info_hash] = self._seeders.get(info_hash, 0) + seeder
+            else:
+                peer = swarm[position]
+                self._seeders[info_hash] += seeder - peer.seeder
+                peer.ip, peer.port, peer.last_seen, peer.expires = ip, port, now, now + self.ttl
+                peer.seeder = seeder
+            heapq.heappush(self._expiries, (now + self.ttl, next(self._sequence), info_hash, peer_id))
+
+    def remove(self, info_hash, peer_id):
+        """
+        Removes a peer from a swarm
+        :param info_hash:
+        :param peer_id:
+        :return: True if the peer was in the swarm
+        """
+        with self._lock:
+            return self._remove(info_hash, peer_id)
+
+    def remove_peer(self, peer_id):
+        """
+        Removes a peer from all its swarms
+        :param peer_id:
+        :return: the number of swarms the peer was removed from
+        """
+        with self._lock:
+            info_hashes = list(self._info_hashes.get(peer_id, ()))
+            for info_hash in info_hashes:
+                self._remove(info_hash, peer_id)
+            return len(info_hashes)
+
+    def _remove(self, info_hash, peer_id):
+        positions = self._positions.get(info_hash)
+        if positions is None or peer_id not in positions:
+            return False
+        swarm = self._swarms[info_hash]
+        position = positions.pop(peer_id)
+        self._seeders[info_hash] -= swarm[position].seeder
+        last = swarm.pop()
+        if position < len(swarm):
+            swarm[position] = last
+            positions[last.peer_id] = position
+        if not swarm:
+            del self._swarms[info_hash]
+            del self._positions[info_hash]
+            del self._seeders[info_hash]
+        info_hashes = self._info_hashes[peer_id]
+        info_hashes.discard(info_hash)
+        if not info_hashes:
+            del self._info_hashes[peer_id]
+        return True
+
+    def expire(self, now=None):
+        """
+        Removes the peers that were not announced for TTL seconds
+        :param now: see add()
+        :return: the number of peers removed
+        """
+        with self._lock:
+            return self._expire(time.monotonic() if now is None else now)
+
+    def _expire(self, now):
+        expired = 0
+        while self._expiries and self._expiries[0][0] <= now:
+            expires, _, info_hash, peer_id = heapq.heappop(self._expiries)
+            position = self._positions.get(info_hash, {}).get(peer_id)
+            # the peer was announced again (a later expiry is in the heap) or removed already
+            if position is not None and self._swarms[info_hash][position].expires == expires:
+                self._remove(info_hash, peer_id)
+                expired += 1
+        return expired
+
+    def sample(self, info_hash, count, now=None):
+        """
+        :param info_hash:
+        :param count: max number of peers
+        :param now: see add()
+        :return: list of up to count random peers (SwarmPeer) of the swarm
+        """
+        with self._lock:
+            self._expire(time.monotonic() if now is None else now)
+            swarm = self._swarms.get(info_hash, [])
+            return random.sample(swarm, min(count, len(swarm)))
+
+    def get(self, info_hash, peer_id):
+        """
+        :return: the SwarmPeer of a peer in a swarm, or None
+        """
+        with self._lock:
+            position = self._positions.get(info_hash, {}).get(peer_id)
+            return self._swarms[info_hash][position] if position is not None else None
+
+    def counts(self, info_hash, now=None):
+        """
+        :param info_hash:
+        :param now: see add()
+        :return: the number of seeders and the number of leechers of a swarm
+        """
+        with self._lock:
+            self._expire(time.monotonic() if now is None else now)
+            seeders = self._seeders.get(info_hash, 0)
+            return seeders, len(self._swarms.get(info_hash, [])) - seeders
+
+    def size(self, info_hash):
+        """
+        :return: the number of peers in a swarm (peers expired but not popped yet included)
+        """
+        with self._lock:
+            return len(self._swarms.get(info_hash, []))
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(swarm) for swarm in self._swarms.values())
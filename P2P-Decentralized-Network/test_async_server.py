@@ -0,0 +1,90 @@
+import asyncio
+import uuid
+
+from async_server import AsyncServer
+from message import Message, MessageDecoder
+from rate_limiter import RateLimiter
+from torrent import Torrent
+
+
+def make_server():
+    torrent = Torrent('age.torrent')
+    message = Message(uuid.uuid4(), torrent.create_info_hash())
+    message.init_bitfield(torrent.num_pieces())
+    return AsyncServer(uuid.uuid4(), torrent, message, upload_limiter=RateLimiter(0),
+                       download_limiter=RateLimiter(0))
+
+
+async def handshake(server, info_hash):
+    """
+    Connects to the server and sends a handshake
+    :return: the listening server, reader, writer, decoder, and the handshake response
+    """
+    listener = await asyncio.start_server(server._client_handler, '127.0.0.1', 0)
+    port = listener.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(Message.encode(Message(uuid.uuid4(), info_hash).handshake))
+    decoder = MessageDecoder()
+    response = await asyncio.wait_for(decoder.receive_async(reader), 5)
+    return listener, reader, writer, decoder, response
+
+
+async def wait_closed(listener, writer):
+    writer.close()
+    listener.close()
+    await listener.wait_closed()
+
+
+def test_connection_served():
+    server = make_server()
+
+    async def run():
+        listener, reader, writer, decoder, response = await handshake(server, server.torrent.create_info_hash())
+        assert response['peer_id'] == server.peer_id
+        writer.write(Message.encode(server.message.interested))
+        unchoke = await asyncio.wait_for(decoder.receive_async(reader), 5)
+        assert unchoke['headers'][0]['body']['id'] == Message.UNCHOKE
+        assert server.num_connections == 1
+        assert len(server.clienthandlers) == 1
+        writer.close()
+        # the uploader of the connection stops once the downloader disconnects
+        for _ in range(100):
+            if not server.num_connections:
+                break
+            await asyncio.sleep(0.01)
+        assert server.num_connections == 0
+        assert not server.clienthandlers
+        await wait_closed(listener, writer)
+
+    asyncio.run(run())
+
+
+def test_different_info_hash():
+    server = make_server()
+
+    async def run():
+        listener, reader, writer, _, response = await handshake(server, '00' * 20)
+        assert response['headers'][0]['body']['message'] == 'Different info hash'
+        writer.write(Message.encode(server.message.not_interested))
+        # the connection is closed by the server
+        assert await asyncio.wait_for(reader.read(), 5) == b''
+        assert server.num_connections == 0
+        await wait_closed(listener, writer)
+
+    asyncio.run(run())
+
+
+def test_max_connections():
+    server = make_server()
+    server.max_connections = 0
+
+    async def run():
+        listener = await asyncio.start_server(server._client_handler, '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        # closed right away, before the handshake
+        assert await asyncio.wait_for(reader.read(), 5) == b''
+        assert server.num_connections == 0
+        await wait_closed(listener, writer)
+
+    asyncio.run(run())
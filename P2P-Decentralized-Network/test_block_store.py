@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+from block_store import BlockStore
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    return str(tmp_path / "blocks" / "blocks.data")
+
+
+def test_put_get(data_path):
+    store = BlockStore(data_path)
+    store.put(0, 1, b'b1')
+    store.put(0, 0, b'b0\n|')
+    assert store.get(0, 0) == b'b0\n|'
+    assert store.get(1, 0) is None
+    assert store.get_piece(0, 2) == b'b0\n|b1'
+    assert store.get_piece(0, 3) is None
+    store.close()
+
+
+def test_reopen(data_path):
+    store = BlockStore(data_path)
+    store.put(0, 0, b'old')
+    store.put(0, 0, b'new')
+    store.put(1, 0, b'x' * 100)
+    store.put(2, 0, b'y')
+    store.discard_piece(1)
+    store.close()
+    store = BlockStore(data_path)
+    assert store.get(0, 0) == b'new'
+    assert store.get(1, 0) is None
+    assert store.get(2, 0) == b'y'
+    assert len(store) == 2
+    store.close()
+
+
+def test_recovers_records_not_indexed(data_path):
+    store = BlockStore(data_path)
+    store.put(0, 0, b'a' * 10)
+    store.put(0, 1, b'b' * 10)
+    store.close()
+    # the index write of the last record was lost
+    with open(data_path + BlockStore.INDEX_EXTENSION, "r+b") as index:
+        index.truncate(BlockStore.INDEX_ENTRY.size)
+    store = BlockStore(data_path)
+    assert store.get_piece(0, 2) == b'a' * 10 + b'b' * 10
+    store.close()
+    # the recovered record is indexed again
+    store = BlockStore(data_path)
+    assert store.get(0, 1) == b'b' * 10
+    store.close()
+
+
+def test_drops_partial_tail(data_path):
+    store = BlockStore(data_path)
+    store.put(0, 0, b'a' * 10)
+    store.close()
+    with open(data_path, "ab") as data:
+        data.write(BlockStore.RECORD_HEADER.pack(0, 1, 10) + b'b' * 4)  # crash in the middle of a record
+    with open(data_path + BlockStore.INDEX_EXTENSION, "ab") as index:
+        index.write(b'\x00' * 5)  # crash in the middle of an index entry
+    store = BlockStore(data_path)
+    assert store.get(0, 0) == b'a' * 10
+    assert not store.has(0, 1)
+    store.put(0, 1, b'c' * 10)
+    store.close()
+    store = BlockStore(data_path)
+    assert store.get_piece(0, 2) == b'a' * 10 + b'c' * 10
+    store.close()
+
+
+def test_compact(data_path):
+    store = BlockStore(data_path)
+    for piece_index in range(4):
+        store.put(piece_index, 0, bytes([piece_index]) * 100)
+    store.discard_piece(1)
+    store.discard_piece(2)
+    store.compact()
+    assert store.get(0, 0) == b'\x00' * 100
+    assert store.get(3, 0) == b'\x03' * 100
+    store.close()
+    store = BlockStore(data_path)
+    assert len(store) == 2
+    assert store.get(3, 0) == b'\x03' * 100
+    store.close()
+
+
+def test_records_flushed_before_close(data_path):
+    store = BlockStore(data_path)
+    store.put(0, 0, b'a' * 10)
+    store.put(0, 1, b'b' * 10)
+    # the program crashed: the store was never closed, another one opens the same files
+    recovered = BlockStore(data_path)
+    assert recovered.get_piece(0, 2) == b'a' * 10 + b'b' * 10
+    recovered.close()
+    store.close()
+
+
+def test_sync(data_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(os, "fsync", lambda fd: synced.append(fd))
+    store = BlockStore(data_path)
+    store.put(0, 0, b'a')
+    assert not synced
+    store.put(1, 0, b'b')
+    store.discard_piece(0)  # piece boundary
+    assert len(synced) == 2
+    store.close()
@@ -0,0 +1,97 @@
+from types import SimpleNamespace
+
+import pytest
+
+import choker as choker_module
+from choker import Choker
+
+
+class Uploader:
+    def __init__(self, downloader_id, interested=True):
+        self.downloader_id = downloader_id
+        self.interested = interested
+        self.choked = False
+        self.uploaded = 0
+
+    def set_choked(self, choked):
+        self.choked = choked
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(choker_module.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def make_choker(uploaders, progress=0.5, downloaded=None):
+    server = SimpleNamespace(clienthandlers={i: uploader for i, uploader in enumerate(uploaders)},
+                             message=SimpleNamespace(progress=lambda: progress))
+    scheduler = SimpleNamespace(downloaded_by_peer=lambda: dict(downloaded or {}))
+    return Choker(server, scheduler)
+
+
+def test_unchoke_the_best_peers(clock):
+    uploaders = [Uploader(i) for i in range(6)]
+    uploaders.append(Uploader(6, interested=False))
+    downloaded = {i: i * 1000 for i in range(6)}
+    choker = make_choker(uploaders, downloaded=downloaded)
+    clock.now += Choker.INTERVAL
+    unchoked = choker.evaluate()
+    # the peers we download the fastest from, plus one optimistic unchoke among the others
+    assert unchoked[:Choker.UNCHOKE_SLOTS - 1] == [uploaders[5], uploaders[4], uploaders[3]]
+    assert choker.optimistic in uploaders[:3]
+    assert [uploader.choked for uploader in uploaders] == [uploader not in unchoked for uploader in uploaders]
+    assert uploaders[6].choked
+
+
+def test_seeding_ranks_by_upload_rate(clock):
+    uploaders = [Uploader(i) for i in range(5)]
+    for i, uploader in enumerate(uploaders):
+        uploader.uploaded = (5 - i) * 1000
+    choker = make_choker(uploaders, progress=1.0)
+    clock.now += Choker.INTERVAL
+    assert choker.evaluate()[:3] == uploaders[:3]
+    # the rates are measured since the last evaluation
+    uploaders[4].uploaded += 100000
+    clock.now += Choker.INTERVAL
+    assert choker.evaluate()[0] is uploaders[4]
+
+
+def test_optimistic_rotation(clock, monkeypatch):
+    uploaders = [Uploader(i) for i in range(6)]
+    choker = make_choker(uploaders, downloaded={0: 3000, 1: 2000, 2: 1000})
+    monkeypatch.setattr(choker_module.random, "choice", lambda candidates: candidates[0])
+    clock.now += Choker.INTERVAL
+    choker.evaluate()
+    optimistic = choker.optimistic
+    assert optimistic is uploaders[3]
+    # kept until OPTIMISTIC_INTERVAL seconds passed
+    monkeypatch.setattr(choker_module.random, "choice", lambda candidates: candidates[-1])
+    clock.now += Choker.INTERVAL
+    choker.evaluate()
+    assert choker.optimistic is optimistic
+    clock.now += Choker.OPTIMISTIC_INTERVAL
+    choker.evaluate()
+    assert choker.optimistic is uploaders[5]
+
+
+def test_connected_choked_when_slots_taken(clock):
+    uploaders = [Uploader(i) for i in range(Choker.UNCHOKE_SLOTS)]
+    choker = make_choker(uploaders)
+    new = Uploader(Choker.UNCHOKE_SLOTS)
+    choker.server.clienthandlers['new'] = new
+    choker.connected(new)
+    assert new.choked
+    uploaders[0].choked = True
+    other = Uploader(Choker.UNCHOKE_SLOTS + 1)
+    choker.connected(other)
+    assert not other.choked
@@ -0,0 +1,53 @@
+import os
+from configparser import NoOptionError, NoSectionError
+
+import pytest
+
+from config import Config
+
+
+@pytest.fixture
+def config(tmp_path):
+    conf_file = tmp_path / "conf.ini"
+    conf_file.write_text("[network]\nmax-upload-rate: 16\nserver-engine: threaded\n\n"
+                         "[peer-status]\nseeder = False\n\n[cache]\nratio = 0.5\n")
+    return Config(str(conf_file))
+
+
+def test_typed_snapshot(config):
+    snapshot = config.snapshot()
+    assert snapshot.network.max_upload_rate == 16
+    assert snapshot.network.server_engine == "threaded"
+    assert snapshot.peer_status.seeder is False
+    assert snapshot.cache.ratio == 0.5
+
+
+def test_get_value(config):
+    assert config.get_value("network", "max-upload-rate") == "16"
+    assert config.get_value("peer-status", "seeder") == "False"
+    with pytest.raises(NoSectionError):
+        config.get_value("tracker", "interval")
+    with pytest.raises(NoOptionError):
+        config.get_value("network", "count")
+
+
+def test_snapshot_shared(config, tmp_path):
+    assert Config(str(tmp_path / "conf.ini")).snapshot() is config.snapshot()
+
+
+def test_reload_on_mtime_change(config, tmp_path, monkeypatch):
+    snapshot = config.snapshot()
+    conf_file = tmp_path / "conf.ini"
+    conf_file.write_text("[network]\nmax-upload-rate: 32\n")
+    stat = os.stat(conf_file)
+    os.utime(conf_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    # the mtime is only checked every RELOAD_CHECK_INTERVAL seconds
+    assert config.snapshot() is snapshot
+    monkeypatch.setattr(Config, "RELOAD_CHECK_INTERVAL", 0)
+    assert config.snapshot().network.max_upload_rate == 32
+
+
+def test_set_value_reloads(config):
+    config.set_value("network", "max-upload-rate", "64")
+    assert config.snapshot().network.max_upload_rate == 64
+    assert config.get_value("network", "max-upload-rate") == "64"
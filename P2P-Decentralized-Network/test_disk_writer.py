@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+
+from disk_writer import DiskWriter
+
+
+@pytest.fixture
+def file_path(tmp_path):
+    return str(tmp_path / "tmp" / "ages.tmp")
+
+
+def test_adjacent_pieces_coalesced(file_path):
+    writer = DiskWriter(file_path, 64, 1024)
+    written = []
+    # the disk thread takes the queue once the condition is released, so the 4 pieces are in one batch
+    with writer._condition:
+        for offset in (16, 0, 48, 8):
+            writer.write(offset, bytes([offset]) * 8, lambda offset=offset: written.append(offset))
+    writer.close()
+    with open(file_path, "rb") as file:
+        data = file.read()
+    assert data == b'\x00' * 8 + b'\x08' * 8 + b'\x10' * 8 + b'\x00' * 24 + b'\x30' * 8 + b'\x00' * 8
+    # 0, 8 and 16 are adjacent
+    assert (writer.writes, writer.pieces_written, writer.bytes_written) == (2, 4, 32)
+    assert sorted(written) == [0, 8, 16, 48]
+
+
+def test_max_write_size(file_path, monkeypatch):
+    monkeypatch.setattr(DiskWriter, "MAX_WRITE_SIZE", 16)
+    writer = DiskWriter(file_path, 64, 1024)
+    with writer._condition:
+        for offset in (0, 8, 16):
+            writer.write(offset, b'x' * 8)
+    writer.close()
+    assert writer.writes == 2
+
+
+def test_backpressure(file_path):
+    writer = DiskWriter(file_path, 64, 16)
+    queued = threading.Event()
+    with writer._condition:
+        writer.write(0, b'a' * 16)
+        thread = threading.Thread(target=lambda: (writer.write(16, b'b' * 8), queued.set()))
+        thread.start()
+        # the queue is full until the disk thread writes the first piece
+        assert not queued.wait(0.1)
+    assert queued.wait(5)
+    thread.join()
+    writer.close()
+    assert writer.pieces_written == 2
+
+
+def test_write_error(file_path):
+    writer = DiskWriter(file_path, 64, 1024)
+    errors, written = [], []
+    with writer._condition:
+        writer.write(-8, b'a' * 8, lambda: written.append(-8), errors.append)
+        writer.write(16, b'b' * 8, lambda: written.append(16), errors.append)
+    writer.close()
+    # only the data that was not written is reported to its owner
+    assert written == [16]
+    assert len(errors) == 1 and isinstance(errors[0], OSError)
+    assert writer.write_errors == 1
+
+
+def test_closed(file_path):
+    writer = DiskWriter(file_path, 64, 1024)
+    writer.write(0, b'a' * 8)
+    writer.close()
+    with open(file_path, "rb") as file:
+        assert file.read(8) == b'a' * 8
+    with pytest.raises(ValueError):
+        writer.write(8, b'b' * 8)
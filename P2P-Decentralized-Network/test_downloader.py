@@ -0,0 +1,131 @@
+import math
+import uuid
+
+import pytest
+
+import downloader as downloader_module
+from downloader import Downloader
+from message import Message, MessageDecoder
+from torrent import Torrent
+
+BLOCK_SIZE = 2048
+
+
+class Socket:
+    def __init__(self):
+        self.downloader = None
+        self.decoder = MessageDecoder()
+        self.sent = []
+
+    def sendall(self, data):
+        # the requests lock is never held while sending
+        assert not self.downloader.requests_lock.locked()
+        self.sent += self.decoder.feed(data)
+
+
+class Scheduler:
+    def __init__(self, blocks):
+        self.blocks = list(blocks)
+        self.released = []
+
+    def register(self, downloader):
+        pass
+
+    def next_block(self, downloader):
+        return self.blocks.pop(0) if self.blocks else None
+
+    def block_length(self, piece_index, block_index):
+        return BLOCK_SIZE
+
+    def block_received(self, downloader, piece_index, begin, block):
+        pass
+
+    def release(self, downloader, blocks):
+        self.released += blocks
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def perf_counter(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(downloader_module.time, "perf_counter", clock.perf_counter)
+    return clock
+
+
+def make_downloader(blocks):
+    torrent = Torrent('age.torrent')
+    message = Message(uuid.uuid4(), torrent.create_info_hash())
+    sock = Socket()
+    downloader = Downloader(sock, uuid.uuid4(), torrent, True, True, message, Scheduler(blocks))
+    sock.downloader = downloader
+    return downloader, sock
+
+
+def test_pipelined_requests(clock):
+    downloader, sock = make_downloader([(0, block_index) for block_index in range(8)])
+    assert downloader.request_blocks() == 0  # choked
+    downloader.on_unchoke()
+    assert downloader.request_blocks() == Downloader.MIN_QUEUE_DEPTH
+    assert [(request['index'], request['begin']) for request in sock.sent] == [(0, 0), (0, BLOCK_SIZE)]
+    # only the first request was sent on an idle connection
+    assert [request[2] for request in downloader.requests.values()] == [True, False]
+    assert downloader.request_blocks() == 0  # the queue is full
+    downloader.on_piece(0, 0, b'x' * BLOCK_SIZE)
+    assert downloader.request_blocks() == 1
+    assert downloader.downloaded == BLOCK_SIZE
+
+
+def test_queue_depth_follows_bandwidth_delay(clock):
+    downloader, _ = make_downloader([(0, block_index) for block_index in range(8)])
+    downloader.on_unchoke()
+    downloader.request_blocks()
+    clock.now = 0.1
+    downloader.on_piece(0, 0, b'x' * BLOCK_SIZE)
+    assert downloader.rtt == pytest.approx(0.1)
+    clock.now = 1.0
+    downloader.on_piece(0, BLOCK_SIZE, b'x' * BLOCK_SIZE)
+    # the second request waited behind the first one, so its latency is not the round trip time
+    assert downloader.rtt == pytest.approx(0.1)
+    rate = 2 * BLOCK_SIZE / 1.0
+    assert downloader.rate == pytest.approx(rate)
+    expected = math.ceil(rate * 0.1 / BLOCK_SIZE * Downloader.QUEUE_GAIN)
+    assert downloader.queue_depth == max(Downloader.MIN_QUEUE_DEPTH, expected)
+
+
+def test_queue_depth_bounds(clock):
+    downloader, _ = make_downloader([])
+    clock.now = 1.0
+    downloader._update_queue_depth((BLOCK_SIZE, 0.5, True), 10 ** 9)
+    assert downloader.queue_depth == Downloader.MAX_QUEUE_DEPTH
+    clock.now = 2.0
+    downloader._update_queue_depth((BLOCK_SIZE, 2.0, True), 0)
+    # the throughput is averaged, the round trip time is not
+    assert downloader.rtt == 0
+    assert downloader.queue_depth == Downloader.MIN_QUEUE_DEPTH
+
+
+def test_choke_releases_requests(clock):
+    downloader, _ = make_downloader([(1, 0), (1, 1)])
+    downloader.on_unchoke()
+    downloader.request_blocks()
+    downloader.on_choke()
+    assert downloader.requests == {}
+    assert downloader.scheduler.released == [(1, 0), (1, 1)]
+    assert downloader.request_blocks() == 0
+
+
+def test_cancel(clock):
+    downloader, sock = make_downloader([(2, 3)])
+    downloader.on_unchoke()
+    downloader.request_blocks()
+    downloader.cancel(2, 3 * BLOCK_SIZE, BLOCK_SIZE)
+    assert downloader.requests == {}
+    cancel = sock.sent[-1]
+    assert (cancel['id'], cancel['index'], cancel['begin']) == (Message.CANCEL, 2, 3 * BLOCK_SIZE)
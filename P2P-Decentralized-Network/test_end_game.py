@@ -0,0 +1,83 @@
+import uuid
+
+from bitarray import bitarray
+
+from end_game import EndGame
+from message import Message
+
+ALL_PIECES = bitarray('11')
+
+
+def make_end_game():
+    # 2 pieces of 2 blocks
+    message = Message(uuid.uuid4(), '00' * 20)
+    message.init_bitfield(2, None, 2)
+    return EndGame(message)
+
+
+def request_all(end_game, downloader):
+    for piece_index in range(2):
+        while end_game.assign_block(downloader, piece_index) != -1:
+            pass
+
+
+def test_enter_once_everything_requested():
+    end_game = make_end_game()
+    assert end_game.assign_block('a', 0) == 0
+    assert end_game.assign_block('a', 0) == 1
+    assert end_game.assign_block('a', 0) == -1
+    assert end_game.fully_requested().tolist() == [True, False]
+    assert not end_game.enter()
+    request_all(end_game, 'a')
+    assert end_game.enter()
+    assert end_game.stats()['in-flight'] == 4
+
+
+def test_duplicates_cancelled():
+    end_game = make_end_game()
+    request_all(end_game, 'a')
+    assert end_game.assign_duplicate('b', ALL_PIECES) is None  # not in end-game yet
+    end_game.enter()
+    duplicates = set()
+    block = end_game.assign_duplicate('b', ALL_PIECES)
+    while block is not None:
+        duplicates.add(block)
+        block = end_game.assign_duplicate('b', ALL_PIECES)
+    assert duplicates == {(0, 0), (0, 1), (1, 0), (1, 1)}
+    # the first copy completes the block, the other peer gets a cancel
+    assert end_game.block_received('b', 0, 0, 2048) == (True, False, ['a'])
+    assert end_game.block_received('a', 0, 0, 2048) == (False, False, [])
+    assert end_game.block_received('a', 0, 1, 2048) == (True, True, ['b'])
+    assert end_game.stats() == {'active': True, 'in-flight': 2, 'duplicate-requests': 4, 'cancels': 2,
+                                'wasted-bytes': 2048}
+
+
+def test_duplicates_only_of_peer_pieces():
+    end_game = make_end_game()
+    request_all(end_game, 'a')
+    end_game.enter()
+    assert end_game.assign_duplicate('b', bitarray('01')) in ((1, 0), (1, 1))
+    assert end_game.assign_duplicate('b', None) is None
+
+
+def test_released_blocks_leave_end_game():
+    end_game = make_end_game()
+    request_all(end_game, 'a')
+    end_game.enter()
+    # choked: the block is requested again from any peer
+    end_game.remove_request('a', 1, 1)
+    assert not end_game.active
+    assert end_game.fully_requested().tolist() == [True, False]
+    assert end_game.assign_block('b', 1) == 1
+    assert end_game.enter()
+
+
+def test_piece_failed():
+    end_game = make_end_game()
+    request_all(end_game, 'a')
+    end_game.block_received('a', 0, 0, 2048)
+    end_game.block_received('a', 0, 1, 2048)
+    end_game.piece_failed(0)
+    assert end_game.message.is_piece_missing(0)
+    assert not end_game.fully_requested()[0]
+    assert end_game.assign_block('b', 0) == 0
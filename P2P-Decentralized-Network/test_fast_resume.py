@@ -0,0 +1,113 @@
+import hashlib
+import os
+
+import pytest
+
+from fast_resume import FastResume
+
+PIECE_LENGTH = 16
+NUM_PIECES = 4
+
+
+class Torrent:
+    def __init__(self, data):
+        self.hashes = [hashlib.sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, len(data), PIECE_LENGTH)]
+
+    def num_pieces(self):
+        return NUM_PIECES
+
+    def piece_length(self):
+        return PIECE_LENGTH
+
+    def create_info_hash(self):
+        return '01' * 20
+
+    def verify_piece(self, piece_index, piece):
+        return hashlib.sha1(piece).digest() == self.hashes[piece_index]
+
+
+@pytest.fixture
+def file_path(tmp_path):
+    file_path = tmp_path / "age.tmp"
+    file_path.write_bytes(bytes(range(PIECE_LENGTH * NUM_PIECES)))
+    return str(file_path)
+
+
+def resume(file_path):
+    with open(file_path, "rb") as file:
+        return FastResume(Torrent(file.read()), None, file_path)
+
+
+def test_no_sidecar(file_path):
+    assert resume(file_path).load().all()
+    assert os.path.exists(file_path + FastResume.EXTENSION)
+
+
+def test_unchanged_file_not_verified(file_path, monkeypatch):
+    fast_resume = resume(file_path)
+    fast_resume.piece_completed(1)
+    fast_resume.save()
+    fast_resume = resume(file_path)
+    verified = []
+    monkeypatch.setattr(fast_resume, "verify", lambda pieces, progress=None: verified.append(pieces) or pieces)
+    assert fast_resume.load().tolist() == [False, True, False, False]
+    assert not verified[0].any()
+
+
+def test_modified_file_verified(file_path):
+    fast_resume = resume(file_path)
+    torrent = fast_resume.torrent
+    fast_resume.piece_completed(0)
+    fast_resume.piece_completed(1)
+    fast_resume.save()
+    # another program rewrites a piece of the bitfield, same size, other mtime
+    with open(file_path, "r+b") as file:
+        file.seek(PIECE_LENGTH)
+        file.write(b'\xff' * PIECE_LENGTH)
+    stat = os.stat(file_path)
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    fast_resume = FastResume(torrent, None, file_path)
+    assert fast_resume.load().tolist() == [True, False, True, True]
+
+
+def test_other_size_verified(file_path):
+    fast_resume = resume(file_path)
+    torrent = fast_resume.torrent
+    fast_resume.recheck()
+    with open(file_path, "r+b") as file:
+        file.truncate(PIECE_LENGTH * 3)
+    assert FastResume(torrent, None, file_path).load().tolist() == [True, True, True, False]
+
+
+def test_saved_every_interval(file_path, monkeypatch):
+    fast_resume = resume(file_path)
+    fast_resume.piece_completed(0)
+    assert not os.path.exists(fast_resume.resume_path)
+    monkeypatch.setattr(FastResume, "SAVE_INTERVAL", 0)
+    fast_resume.piece_completed(1)
+    assert os.path.exists(fast_resume.resume_path)
+    assert resume(file_path).load().tolist() == [True, True, False, False]
+
+
+def test_saved_when_completed(file_path):
+    fast_resume = resume(file_path)
+    for piece_index in range(NUM_PIECES):
+        fast_resume.piece_completed(piece_index)
+    assert os.path.exists(fast_resume.resume_path)
+    assert not os.path.exists(fast_resume.resume_path + ".tmp")
+
+
+def test_other_torrent_verified(file_path):
+    fast_resume = resume(file_path)
+    fast_resume.piece_completed(0)
+    fast_resume.save()
+    other = resume(file_path)
+    other.torrent.create_info_hash = lambda: '02' * 20
+    other.torrent.hashes[1] = b'\x00' * 20
+    assert other.load().tolist() == [True, False, True, True]
+
+
+def test_corrupted_sidecar(file_path):
+    with open(file_path + FastResume.EXTENSION, "wb") as file:
+        file.write(b'd8:bitfield')
+    assert resume(file_path).load().all()
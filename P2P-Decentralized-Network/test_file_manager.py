@@ -0,0 +1,58 @@
+import os
+import uuid
+
+import pytest
+
+from file_manager import FileManager
+from torrent import Torrent
+
+
+@pytest.fixture
+def file_manager(tmp_path):
+    torrent = Torrent('age.torrent')
+    data = os.urandom(torrent.file_length())
+    file_path = tmp_path / "age.txt"
+    file_path.write_bytes(data)
+    file_manager = FileManager(torrent, uuid.uuid4())
+    file_manager.set_path_to_original_file(str(file_path))
+    file_manager.data = data
+    yield file_manager
+    file_manager.close()
+
+
+def test_get_block(file_manager):
+    piece_size = file_manager.piece_size
+    assert file_manager.get_block(3, 2048, 2048) == file_manager.data[3 * piece_size + 2048:3 * piece_size + 4096]
+
+
+def test_read_last_piece(file_manager):
+    last = file_manager.torrent.num_pieces() - 1
+    piece = file_manager.read_piece(last)
+    assert piece == file_manager.data[last * file_manager.piece_size:]
+    assert len(piece) == file_manager.piece_length(last) < file_manager.piece_size
+
+
+def test_file_opened_once(file_manager, monkeypatch):
+    opened = []
+    os_open = os.open
+    monkeypatch.setattr(os, "open", lambda *args: opened.append(args[0]) or os_open(*args))
+    for piece_index in range(4):
+        file_manager.get_block(piece_index, 0, 2048)
+    assert len(opened) == 1
+
+
+def test_read_without_pread(file_manager, monkeypatch):
+    monkeypatch.delattr(os, "pread", raising=False)
+    piece_size = file_manager.piece_size
+    assert file_manager.get_block(1, 0, 16) == file_manager.data[piece_size:piece_size + 16]
+    assert file_manager.get_block(0, 16, 16) == file_manager.data[16:32]
+
+
+def test_block_file_range(file_manager):
+    last = file_manager.torrent.num_pieces() - 1
+    file_offset, length = file_manager.block_file_range(last, 0, file_manager.piece_size)
+    assert (file_offset, length) == (last * file_manager.piece_size, file_manager.piece_length(last))
+    with pytest.raises(ValueError):
+        file_manager.block_file_range(0, file_manager.piece_size - 1, 2)
+    with pytest.raises(ValueError):
+        file_manager.block_file_range(last + 1, 0, 16)
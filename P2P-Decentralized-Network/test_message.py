@@ -0,0 +1,194 @@
+import socket
+import uuid
+
+import pytest
+from bitarray import bitarray
+
+from custom_exception import ProtocolException
+from message import Message, MessageDecoder
+
+
+def roundtrip(data):
+    frame = Message.encode(data)
+    (length,) = Message.LENGTH_PREFIX.unpack_from(frame)
+    assert length == len(frame) - Message.LENGTH_PREFIX.size
+    return Message.decode(frame[Message.LENGTH_PREFIX.size:])
+
+
+def test_pwp_messages_roundtrip():
+    assert roundtrip({'id': Message.CHOKE})['id'] == Message.CHOKE
+    assert roundtrip({'id': Message.HAVE, 'piece_index': 7})['piece_index'] == 7
+    request = roundtrip({'id': Message.REQUEST, 'index': 1, 'begin': 2048, 'length': 2048})
+    assert (request['id'], request['index'], request['begin'], request['length']) == (Message.REQUEST, 1, 2048, 2048)
+    cancel = roundtrip({'id': Message.CANCEL, 'index': 3, 'begin': 0, 'length': 16})
+    assert (cancel['id'], cancel['index']) == (Message.CANCEL, 3)
+    piece = roundtrip({'id': Message.PIECE, 'index': 2, 'begin': 4096, 'block': b'\x00\n|data'})
+    assert (piece['index'], piece['begin'], bytes(piece['block'])) == (2, 4096, b'\x00\n|data')
+    assert roundtrip({'id': Message.PORT, 'listen-port': 6881})['listen-port'] == 6881
+    pex = roundtrip({'id': Message.EXTENDED, 'added': b'\x7f\x00\x00\x01\x13\x88', 'dropped': b''})
+    assert (pex['added'], pex['dropped']) == (b'\x7f\x00\x00\x01\x13\x88', b'')
+
+
+def test_pex_frame():
+    frame = Message.encode({'id': Message.EXTENDED, 'added': b'\x7f\x00\x00\x01\x13\x88', 'dropped': b''})
+    # <extended message id><bencoded ut_pex dictionary>
+    assert frame[5] == Message.UT_PEX
+    assert frame[6:] == b'd5:added6:\x7f\x00\x00\x01\x13\x887:added.f1:\x007:dropped0:e'
+
+
+@pytest.mark.parametrize("added, dropped", [(b'\x00' * 5, b''), (b'', b'\x00' * 7)])
+def test_pex_partial_peer(added, dropped):
+    with pytest.raises(ValueError):
+        Message.encode({'id': Message.EXTENDED, 'added': added, 'dropped': dropped})
+    payload = b'd5:added%d:%s7:dropped%d:%se' % (len(added), added, len(dropped), dropped)
+    with pytest.raises(ProtocolException):
+        Message.decode(bytes([Message.EXTENDED, Message.UT_PEX]) + payload)
+
+
+def test_bitfield_roundtrip():
+    bits = bitarray('1011001')
+    assert roundtrip({'id': Message.BITFIELD, 'bitfield': bits})['bitfield'] == bits.tobytes()
+
+
+def test_keep_alive():
+    assert Message.encode({'len': b'0000'}) == b'\x00\x00\x00\x00'
+    assert Message.decode(b'') == {'len': 0}
+
+
+def test_control_frame_roundtrip():
+    peer_id = uuid.uuid4()
+    data = {'headers': {'type': 'handshake'}, 'peer_id': peer_id, 'info_hash': b'\x00' * 20,
+            'listen_port': 5000, 'interested': True, 'choked': False, 'status': None, 'peers': ['a', b'b', 3]}
+    assert roundtrip(data) == data
+
+
+def test_control_frame_rejects_other_types():
+    with pytest.raises(TypeError):
+        Message.encode({'headers': object()})
+
+
+@pytest.mark.parametrize("payload", [
+    b'\x80\x04K\x01.',  # a pickle
+    b'd1:ai1e',  # truncated bencode
+    b'd1:a1:xe',  # unknown type tag
+])
+def test_malformed_control_frame(payload):
+    with pytest.raises(ProtocolException):
+        Message.decode(bytes([Message.CONTROL]) + payload)
+
+
+def test_malformed_pwp_frames():
+    with pytest.raises(ProtocolException):
+        Message.decode(bytes([Message.HAVE, 0]))
+    with pytest.raises(ProtocolException):
+        Message.decode(bytes([Message.CHOKE, 0]))
+    with pytest.raises(ProtocolException):
+        Message.decode(bytes([99]))
+
+
+def test_decoder_split_frames():
+    frames = Message.encode({'id': Message.HAVE, 'piece_index': 1}) + \
+        Message.encode({'id': Message.REQUEST, 'index': 0, 'begin': 0, 'length': 2048})
+    decoder = MessageDecoder()
+    messages = []
+    for i in range(len(frames)):
+        messages += decoder.feed(frames[i:i + 1])
+    assert [message['id'] for message in messages] == [Message.HAVE, Message.REQUEST]
+
+
+def test_decoder_merged_frames():
+    frames = b''.join(Message.encode({'id': Message.HAVE, 'piece_index': i}) for i in range(5))
+    messages = MessageDecoder().feed(frames + frames[:3])
+    assert [message['piece_index'] for message in messages] == list(range(5))
+
+
+def test_decoder_skips_bad_frame():
+    good = Message.encode({'id': Message.HAVE, 'piece_index': 1})
+    bad = Message.LENGTH_PREFIX.pack(2) + bytes([Message.CHOKE, 0])
+    decoder = MessageDecoder()
+    with pytest.raises(ProtocolException):
+        decoder.feed(good + bad + good)
+    # the message before the bad frame is kept, the one after it is decoded with the next data
+    assert [message['piece_index'] for message in decoder.drain()] == [1]
+    assert [message['piece_index'] for message in decoder.feed(b'')] == [1]
+
+
+def test_decoder_rejects_oversized_frame():
+    decoder = MessageDecoder(max_message_length=16)
+    with pytest.raises(ProtocolException):
+        decoder.feed(Message.LENGTH_PREFIX.pack(17) + b'\x00' * 17)
+    # the buffer is cleared, so the next frames are not read from the middle of the oversized one
+    assert decoder.feed(Message.encode({'id': Message.UNCHOKE}))[0]['id'] == Message.UNCHOKE
+
+
+def test_receive_decodes_frames_after_bad_frame():
+    good = Message.encode({'id': Message.HAVE, 'piece_index': 3})
+    bad = Message.LENGTH_PREFIX.pack(2) + bytes([Message.CHOKE, 0])
+    reader, writer = socket.socketpair()
+    try:
+        reader.settimeout(1)
+        writer.sendall(bad + good)  # received by the same recv()
+        decoder = MessageDecoder()
+        with pytest.raises(ProtocolException):
+            decoder.receive(reader)
+        # the peer sends nothing more, the good frame is already buffered
+        assert decoder.receive(reader)['piece_index'] == 3
+    finally:
+        reader.close()
+        writer.close()
+
+
+def bitfield_message(num_pieces=10, completed=None, blocks_per_piece=4, last_piece_blocks=2):
+    message = Message(uuid.uuid4(), '00' * 20)
+    message.init_bitfield(num_pieces, completed, blocks_per_piece, last_piece_blocks)
+    return message
+
+
+def test_piece_completed_by_its_blocks():
+    message = bitfield_message()
+    for block_index in (2, 0, 1):
+        message.set_block_to_completed(3, block_index)
+    assert message.is_piece_missing(3)
+    assert message.next_missing_block_index(3) == 3
+    message.set_block_to_completed(3, 3)
+    assert not message.is_piece_missing(3)
+    assert message.next_missing_block_index(3) == -1
+    # the blocks past the end of the file are never downloaded
+    message.set_block_to_completed(9, 0)
+    message.set_block_to_completed(9, 1)
+    assert not message.is_piece_missing(9)
+    assert message.num_completed_pieces() == 2
+    assert message.progress() == 0.2
+
+
+def test_next_missing_piece():
+    completed = bitarray('1101100000')
+    message = bitfield_message(completed=completed)
+    assert message.num_completed_pieces() == 4
+    assert message.next_missing_piece_index() == 2
+    assert message.next_missing_piece_index(3) == 5
+    # completed by a previous run, so on disk already
+    assert message.is_piece_available(0) and not message.is_piece_available(2)
+    message.set_piece_to_missing(0)
+    assert message.next_missing_piece_index() == 0
+    assert not message.is_piece_available(0)
+    assert message.num_completed_pieces() == 3
+
+
+def test_piece_available_once_written():
+    message = bitfield_message()
+    message.set_piece_to_completed(1)
+    assert not message.is_piece_available(1)
+    assert not message.get_bitfield_message()['bitfield'][1]
+    message.set_piece_available(1)
+    assert message.get_bitfield_message()['bitfield'][1]
+
+
+def test_bitfield_from_bytes():
+    message = bitfield_message(completed=bitarray('1000000001'))
+    message.bitfield_from_bytes(bitarray('0110000000' + '000000').tobytes())
+    assert message.get_bitfield().tolist() == [False, True, True] + [False] * 7
+    assert message.num_completed_pieces() == 2
+    # the last piece is missing again, but its blocks past the end of the file are kept
+    assert message.get_bitfield_piece(9).tolist() == [False, False, True, True]
+    assert message.bitfield_to_bytes() == bitarray('0110000000' + '000000').tobytes()
@@ -0,0 +1,88 @@
+from pex import PeerExchange
+from tracker import Tracker
+
+LISTEN_ADDRESS = ('10.0.0.1', 5000)
+
+
+class Connection:
+    def __init__(self):
+        self.sent = []  # (added, dropped) decoded
+
+    def send_pex(self, added, dropped):
+        self.sent.append((set(Tracker.decode_peers(added)), set(Tracker.decode_peers(dropped))))
+
+
+def test_send_due_diffs():
+    pex = PeerExchange(LISTEN_ADDRESS)
+    a, b, c = Connection(), Connection(), Connection()
+    pex.connected(a, ('10.0.0.2', 5000))
+    pex.connected(b, ('10.0.0.3', 5000))
+    pex.connected(c)  # listen address not known, never advertised
+    now = PeerExchange.INTERVAL
+    assert pex.send_due(now) == 3
+    assert a.sent == [({('10.0.0.3', 5000)}, set())]
+    assert b.sent == [({('10.0.0.2', 5000)}, set())]
+    assert c.sent == [({('10.0.0.2', 5000), ('10.0.0.3', 5000)}, set())]
+    # nothing changed
+    assert pex.send_due(now + PeerExchange.INTERVAL) == 0
+    d = Connection()
+    pex.connected(d, ('10.0.0.4', 5000))
+    pex.disconnected(b)
+    # only the new connection is due before the interval
+    assert pex.send_due(now + 1) == 1
+    assert d.sent == [({('10.0.0.2', 5000)}, set())]
+    assert pex.send_due(now + PeerExchange.INTERVAL) == 2
+    assert a.sent[-1] == ({('10.0.0.4', 5000)}, {('10.0.0.3', 5000)})
+    assert c.sent[-1] == ({('10.0.0.4', 5000)}, {('10.0.0.3', 5000)})
+
+
+def test_send_due_max_added():
+    pex = PeerExchange(LISTEN_ADDRESS)
+    connections = [Connection() for _ in range(PeerExchange.MAX_ADDED + 2)]
+    for i, connection in enumerate(connections):
+        pex.connected(connection, ('10.0.1.%d' % i, 5000))
+    pex.send_due(PeerExchange.INTERVAL)
+    assert len(connections[0].sent[0][0]) == PeerExchange.MAX_ADDED
+    # the rest is sent with the next message
+    pex.send_due(2 * PeerExchange.INTERVAL)
+    assert len(connections[0].sent[1][0]) == 1
+
+
+def test_received():
+    learned = []
+    pex = PeerExchange(LISTEN_ADDRESS, on_peers=lambda peers: learned.append(Tracker.decode_peers(peers)))
+    a, b = Connection(), Connection()
+    pex.connected(a, ('10.0.0.2', 5000))
+    pex.connected(b, ('10.0.0.3', 5000))
+    added = Tracker.encode_peers([('10.0.0.3', 5000), LISTEN_ADDRESS, ('10.0.0.4', 5000), ('10.0.0.5', 5000)])
+    new = pex.received(a, added, b'', now=100)
+    # the connected peers and this peer are not new
+    assert Tracker.decode_peers(new) == [('10.0.0.4', 5000), ('10.0.0.5', 5000)]
+    assert learned == [[('10.0.0.4', 5000), ('10.0.0.5', 5000)]]
+    # known already
+    assert pex.received(b, Tracker.encode_peers([('10.0.0.4', 5000)]), b'', now=100) == b''
+    assert len(learned) == 1
+    # too soon after the last message on the connection
+    assert pex.received(a, Tracker.encode_peers([('10.0.0.6', 5000)]), b'', now=101) == b''
+    assert pex.messages_ignored == 1
+    pex.received(a, b'', Tracker.encode_peers([('10.0.0.5', 5000)]), now=100 + PeerExchange.MIN_RECEIVE_INTERVAL)
+    assert set(pex.known) == {('10.0.0.4', 5000)}
+    # connected to a known peer
+    pex.connected(Connection(), ('10.0.0.4', 5000))
+    assert pex.known == {}
+
+
+def test_received_unknown_connection():
+    pex = PeerExchange(LISTEN_ADDRESS)
+    assert pex.received(Connection(), Tracker.encode_peers([('10.0.0.4', 5000)]), b'', now=100) == b''
+    assert pex.messages_ignored == 1
+
+
+def test_max_known():
+    pex = PeerExchange(LISTEN_ADDRESS)
+    pex.MAX_KNOWN = 3
+    a = Connection()
+    pex.connected(a, ('10.0.0.2', 5000))
+    pex.received(a, Tracker.encode_peers([('10.0.1.%d' % i, 5000) for i in range(5)]), b'', now=100)
+    # the peers learned first are forgotten
+    assert list(pex.known) == [('10.0.1.2', 5000), ('10.0.1.3', 5000), ('10.0.1.4', 5000)]
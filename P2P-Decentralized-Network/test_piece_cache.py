@@ -0,0 +1,52 @@
+import uuid
+
+from file_manager import FileManager
+from piece_cache import PieceCache
+from torrent import Torrent
+
+
+def test_lru_eviction():
+    cache = PieceCache(30)
+    cache.put(0, b'a' * 10)
+    cache.put(1, b'b' * 10)
+    cache.put(2, b'c' * 10)
+    assert cache.get(0) == b'a' * 10  # piece 1 is the least recently used now
+    cache.put(3, b'd' * 10)
+    assert cache.get(1) is None
+    assert cache.get(0) is not None and cache.get(2) is not None and cache.get(3) is not None
+    assert cache.stats() == {'hits': 4, 'misses': 1, 'evictions': 1, 'pieces': 3, 'bytes': 30, 'max_bytes': 30}
+
+
+def test_put_again():
+    cache = PieceCache(20)
+    cache.put(0, b'a' * 10)
+    cache.put(0, b'b' * 15)
+    assert cache.stats()['bytes'] == 15
+    assert cache.get(0) == b'b' * 15
+
+
+def test_piece_bigger_than_cache():
+    cache = PieceCache(10)
+    cache.put(0, b'a' * 5)
+    cache.put(1, b'b' * 11)
+    assert len(cache) == 1
+    assert cache.get(1) is None
+    assert cache.stats()['evictions'] == 0
+
+
+def test_cached_block(tmp_path):
+    torrent = Torrent('age.torrent')
+    file_path = tmp_path / "age.txt"
+    file_path.write_bytes(b'\x00' * torrent.file_length())
+    file_manager = FileManager(torrent, uuid.uuid4(), PieceCache(4 * torrent.piece_length()))
+    file_manager.set_path_to_original_file(str(file_path))
+    torrent.verify_piece = lambda piece_index, piece: piece_index == 0
+    try:
+        assert bytes(file_manager.get_cached_block(0, 2048, 16)) == b'\x00' * 16
+        assert bytes(file_manager.get_cached_block(0, 0, 16)) == b'\x00' * 16
+        assert file_manager.piece_cache.stats()['hits'] == 1
+        # a piece that does not match its hash is never cached
+        assert file_manager.get_cached_block(1, 0, 16) is None
+        assert len(file_manager.piece_cache) == 1
+    finally:
+        file_manager.close()
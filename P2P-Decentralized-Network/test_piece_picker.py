@@ -0,0 +1,62 @@
+import pytest
+from bitarray import bitarray
+
+from piece_picker import PiecePicker
+
+
+def pieces(bits):
+    return bitarray(bits)
+
+
+def test_rarest_first():
+    picker = PiecePicker(6)
+    picker.peer_bitfield('a', pieces('111111'))
+    picker.peer_bitfield('b', pieces('110111'))
+    picker.peer_bitfield('c', pieces('100110'))
+    assert [picker.availability(piece_index) for piece_index in range(6)] == [3, 2, 1, 3, 3, 2]
+    have = pieces('000000')
+    assert picker.pick('a', have) == 2
+    # ties are broken at random among the rarest pieces
+    assert {picker.pick('b', have) for _ in range(50)} == {1, 5}
+    assert picker.pick('c', have) in (0, 3, 4)
+
+
+def test_have_and_exclude():
+    picker = PiecePicker(4)
+    picker.peer_bitfield('a', pieces('1100'))
+    picker.peer_have('a', 3)
+    picker.peer_have('a', 3)  # announced twice, counted once
+    assert picker.availability(3) == 1
+    assert picker.pick('a', pieces('1100')) == 3
+    assert picker.pick('a', pieces('1100'), exclude=pieces('0001')) == -1
+    # a have received before the bitfield
+    picker.peer_have('b', 2)
+    assert picker.pick('b', pieces('0000')) == 2
+
+
+def test_disconnected():
+    picker = PiecePicker(3)
+    picker.peer_bitfield('a', pieces('110'))
+    picker.peer_bitfield('b', pieces('010'))
+    picker.peer_disconnected('b')
+    assert [picker.availability(piece_index) for piece_index in range(3)] == [1, 1, 0]
+    assert picker.peer_pieces('b') is None
+    assert picker.pick('b', pieces('000')) == -1
+    # a new bitfield replaces the previous one
+    picker.peer_bitfield('a', pieces('001'))
+    assert [picker.availability(piece_index) for piece_index in range(3)] == [0, 0, 1]
+
+
+def test_bitfield_payload():
+    picker = PiecePicker(10)
+    picker.peer_bitfield('a', pieces('0000000001' + '111111').tobytes())  # spare bits are ignored
+    assert picker.peer_pieces('a').tolist() == [False] * 9 + [True]
+
+
+def test_sequential():
+    picker = PiecePicker(5, PiecePicker.SEQUENTIAL)
+    picker.peer_bitfield('a', pieces('11111'))
+    picker.peer_bitfield('b', pieces('00010'))
+    assert picker.pick('a', pieces('10000')) == 1
+    with pytest.raises(ValueError):
+        PiecePicker(5, "random")
@@ -0,0 +1,82 @@
+import pytest
+
+import rate_limiter as rate_limiter_module
+from rate_limiter import RateLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter_module.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(1000)
+    # a full burst goes right away, then the bucket goes into debt
+    assert bucket.reserve(1000) == 0
+    assert bucket.reserve(500) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.reserve(1000) == pytest.approx(1.0)
+    # tokens saved while idle are capped by the burst
+    clock.now += 100
+    assert bucket.reserve(2000) == pytest.approx(1.0)
+
+
+def test_token_bucket_unlimited(clock):
+    bucket = TokenBucket(0)
+    assert bucket.reserve(10 ** 9) == 0
+    bucket.set_rate(100)
+    assert bucket.reserve(100) == pytest.approx(1.0)
+
+
+def test_fair_share(clock):
+    limiter = RateLimiter(1000)
+    a, b, idle = limiter.connection(), limiter.connection(), limiter.connection()
+    limiter.reserve(a, 0)
+    limiter.reserve(b, 0)
+    # only the connections active in the last ACTIVE_WINDOW seconds share the rate
+    assert a.bucket.rate == b.bucket.rate == 500
+    clock.now += RateLimiter.ACTIVE_WINDOW + 0.1
+    limiter.reserve(a, 0)
+    assert a.bucket.rate == 1000
+    idle.close()
+    limiter.reserve(b, 0)
+    assert a.bucket.rate == b.bucket.rate == 500
+
+
+def test_connection_rate(clock):
+    limiter = RateLimiter(1000, connection_rate=300)
+    connection = limiter.connection()
+    limiter.reserve(connection, 0)
+    assert connection.bucket.rate == 300
+    limiter.set_connection_rate(0)
+    assert connection.bucket.rate == 1000
+    limiter.set_rate(0)
+    limiter.set_connection_rate(200)
+    assert connection.bucket.rate == 200
+    limiter.set_connection_rate(0)
+    assert connection.bucket.rate == 0
+
+
+def test_reserve_both_rates(clock):
+    limiter = RateLimiter(1000, connection_rate=500)
+    connection = limiter.connection()
+    # the connection bucket is the slower one, and a new connection has no burst saved
+    assert limiter.reserve(connection, 1000) == pytest.approx(2.0)
+    limiter.set_connection_rate(0)
+    clock.now += 10
+    assert limiter.reserve(connection, 3000) == pytest.approx(2.0)
+
+
+def test_from_config():
+    limiter = RateLimiter.from_config("max-upload-rate")
+    assert (limiter.global_bucket.rate, limiter.connection_rate) == (16 * 1024, 0)
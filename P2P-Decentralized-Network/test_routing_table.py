@@ -0,0 +1,76 @@
+import time
+
+from routing_table import RoutingTable, distance
+
+NODE_ID = b'\x00' * 20
+
+
+def far_id(i):
+    """:return: a node id in the last bucket (the first bit differs from NODE_ID)"""
+    return b'\x80' + i.to_bytes(19, "big")
+
+
+def test_bucket_index():
+    table = RoutingTable(NODE_ID)
+    assert table.bucket_index(far_id(1)) == RoutingTable.ID_BITS - 1
+    assert table.bucket_index(b'\x00' * 19 + b'\x01') == 0
+    assert table.bucket_index(NODE_ID) == -1
+    assert not table.add(NODE_ID, '10.0.0.1', 6881)
+    assert not table.add(b'\x01' * 19, '10.0.0.1', 6881)
+
+
+def test_full_bucket_keeps_good_nodes():
+    table = RoutingTable(NODE_ID, k=2)
+    assert table.add(far_id(1), '10.0.0.1', 6881)
+    assert table.add(far_id(2), '10.0.0.2', 6881)
+    # the bucket is full of good nodes, the new one is a replacement
+    assert not table.add(far_id(3), '10.0.0.3', 6881)
+    assert table.get(far_id(3)) is None
+    assert len(table) == 2
+
+
+def test_full_bucket_evicts_stale_node():
+    table = RoutingTable(NODE_ID, k=2)
+    table.add(far_id(1), '10.0.0.1', 6881)
+    table.add(far_id(2), '10.0.0.2', 6881)
+    table.get(far_id(1)).last_seen = time.monotonic() - RoutingTable.STALE_TIME
+    assert table.add(far_id(3), '10.0.0.3', 6881)
+    assert table.get(far_id(1)) is None
+    assert {node.id for node in table.nodes()} == {far_id(2), far_id(3)}
+
+
+def test_seen_node_moves_to_the_end():
+    table = RoutingTable(NODE_ID, k=2)
+    table.add(far_id(1), '10.0.0.1', 6881)
+    table.add(far_id(2), '10.0.0.2', 6881)
+    # far_id(1) answered again, so far_id(2) is now the least recently seen
+    table.add(far_id(1), '10.0.0.1', 6881)
+    table.get(far_id(2)).last_seen = time.monotonic() - RoutingTable.STALE_TIME
+    table.get(far_id(1)).last_seen = time.monotonic() - RoutingTable.STALE_TIME
+    assert table.add(far_id(3), '10.0.0.3', 6881)
+    assert table.get(far_id(2)) is None
+    assert table.get(far_id(1)) is not None
+
+
+def test_failed_node_replaced():
+    table = RoutingTable(NODE_ID, k=2)
+    table.add(far_id(1), '10.0.0.1', 6881)
+    table.add(far_id(2), '10.0.0.2', 6881)
+    table.add(far_id(3), '10.0.0.3', 6881)  # replacement
+    for _ in range(RoutingTable.MAX_FAILURES - 1):
+        table.failed(far_id(1))
+    assert table.get(far_id(1)) is not None
+    table.failed(far_id(1))
+    assert table.get(far_id(1)) is None
+    assert table.get(far_id(3)) is not None
+
+
+def test_closest():
+    table = RoutingTable(NODE_ID)
+    ids = [bytes([i]) + b'\x00' * 19 for i in range(1, 30)]
+    for i, node_id in enumerate(ids):
+        table.add(node_id, '10.0.0.%d' % i, 6881)
+    target = bytes([5]) + b'\x00' * 19
+    closest = table.closest(target, 4)
+    assert closest[0].id == target
+    assert [node.id for node in closest] == sorted(ids, key=lambda node_id: distance(node_id, target))[:4]
@@ -0,0 +1,187 @@
+import threading
+import uuid
+
+from bitarray import bitarray
+
+from message import Message
+from scheduler import DownloadScheduler
+
+BLOCK_SIZE = 4
+NUM_PIECES = 3
+BLOCKS_PER_PIECE = 2
+ALL_PIECES = bitarray('111')
+
+
+class Torrent:
+    def block_size(self):
+        return BLOCK_SIZE
+
+
+class BlockStore:
+    def discard_piece(self, piece_index):
+        pass
+
+
+class FileManager:
+    def __init__(self):
+        self.blocks = {}
+        self.invalid = set()  # pieces that fail the hash validation
+        self.write_errors = set()  # pieces that cannot be written
+
+    def piece_length(self, piece_index):
+        return BLOCK_SIZE * BLOCKS_PER_PIECE
+
+    def flush_block(self, piece_index, block_index, block):
+        self.blocks[(piece_index, block_index)] = block
+
+    def extract_piece(self, piece_index):
+        return b''.join(self.blocks[(piece_index, block_index)] for block_index in range(BLOCKS_PER_PIECE))
+
+    def flush_piece(self, piece_index, piece, callback, on_error):
+        if piece_index in self.invalid:
+            return False
+        if piece_index in self.write_errors:
+            on_error(OSError("disk full"))
+        else:
+            callback()
+        return True
+
+    def block_store(self):
+        return BlockStore()
+
+
+class Downloader:
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.choked = False
+        self.requests = {}
+        self.requests_lock = threading.Lock()
+        self.downloaded = 0
+        self.uploader_id = uuid.uuid4()
+        self.request_threads = []  # threads request_blocks() was called from
+        self.haves = []
+        self.cancels = []
+        scheduler.register(self)
+
+    def request_blocks(self):
+        self.request_threads.append(threading.current_thread())
+
+    def send_have(self, have):
+        self.haves.append(have['piece_index'])
+
+    def cancel(self, piece_index, begin, length):
+        self.cancels.append((piece_index, begin))
+
+
+def make_scheduler():
+    message = Message(uuid.uuid4(), '00' * 20)
+    message.init_bitfield(NUM_PIECES, None, BLOCKS_PER_PIECE)
+    return DownloadScheduler(Torrent(), message, FileManager())
+
+
+def receive(scheduler, downloader, block):
+    piece_index, block_index = block
+    scheduler.block_received(downloader, piece_index, block_index * BLOCK_SIZE, bytes([piece_index]) * BLOCK_SIZE)
+
+
+def wait_threads(scheduler):
+    scheduler._announcer.shutdown(wait=True)
+    scheduler._requester.shutdown(wait=True)
+
+
+def test_blocks_spread_over_connections():
+    scheduler = make_scheduler()
+    a, b = Downloader(scheduler), Downloader(scheduler)
+    scheduler.peer_bitfield(a, ALL_PIECES)
+    scheduler.peer_bitfield(b, ALL_PIECES)
+    blocks = [scheduler.next_block(a), scheduler.next_block(a), scheduler.next_block(b), scheduler.next_block(b)]
+    # a block is never requested twice outside end-game
+    assert len(set(blocks)) == 4
+    # a keeps downloading its piece while it has blocks that are not in flight
+    assert blocks[0][0] == blocks[1][0] != blocks[2][0]
+    assert not scheduler.end_game.active
+
+
+def test_piece_completed():
+    scheduler = make_scheduler()
+    a = Downloader(scheduler)
+    scheduler.peer_bitfield(a, bitarray('010'))
+    blocks = [scheduler.next_block(a), scheduler.next_block(a)]
+    assert blocks == [(1, 0), (1, 1)]
+    for block in blocks:
+        receive(scheduler, a, block)
+    wait_threads(scheduler)
+    assert scheduler.pieces_completed == 1
+    assert scheduler.message.is_piece_available(1)
+    assert a.haves == [1]
+    # the peer has no other piece we need
+    assert scheduler.next_block(a) is None
+
+
+def test_piece_failed():
+    scheduler = make_scheduler()
+    scheduler.file_manager.invalid.add(0)
+    a = Downloader(scheduler)
+    scheduler.peer_bitfield(a, bitarray('100'))
+    for _ in range(BLOCKS_PER_PIECE):
+        receive(scheduler, a, scheduler.next_block(a))
+    assert (scheduler.pieces_completed, scheduler.pieces_failed) == (0, 1)
+    assert scheduler.message.is_piece_missing(0)
+    # downloaded again
+    assert scheduler.next_block(a) == (0, 0)
+
+
+def test_write_failed():
+    scheduler = make_scheduler()
+    scheduler.file_manager.write_errors.add(2)
+    a, idle = Downloader(scheduler), Downloader(scheduler)
+    scheduler.peer_bitfield(a, bitarray('001'))
+    for _ in range(BLOCKS_PER_PIECE):
+        receive(scheduler, a, scheduler.next_block(a))
+    wait_threads(scheduler)
+    assert (scheduler.pieces_completed, scheduler.pieces_failed) == (0, 1)
+    assert scheduler.message.is_piece_missing(2)
+    assert not scheduler.message.is_piece_available(2)
+    assert a.haves == []
+    # the idle connections request the piece again from the requester thread
+    assert idle.request_threads and threading.current_thread() not in idle.request_threads
+
+
+def test_released_blocks_requested_again():
+    scheduler = make_scheduler()
+    choked, busy, idle = Downloader(scheduler), Downloader(scheduler), Downloader(scheduler)
+    scheduler.peer_bitfield(choked, bitarray('010'))
+    scheduler.peer_bitfield(busy, bitarray('100'))
+    scheduler.peer_bitfield(idle, bitarray('010'))
+    blocks = [scheduler.next_block(choked), scheduler.next_block(choked)]
+    busy.requests[scheduler.next_block(busy)] = None
+    assert scheduler.next_block(idle) is None  # every block of piece 1 is in flight
+    choked.choked = True
+    scheduler.release(choked, blocks)
+    wait_threads(scheduler)
+    # the busy connection takes the block with its next requests, from its own thread
+    assert busy.request_threads == []
+    assert idle.request_threads and threading.current_thread() not in idle.request_threads
+    assert choked.request_threads == []
+    assert scheduler.next_block(idle) == (1, 0)
+
+
+def test_end_game():
+    scheduler = make_scheduler()
+    a, b = Downloader(scheduler), Downloader(scheduler)
+    scheduler.peer_bitfield(a, ALL_PIECES)
+    scheduler.peer_bitfield(b, bitarray('001'))
+    blocks = []
+    block = scheduler.next_block(a)
+    while block is not None and not scheduler.end_game.active:
+        blocks.append(block)
+        block = scheduler.next_block(a)
+    assert len(blocks) == NUM_PIECES * BLOCKS_PER_PIECE
+    # every block is in flight: b requests again the blocks of the pieces its peer has
+    duplicate = scheduler.next_block(b)
+    assert scheduler.end_game.active and duplicate[0] == 2
+    receive(scheduler, b, duplicate)
+    assert a.cancels == [(duplicate[0], duplicate[1] * BLOCK_SIZE)]
+    receive(scheduler, a, duplicate)
+    assert scheduler.end_game.stats()['wasted-bytes'] == BLOCK_SIZE
+    wait_threads(scheduler)
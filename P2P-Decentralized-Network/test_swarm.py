@@ -0,0 +1,60 @@
+from swarm import SwarmRegistry
+
+INFO_HASH = b'\x01' * 20
+OTHER_INFO_HASH = b'\x02' * 20
+
+
+def test_add_and_counts():
+    swarms = SwarmRegistry(ttl=60)
+    swarms.add(INFO_HASH, b'a', '10.0.0.1', 5000, now=0)
+    swarms.add(INFO_HASH, b'b', '10.0.0.2', 5000, now=0, seeder=True)
+    assert swarms.counts(INFO_HASH, now=1) == (1, 1)
+    # announced again as a seeder
+    swarms.add(INFO_HASH, b'a', '10.0.0.3', 5001, now=1, seeder=True)
+    assert swarms.counts(INFO_HASH, now=1) == (2, 0)
+    peer = swarms.get(INFO_HASH, b'a')
+    assert (peer.ip, peer.port) == ('10.0.0.3', 5001)
+
+
+def test_expiry():
+    swarms = SwarmRegistry(ttl=60)
+    swarms.add(INFO_HASH, b'a', '10.0.0.1', 5000, now=0)
+    swarms.add(INFO_HASH, b'b', '10.0.0.2', 5000, now=0)
+    # announced again, so it expires later
+    swarms.add(INFO_HASH, b'b', '10.0.0.2', 5000, now=50)
+    assert swarms.expire(now=59) == 0
+    assert swarms.expire(now=60) == 1
+    assert swarms.get(INFO_HASH, b'a') is None
+    assert swarms.get(INFO_HASH, b'b') is not None
+    assert swarms.expire(now=110) == 1
+    assert swarms.size(INFO_HASH) == 0
+    assert swarms.counts(INFO_HASH, now=110) == (0, 0)
+
+
+def test_sample():
+    swarms = SwarmRegistry(ttl=60)
+    for i in range(20):
+        swarms.add(INFO_HASH, i, '10.0.0.%d' % i, 5000, now=i)
+    sample = swarms.sample(INFO_HASH, 5, now=20)
+    assert len(sample) == 5
+    assert len({peer.peer_id for peer in sample}) == 5
+    assert len(swarms.sample(INFO_HASH, 50, now=20)) == 20
+    # the peers announced at 0..9 expired
+    assert {peer.peer_id for peer in swarms.sample(INFO_HASH, 50, now=69)} == set(range(10, 20))
+    assert swarms.sample(OTHER_INFO_HASH, 5, now=69) == []
+
+
+def test_remove():
+    swarms = SwarmRegistry(ttl=60)
+    for i in range(3):
+        swarms.add(INFO_HASH, i, '10.0.0.%d' % i, 5000, now=0)
+    swarms.add(OTHER_INFO_HASH, 0, '10.0.0.0', 5000, now=0)
+    assert swarms.remove(INFO_HASH, 1)
+    assert not swarms.remove(INFO_HASH, 1)
+    # the last peer took the place of the peer removed
+    assert swarms.get(INFO_HASH, 2).peer_id == 2
+    assert swarms.remove_peer(0) == 2
+    assert len(swarms) == 1
+    # the expiry times of the removed peers are skipped
+    assert swarms.expire(now=60) == 1
+    assert len(swarms) == 0
@@ -0,0 +1,63 @@
+import hashlib
+
+import bencodepy
+
+from torrent import Torrent
+
+
+def write_torrent(tmp_path, info, **metainfo):
+    torrent_path = tmp_path / "test.torrent"
+    torrent_path.write_bytes(bencodepy.encode(dict(metainfo, info=info)))
+    return str(torrent_path)
+
+
+def test_info_hash():
+    torrent = Torrent('age.torrent')
+    with open('age.torrent', "rb") as file:
+        info = bencodepy.decode(file.read())[b'info']
+    assert torrent.info_hash == hashlib.sha1(bencodepy.encode(info)).digest()
+    assert torrent.create_info_hash() == torrent.info_hash.hex()
+
+
+def test_info_hash_from_raw_bytes(tmp_path):
+    info = {'length': 10, 'name': 'a.txt', 'piece length': 16, 'pieces': b'\x00' * 20,
+            'nested': {'list': [1, b'e', {'i': -1}]}}
+    torrent_path = write_torrent(tmp_path, info, announce='udp://127.0.0.1:1337/announce',
+                                 **{'z-last': [b'd', 0]})
+    with open(torrent_path, "rb") as file:
+        raw_data = file.read()
+    encoded_info = bencodepy.encode(info)
+    # the info hash is taken from the bytes of the file, whatever the keys around the info section
+    assert encoded_info in raw_data
+    assert Torrent(torrent_path).info_hash == hashlib.sha1(encoded_info).digest()
+
+
+def test_validate_hash_info():
+    torrent = Torrent('age.torrent')
+    assert torrent.validate_hash_info(torrent.create_info_hash())
+    assert torrent.validate_hash_info(torrent.info_hash)
+    assert torrent.validate_hash_info(bytearray(torrent.info_hash))
+    assert not torrent.validate_hash_info('00' * 20)
+    assert not torrent.validate_hash_info(b'\x00' * 20)
+    assert not torrent.validate_hash_info(None)
+
+
+def test_piece_hashes(tmp_path):
+    data = bytes(range(40))
+    hashes = [hashlib.sha1(data[i:i + 16]).digest() for i in range(0, len(data), 16)]
+    info = {'length': len(data), 'name': 'a.txt', 'piece length': 16, 'pieces': b''.join(hashes)}
+    torrent = Torrent(write_torrent(tmp_path, info))
+    assert torrent.num_pieces() == 3
+    assert torrent.pieces() == b''.join(hashes)
+    assert bytes(torrent.piece(2)) == hashes[2]
+    assert torrent.verify_piece(2, data[32:])
+    assert torrent.verify_piece(0, memoryview(data)[:16])
+    assert not torrent.verify_piece(1, data[:16])
+
+
+def test_piece_hashes_age_torrent():
+    torrent = Torrent('age.torrent')
+    with open('age.torrent', "rb") as file:
+        pieces = bencodepy.decode(file.read())[b'info'][b'pieces']
+    assert torrent.pieces() == pieces
+    assert torrent.num_pieces() == len(pieces) // Torrent.PIECE_HASH_SIZE
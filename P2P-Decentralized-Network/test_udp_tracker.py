@@ -0,0 +1,104 @@
+import socket
+import struct
+
+import pytest
+
+from tracker import Tracker
+from udp_tracker import UDPTracker
+
+INFO_HASH = b'\x01' * 20
+NOW = 1000000.0
+
+
+@pytest.fixture
+def tracker():
+    return UDPTracker(interval=60)
+
+
+def connect(tracker, addr, now=NOW):
+    response = tracker.process_request(
+        UDPTracker.CONNECT_REQUEST.pack(UDPTracker.PROTOCOL_ID, UDPTracker.CONNECT, 7), addr, now)
+    action, transaction_id, connection_id = UDPTracker.CONNECT_RESPONSE.unpack(response)
+    assert (action, transaction_id) == (UDPTracker.CONNECT, 7)
+    return connection_id
+
+
+def announce(tracker, addr, peer_id, left=10, event=UDPTracker.STARTED, ip=0, num_want=-1, connection_id=None,
+             now=NOW):
+    if connection_id is None:
+        connection_id = connect(tracker, addr, now)
+    request = UDPTracker.ANNOUNCE_REQUEST.pack(connection_id, UDPTracker.ANNOUNCE, 8, INFO_HASH, peer_id,
+                                               0, left, 0, event, ip, 0, num_want, addr[1])
+    return tracker.process_request(request, addr, now)
+
+
+def parse_announce(response):
+    action, transaction_id, interval, leechers, seeders = UDPTracker.ANNOUNCE_RESPONSE.unpack_from(response)
+    assert (action, transaction_id) == (UDPTracker.ANNOUNCE, 8)
+    return interval, leechers, seeders, Tracker.decode_peers(response[UDPTracker.ANNOUNCE_RESPONSE.size:])
+
+
+def test_connect_requires_protocol_id(tracker):
+    assert tracker.process_request(UDPTracker.CONNECT_REQUEST.pack(0, UDPTracker.CONNECT, 7), ('1.2.3.4', 1), NOW) \
+        is None
+    assert tracker.process_request(b'\x00' * 8, ('1.2.3.4', 1), NOW) is None
+
+
+def test_connection_id(tracker):
+    addr = ('1.2.3.4', 6881)
+    connection_id = connect(tracker, addr)
+    assert tracker.valid_connection_id(connection_id, addr, NOW + UDPTracker.CONNECTION_ID_LIFETIME)
+    assert not tracker.valid_connection_id(connection_id, addr, NOW + 2 * UDPTracker.CONNECTION_ID_LIFETIME)
+    assert not tracker.valid_connection_id(connection_id, ('1.2.3.4', 6882), NOW)
+    response = announce(tracker, ('1.2.3.5', 6881), b'a' * 20, connection_id=connection_id)
+    action, transaction_id = UDPTracker.RESPONSE_HEADER.unpack_from(response)
+    assert (action, transaction_id) == (UDPTracker.ERROR, 8)
+
+
+def test_announce(tracker):
+    interval, leechers, seeders, peers = parse_announce(announce(tracker, ('1.2.3.4', 6881), b'a' * 20))
+    assert 54 <= interval <= 66
+    assert (leechers, seeders, peers) == (1, 0, [])
+    _, leechers, seeders, peers = parse_announce(announce(tracker, ('1.2.3.5', 6881), b'b' * 20, left=0))
+    assert (leechers, seeders, peers) == (1, 1, [('1.2.3.4', 6881)])
+    _, _, _, peers = parse_announce(announce(tracker, ('1.2.3.4', 6881), b'a' * 20, event=UDPTracker.NONE))
+    assert peers == [('1.2.3.5', 6881)]
+    _, _, _, peers = parse_announce(announce(tracker, ('1.2.3.6', 6881), b'c' * 20, num_want=1))
+    assert len(peers) == 1
+
+
+def test_announce_stopped(tracker):
+    announce(tracker, ('1.2.3.4', 6881), b'a' * 20)
+    _, leechers, seeders, peers = parse_announce(
+        announce(tracker, ('1.2.3.4', 6881), b'a' * 20, event=UDPTracker.STOPPED))
+    assert (leechers, seeders, peers) == (0, 0, [])
+
+
+def test_announce_ip_field(tracker):
+    ip = struct.unpack("!I", socket.inet_aton('8.8.8.8'))[0]
+    # any client could add another host to the swarm, so its own address is used
+    announce(tracker, ('1.2.3.4', 6881), b'a' * 20, ip=ip)
+    assert tracker.swarms.get(INFO_HASH, b'a' * 20).ip == '1.2.3.4'
+    announce(tracker, ('127.0.0.1', 6881), b'b' * 20, ip=ip)
+    assert tracker.swarms.get(INFO_HASH, b'b' * 20).ip == '8.8.8.8'
+    tracker.trusted_ips.add('1.2.3.5')
+    announce(tracker, ('1.2.3.5', 6881), b'c' * 20, ip=ip)
+    assert tracker.swarms.get(INFO_HASH, b'c' * 20).ip == '8.8.8.8'
+
+
+def test_scrape(tracker):
+    announce(tracker, ('1.2.3.4', 6881), b'a' * 20)
+    announce(tracker, ('1.2.3.5', 6881), b'b' * 20, left=0)
+    announce(tracker, ('1.2.3.5', 6881), b'b' * 20, left=0, event=UDPTracker.COMPLETED)
+    addr = ('1.2.3.6', 6881)
+    request = UDPTracker.HEADER.pack(connect(tracker, addr), UDPTracker.SCRAPE, 9) + INFO_HASH + b'\x02' * 20
+    response = tracker.process_request(request, addr, NOW)
+    assert UDPTracker.RESPONSE_HEADER.unpack_from(response) == (UDPTracker.SCRAPE, 9)
+    entries = list(UDPTracker.SCRAPE_ENTRY.iter_unpack(response[UDPTracker.RESPONSE_HEADER.size:]))
+    assert entries == [(1, 1, 1), (0, 0, 0)]
+
+
+def test_unknown_action(tracker):
+    addr = ('1.2.3.4', 6881)
+    response = tracker.process_request(UDPTracker.HEADER.pack(connect(tracker, addr), 9, 10), addr, NOW)
+    assert UDPTracker.RESPONSE_HEADER.unpack_from(response) == (UDPTracker.ERROR, 10)
@@ -0,0 +1,60 @@
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from bitarray import bitarray
+
+from custom_exception import ProtocolException
+from message import Message
+from rate_limiter import RateLimiter
+from torrent import Torrent
+from uploader import Uploader
+
+
+@pytest.fixture
+def uploader():
+    torrent = Torrent('age.torrent')
+    message = Message(uuid.uuid4(), torrent.create_info_hash())
+    completed = bitarray(torrent.num_pieces())
+    completed.setall(False)
+    completed[0] = True
+    message.init_bitfield(torrent.num_pieces(), completed)
+    server = SimpleNamespace(piece_cache=None, listen_ports={}, message=message, pex=None,
+                             upload_limiter=RateLimiter(0), download_limiter=RateLimiter(0),
+                             add_uploaded=lambda num_bytes: None)
+    uploader = Uploader(uuid.uuid4(), server, None, ('127.0.0.1', 5001), torrent)
+    yield uploader
+    uploader.close()
+
+
+def request(index, begin=0, length=2048):
+    return {'id': Message.REQUEST, 'index': index, 'begin': begin, 'length': length}
+
+
+def test_serves_available_piece(uploader):
+    responses = uploader._handle_received(request(0, 2048))
+    assert len(responses) == 1
+    assert (responses[0]['id'], responses[0]['index'], responses[0]['begin']) == (Message.PIECE, 0, 2048)
+    assert responses[0]['file_offset'] == 2048
+    assert uploader.uploaded == 2048
+
+
+def test_drops_request_for_missing_piece(uploader):
+    # the connection stays open, only the request is dropped
+    assert uploader._handle_received(request(1)) == []
+    assert uploader.requests_dropped == 1
+    assert uploader.uploaded == 0
+    assert len(uploader._handle_received(request(0))) == 1
+
+
+def test_rejects_request_out_of_bounds(uploader):
+    with pytest.raises(ProtocolException):
+        uploader._handle_received(request(0, begin=uploader.file_manager.piece_size))
+    with pytest.raises(ProtocolException):
+        uploader._handle_received(request(uploader.torrent.num_pieces()))
+
+
+def test_requests_dropped_while_choked(uploader):
+    uploader.choked = True
+    assert uploader._handle_received(request(0)) == []
+    assert not uploader.requests
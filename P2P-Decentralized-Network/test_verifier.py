@@ -0,0 +1,62 @@
+import hashlib
+
+from bitarray import bitarray
+
+from verifier import PieceVerifier
+
+PIECE_LENGTH = 16
+NUM_PIECES = 10
+
+
+class Torrent:
+    def __init__(self, data):
+        self.hashes = [hashlib.sha1(data[i:i + PIECE_LENGTH]).digest() for i in range(0, len(data), PIECE_LENGTH)]
+        self.verified = []
+
+    def num_pieces(self):
+        return len(self.hashes)
+
+    def piece_length(self):
+        return PIECE_LENGTH
+
+    def verify_piece(self, piece_index, piece):
+        self.verified.append(piece_index)
+        return hashlib.sha1(piece).digest() == self.hashes[piece_index]
+
+
+def make_file(tmp_path):
+    # the last piece is shorter
+    data = bytes(range(256))[:PIECE_LENGTH * NUM_PIECES - 5]
+    file_path = tmp_path / "age.txt"
+    file_path.write_bytes(data)
+    return Torrent(data), str(file_path)
+
+
+def test_verify_all(tmp_path):
+    torrent, file_path = make_file(tmp_path)
+    with open(file_path, "r+b") as file:
+        file.seek(3 * PIECE_LENGTH)
+        file.write(b'\xff')
+    progress = []
+    # 3 pieces per read, 2 workers
+    verifier = PieceVerifier(torrent, file_path, workers=2)
+    verifier.pieces_per_read = 3
+    bitfield = verifier.verify(progress=lambda done, total: progress.append((done, total)))
+    assert bitfield.tolist() == [True] * 3 + [False] + [True] * 6
+    assert progress[-1] == (NUM_PIECES, NUM_PIECES)
+    assert [done for done, _ in progress] == sorted(done for done, _ in progress)
+
+
+def test_verify_some(tmp_path):
+    torrent, file_path = make_file(tmp_path)
+    pieces = bitarray(NUM_PIECES)
+    pieces.setall(False)
+    pieces[1] = pieces[9] = True
+    bitfield = PieceVerifier(torrent, file_path).verify(pieces)
+    assert bitfield == pieces
+    assert sorted(torrent.verified) == [1, 9]
+
+
+def test_missing_file(tmp_path):
+    torrent, _ = make_file(tmp_path)
+    assert not PieceVerifier(torrent, str(tmp_path / "missing.txt")).verify().any()
@@ -2,32 +2,90 @@ import torrent_parser as tp
 from config import Config
 
 import hashlib
+import hmac
+import io
 
 class Torrent:
+    PIECE_HASH_SIZE = 20  # bytes of a SHA1 digest
 
     def __init__(self, torrent_path):
         self.torrent_path = torrent_path
-        self.torrent_data = tp.parse_torrent_file(torrent_path)
+        with open(torrent_path, "rb") as file:
+            raw_data = file.read()
+        self.torrent_data = tp.TorrentFileParser(io.BytesIO(raw_data)).parse()
         self.config = Config()
+        # the info hash is computed once, from the exact bencoded info section found in the file
+        info_start, info_end = self._value_span(raw_data, 0, b'info')
+        self.info_hash = self._hash_torrent_info(raw_data[info_start:info_end])  # raw 20 bytes
+        self.info_hash_hex = self.info_hash.hex()
+        # the piece hashes are kept as one contiguous buffer of 20 bytes SHA1 digests, split from the
+        # bencoded info section
+        pieces_start, pieces_end = self._value_span(raw_data, info_start, b'pieces')
+        self._pieces = raw_data[raw_data.index(b':', pieces_start) + 1:pieces_end]
+        self._piece_hashes = memoryview(self._pieces)
+        self._num_pieces = len(self._pieces) // self.PIECE_HASH_SIZE
 
     def _hash_torrent_info(self, torrent_info):
         """
         Hash the torrent info from the meta-info in the torrent file.
-        :param torrent_info:
-        :return: the
+        :param torrent_info: the bencoded info section
+        :return: the SHA1 digest (20 bytes)
         """
         sha1 = hashlib.sha1()
         sha1.update(torrent_info)
-        return sha1.hexdigest()
+        return sha1.digest()
+
+    def _value_span(self, raw_data, dict_start, key):
+        """
+        Finds a bencoded value of a dictionary in the torrent file without a decode-encode roundtrip
+        :param raw_data: the bytes of the torrent file
+        :param dict_start: the offset of the dictionary (i.e 0 for the metainfo dictionary)
+        :param key: the key of the value (bytes)
+        :return: the start and end offsets of the value
+        """
+        encoded_key = b'%d:%s' % (len(key), key)
+        index = dict_start + 1  # skips the 'd' of the dictionary
+        while raw_data[index:index + 1] != b'e':
+            key_end = self._bencode_end(raw_data, index)
+            value_end = self._bencode_end(raw_data, key_end)
+            if raw_data[index:key_end] == encoded_key:
+                return key_end, value_end
+            index = value_end
+        raise ValueError("%s not found in %s" % (key.decode(), self.torrent_path))
+
+    @staticmethod
+    def _bencode_end(raw_data, index):
+        """
+        :param raw_data: bencoded data
+        :param index: offset where a bencoded value starts
+        :return: the offset right after the end of that value
+        """
+        depth = 0
+        while True:
+            token = raw_data[index:index + 1]
+            if token in (b'd', b'l'):
+                depth += 1
+                index += 1
+            elif token == b'e':
+                depth -= 1
+                index += 1
+            elif token == b'i':
+                index = raw_data.index(b'e', index) + 1
+            elif token.isdigit():
+                colon = raw_data.index(b':', index)
+                index = colon + 1 + int(raw_data[index:colon])
+            else:
+                raise ValueError("invalid bencoded data at offset %d" % index)
+            if depth == 0:
+                return index
 
     def create_info_hash(self):
         """
-        Creates the torrent info hash (SHA1) from the info section in the torrent file
-        :return:
+        Returns the torrent info hash (SHA1) of the info section in the torrent file.
+        It is computed once when the torrent is loaded.
+        :return: the info hash (hex)
         """
-        torrent_info = self.torrent_data['info']
-        hash_info = self._hash_torrent_info(str(torrent_info).encode())
-        return hash_info  # returns the info hash
+        return self.info_hash_hex
 
     def announce(self):
         return self.torrent_data['announce']
@@ -61,32 +119,58 @@ class Torrent:
         return self.torrent_data['info']['length']
 
     def num_pieces(self):
-        return len(self.torrent_data['info']['pieces'])
+        return self._num_pieces
 
     def pieces(self):
-        return self.torrent_data['info']['pieces']
+        """
+        :return: the piece hashes, packed as 20 bytes SHA1 digests one after the other (bytes)
+        """
+        return self._pieces
 
     def piece(self, index):
-        return self.pieces()[index]
+        """
+        :param index: the piece index
+        :return: the raw SHA1 digest of the piece (memoryview of 20 bytes, no copy)
+        """
+        start = index * self.PIECE_HASH_SIZE
+        return self._piece_hashes[start:start + self.PIECE_HASH_SIZE]
+
+    def verify_piece(self, index, piece):
+        """
+        Validates a piece with its hash from the torrent file
+        :param index: the piece index
+        :param piece: the piece data (bytes-like)
+        :return: True if the piece is valid. Otherwise, returns False
+        """
+        return hashlib.sha1(piece).digest() == self.piece(index)
 
     def piece_length(self):
         return self.torrent_data['info']['piece length']
 
     def validate_hash_info(self, info_hash):
-        return self.create_info_hash() == info_hash
+        """
+        Compares an info hash sent by another peer with the info hash of this torrent in constant time
+        :param info_hash: the info hash (hex or raw 20 bytes)
+        :return: True if the info hashes are equal. Otherwise, returns False
+        """
+        if isinstance(info_hash, str):
+            return hmac.compare_digest(info_hash.encode(), self.info_hash_hex.encode())
+        if isinstance(info_hash, (bytes, bytearray)):
+            return hmac.compare_digest(bytes(info_hash), self.info_hash)
+        return False
 
     def path_to_temp(self):
         torrent_path = self.torrent_path
         file = torrent_path.split('/')
         file_name = file[-1].split('.')[0]
-        tmp_path = self.config.get_value("resources", "tmp-files")
+        tmp_path = self.config.snapshot().resources.tmp_files
         return tmp_path + file_name + ".tmp"
 
     def path_to_tmp_blocks(self):
-        return self.config.get_value("resources", "tmp-blocks")
+        return self.config.snapshot().resources.tmp_blocks
 
     def piece_size(self):
-        return int(self.config.get_value("sizes", "piece-size"))
+        return self.config.snapshot().sizes.piece_size
 
     def block_size(self):
-        return int(self.config.get_value("sizes", "block-size"))
\ No newline at end of file
+        return self.config.snapshot().sizes.block_size
\ No newline at end of file
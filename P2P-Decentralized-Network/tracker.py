@@ -1,14 +1,46 @@
 from server import Server
+from krpc import KRPCEndpoint, KRPCProtocol
+from routing_table import RoutingTable, NodeLookup
+from swarm import SwarmRegistry
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
 import socket
+import struct
 import threading
+import time
+import uuid
 import bencodepy
 
 
 class Tracker:
+    """
+    DHT node of a peer (Kademlia, KRPC messages as in BEP 5)
+    Nodes are identified by 160-bit ids and kept in the k-buckets of a RoutingTable. A node answers the
+    queries ping, find_node (the nodes closest to a target), get_peers (the peers of an info hash, and the
+    nodes closest to it) and announce_peer (stores the sender as a peer of an info hash).
+    All the messages go through a KRPCEndpoint on the bound DHT socket, which matches the responses to the
+    queries in flight by transaction id, so the lookups and the queries received run concurrently.
+    The announcing peer bootstraps its routing table with a ping broadcast, then looks up the peers of the
+    torrent with an iterative get_peers lookup (see NodeLookup), and announces itself to the closest nodes.
+    USAGE: tracker = Tracker(server, torrent, announce)
+           threading.Thread(target=tracker.run).start()
+           tracker.started.wait(timeout)  # the first lookup is done
+           peers = Tracker.decode_peers(tracker.get_DHT())  # [(ip, port), ...] of the peers of the torrent
+           nodes = tracker.find_node(target)  # the nodes closest to a target
+    """
     DHT_PORT = 6000
     SELF_PORT = 6000  # Change port for other peers
+    BOOTSTRAP_TIMEOUT = 1  # seconds waiting for answers to the ping broadcast
+    BOOTSTRAP_RETRIES = 5
+    TOKEN_INTERVAL = 5 * 60  # seconds between rotations of the announce_peer token secret
+    ANNOUNCE_INTERVAL = 15 * 60  # seconds between announces, less than the TTL of the swarm registry
+    MAX_VALUES = 100  # max peers in a get_peers response, so it fits in a single datagram
+    # compact formats (BEP 23, BEP 5): ipv4 address and port of a peer, node id, ipv4 address and port of a node
+    COMPACT_PEER = struct.Struct("!4sH")  # 6 bytes
+    COMPACT_NODE = struct.Struct("!20s4sH")  # 26 bytes
 
     ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in tracker.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
 
@@ -22,12 +54,20 @@ class Tracker:
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self.udp_socket.bind(("", self.SELF_PORT))
-        # will story a list of dictionaries representing entries in the routing table
-        # dictionaries stored here are in the following form
-        # {'nodeID': '<the node id is a SHA1 hash of the ip_address and port of the server node and a random uuid>',
-        #  'ip_address': '<the ip address of the node>', 'port': '<the port number of the node',
-        #  'info_hash': '<the info hash from the torrent file>', last_changed': 'timestamp'}
-        self._routing_table = []
+        # the node id is a SHA1 hash of the ip_address and port of the server node and a random uuid
+        self.node_id = hashlib.sha1(("%s/%s/%s" % (self.server.server_ip_address, self.server.server_port,
+                                                   uuid.uuid4())).encode()).digest()
+        self._routing_table = RoutingTable(self.node_id)
+        # peers announced to this node, by info hash (raw 20 bytes) and peer id
+        self.swarms = SwarmRegistry()
+        self._found_peers = []  # peers of the torrent found by the last get_peers lookup
+        # set once the node is bootstrapped and the first lookup is done, or once it failed. The peers found
+        # by get_DHT() may be none: this peer can be alone in the network
+        self.started = threading.Event()
+        self._token_secrets = [os.urandom(20), os.urandom(20)]  # current and previous secret
+        self._token_rotated = time.monotonic()
+        self.endpoint = KRPCEndpoint(self.udp_socket, self.encode, self.decode, self.process_query,
+                                     self._process_response)
 
     def _get_torrent_info_hash(self):
         """
@@ -37,85 +77,251 @@ class Tracker:
 
     def add_peer_to_swarm(self, peer_id, peer_ip, peer_port):
         """
-        TODO: when a peers connects to the network adds this peer
-              to the list of peers connected
+        When a peers connects to the network adds this peer to the swarm of the torrent, or refreshes
+        its entry. The peer expires after SwarmRegistry.TTL seconds unless it is added again.
         :param peer_id:
         :param peer_ip:
-        :param peer_port:
-        :return:
+        :param peer_port: the server port of the peer
+        :return: VOID
         """
-        pass  # your code here
+        self.swarms.add(self.torrent.info_hash, peer_id, peer_ip, int(peer_port))
 
     def remove_peer_from_swarm(self, peer_id):
         """
-        TODO: removes a peer from the swarm when it disconnects from the network
-              Note: this method needs to handle exceptions when the peer disconnected abruptly without
-              notifying the network (i.e internet connection dropped...)
+        Removes a peer from the swarms when it disconnects from the network
+        Note: the peers that disconnected abruptly without notifying the network (i.e internet connection
+        dropped...) are removed by the swarm registry once their TTL expires
         :param peer_id:
-        :return:
+        :return: True if the peer was in a swarm
         """
-        pass  # your code here
+        return self.swarms.remove_peer(peer_id) > 0
 
     def broadcast(self, message, self_broadcast_enabled=False):
-        try:
-            encoded_message = self.encode(message)
-            self.udp_socket.sendto(
-                encoded_message, ('<broadcast>', self.DHT_PORT))
-            print("Message broadcast.....")
-        except socket.error as error:
-            print(error)
+        self.endpoint.send(message, ('<broadcast>', self.DHT_PORT))
+        print("Message broadcast.....")
 
     def send_udp_message(self, message, ip, port):
-        try:
-            new_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            message = self.encode(message)
-            new_socket.sendto(message, (ip, port))
-        except:
-            print("error")
+        """
+        Sends a message from the DHT socket, so the receiver sees the DHT port of this node
+        """
+        self.endpoint.send(message, (ip, port))
 
     def broadcast_listerner(self):
+        """
+        Runs the DHT endpoint: answers the queries received, and receives the responses of the queries sent
+        :return: VOID
+        """
         try:
-            print("Listening at DHT port: ", self.DHT_PORT)
-            while True:
-                raw_data, sender_ip_and_port = self.udp_socket.recvfrom(4096)
-                if raw_data:
-                    data = self.decode(raw_data)
-                    ip_sender = sender_ip_and_port[0]
-                    port_sender = sender_ip_and_port[1]
-                    print("data received by sender",
-                          data, ip_sender, port_sender)
-                    if not self.announce:
-                        self.process_query(data, ip_sender, port_sender)
-                    else:
-                        self._routing_table = data
-                    exit(1)
-
+            print("Listening at DHT port: ", self.SELF_PORT)
+            self.endpoint.run()
         except Exception as ex:
             print(self.ERROR_TEMPLATE.format(
                 "broadcast_listerner()", type(ex).__name__, ex.args))
 
+    def _process_response(self, data, ip_sender, port_sender):
+        # responses that match no query in flight, i.e answers to the ping broadcast
+        if data.get("y") == "r" and isinstance(data.get("r"), dict):
+            self._routing_table.add(self._raw(data["r"].get("id", b"")), ip_sender, port_sender)
+
     def process_query(self, data, ip_sender, port_sender):
         """
-        TODO: process an incoming query from a node
-        :return: the response
+        Processes an incoming query from a node
+        :param data: the query (decoded)
+        :param ip_sender:
+        :param port_sender:
+        :return: the response, or None if the query came from this node
         """
         query = data.get("q")
-        r = None
+        t = data.get("t", b"")
+        try:
+            a = data["a"]
+            node_id = self._raw(a["id"])
+            if node_id == self.node_id:
+                return None
+            r = {"id": self.node_id}
+            # queries are sent from the DHT socket of the node, so the sender is a node of the DHT
+            self._routing_table.add(node_id, ip_sender, port_sender)
+            if query == "ping":
+                pass
+            elif query == "find_node":
+                r["nodes"] = self.encode_nodes(self._routing_table.closest(self._raw(a["target"])))
+            elif query == "get_peers":
+                info_hash = self._raw(a["info_hash"])
+                r["token"] = self._token(ip_sender)
+                r["nodes"] = self.encode_nodes(self._routing_table.closest(info_hash))
+                values = self.encode_peers(self._swarm_addresses(info_hash, self.MAX_VALUES))
+                if values:
+                    # a list of 6 bytes strings, one per peer
+                    r["values"] = [values[i:i + self.COMPACT_PEER.size]
+                                   for i in range(0, len(values), self.COMPACT_PEER.size)]
+            elif query == "announce_peer":
+                if not self._valid_token(self._raw(a["token"]), ip_sender):
+                    return {"t": t, "y": "e", "e": [203, "Bad token"]}
+                # the node id of the announcing node is its peer id in the swarm
+                self.swarms.add(self._raw(a["info_hash"]), node_id, ip_sender, int(a["port"]))
+            else:
+                return {"t": t, "y": "e", "e": [204, "Method Unknown"]}
+            return {"t": t, "y": "r", "r": r}
+        except (KeyError, TypeError, ValueError) as ex:
+            print(self.ERROR_TEMPLATE.format(
+                "process_query()", type(ex).__name__, ex.args))
+            return {"t": t, "y": "e", "e": [203, "Protocol Error"]}
+
+    def query(self, ip, port, q, a, timeout=KRPCProtocol.TIMEOUT, retries=KRPCProtocol.RETRIES):
+        """
+        Sends a query to a node and waits for its response
+        :param ip:
+        :param port: the DHT port of the node
+        :param q: the query name (i.e find_node)
+        :param a: the query arguments, without the id of this node
+        :param timeout: seconds before the query is sent again
+        :param retries: times the query is sent again
+        :return: the response dictionary ("r"), or None if the node did not answer or answered an error
+        """
+        message = {"y": "q", "q": q, "a": dict(a, id=self.node_id)}
+        data = self.endpoint.query(message, (ip, port), timeout, retries)
+        r = data.get("r") if data is not None and data.get("y") == "r" else None
+        return r if isinstance(r, dict) else None
+
+    def _lookup(self, q, a, target):
+        """
+        Iterative lookup of a target, see NodeLookup
+        :return: the closest nodes that responded, the peers found, and the tokens of the nodes (get_peers)
+        """
+        tokens = {}
+
+        def query(node):
+            r = self.query(node.ip, node.port, q, a)
+            if r is None:
+                self._routing_table.failed(node.id)
+                return None
+            self._routing_table.add(node.id, node.ip, node.port)
+            if "token" in r:
+                tokens[node.id] = self._raw(r["token"])
+            nodes = [node for node in self.decode_nodes(self._raw(r.get("nodes", b""))) if node[0] != self.node_id]
+            values = r.get("values", [])
+            return nodes, self.decode_peers(b"".join(self._raw(value) for value in values
+                                                     if isinstance(value, (str, bytes))))
+
+        lookup = NodeLookup(self._routing_table.closest(target), target, query)
+        nodes, peers = lookup.run()
+        return nodes, peers, tokens
+
+    def find_node(self, target):
+        """
+        Looks up the nodes of the DHT closest to a target
+        :param target: a node id (raw 20 bytes)
+        :return: list of the closest nodes (see routing_table.Node), closest first
+        """
+        nodes, _, _ = self._lookup("find_node", {"target": target}, target)
+        return nodes
+
+    def get_peers(self, info_hash=None, announce=True):
+        """
+        Looks up the peers of an info hash, and announces this peer to the closest nodes
+        :param info_hash: raw 20 bytes. By default, the info hash of the torrent
+        :param announce: True to send announce_peer to the closest nodes
+        :return: list of (ip, port) of the peers found
+        """
+        info_hash = info_hash or self.torrent.info_hash
+        nodes, peers, tokens = self._lookup("get_peers", {"info_hash": info_hash}, info_hash)
+        if announce:
+            nodes = [node for node in nodes if node.id in tokens]
+            args = {"info_hash": info_hash, "port": self.server.server_port}
+            with ThreadPoolExecutor(max_workers=NodeLookup.ALPHA) as executor:
+                for node in nodes:
+                    executor.submit(self.query, node.ip, node.port, "announce_peer",
+                                    dict(args, token=tokens[node.id]))
+        if info_hash == self.torrent.info_hash:
+            self._found_peers = peers
+        return peers
 
-        # Response = {"t": "aa", "y": "r", "r": {"id": "mnopqrstuvwxyz123456"}}
-        if query == "ping":
-            print("ping Query: \n" + str(data) + "\n")
-            # r = {"id": self.encode(self._server.host)}
-            if self.torrent.validate_hash_info(self.decode(data["a"]["id"])):
-                # Harcode ip address to be localhost for testing
-                # self._routing_table = [str(ip_sender) + "/" + str(port_sender)]
-                self._routing_table = [
-                    "127.0.0.1" + "/" + str(self.server.server_port)]
-                print("Hashed info data matches!...")
-                self.send_udp_message(self._routing_table, ip_sender, port_sender)
+    def _swarm_addresses(self, info_hash, count):
+        """
+        :return: list of (ip, port) of up to count random peers of a swarm, this peer first if it shares
+                 the info hash
+        """
+        own = [self._server_address()] if info_hash == self.torrent.info_hash else []
+        peers = self.swarms.sample(info_hash, max(count - len(own), 0))
+        return own + [(peer.ip, peer.port) for peer in peers]
+
+    def _server_address(self):
+        return self.server.server_ip_address, int(self.server.server_port)
+
+    def _token(self, ip):
+        """
+        :return: the token a node must send back in announce_peer, bound to its ip address
+        """
+        if time.monotonic() - self._token_rotated > self.TOKEN_INTERVAL:
+            self._token_secrets = [os.urandom(20), self._token_secrets[0]]
+            self._token_rotated = time.monotonic()
+        return hashlib.sha1(self._token_secrets[0] + ip.encode()).digest()[:8]
+
+    def _valid_token(self, token, ip):
+        self._token(ip)  # rotates the secret if needed
+        return any(hashlib.sha1(secret + ip.encode()).digest()[:8] == token for secret in self._token_secrets)
+
+    @classmethod
+    def encode_peers(cls, peers):
+        """
+        :param peers: list of (ip, port)
+        :return: the compact peer list, 6 bytes per peer. Peers that are not ipv4 addresses are skipped
+        """
+        compact = bytearray()
+        for ip, port in peers:
+            try:
+                compact += cls.COMPACT_PEER.pack(socket.inet_aton(ip), int(port))
+            except (OSError, struct.error, ValueError):
+                continue
+        return bytes(compact)
+
+    @classmethod
+    def decode_peers(cls, compact):
+        """
+        :param compact: a compact peer list (a trailing partial entry is ignored)
+        :return: list of (ip, port)
+        """
+        compact = compact[:len(compact) - len(compact) % cls.COMPACT_PEER.size]
+        return [(socket.inet_ntoa(ip), port) for ip, port in cls.COMPACT_PEER.iter_unpack(compact)]
+
+    @classmethod
+    def encode_nodes(cls, nodes):
+        """
+        :param nodes: list of routing_table.Node
+        :return: the compact node list, 26 bytes per node
+        """
+        compact = bytearray()
+        for node in nodes:
+            try:
+                compact += cls.COMPACT_NODE.pack(node.id, socket.inet_aton(node.ip), node.port)
+            except (OSError, struct.error):
+                continue
+        return bytes(compact)
 
+    @classmethod
+    def decode_nodes(cls, compact):
+        """
+        :param compact: a compact node list (a trailing partial entry is ignored)
+        :return: list of (node id, ip, port)
+        """
+        compact = compact[:len(compact) - len(compact) % cls.COMPACT_NODE.size]
+        return [(node_id, socket.inet_ntoa(ip), port) for node_id, ip, port in cls.COMPACT_NODE.iter_unpack(compact)]
+
+    @staticmethod
+    def _raw(value):
+        # binary strings that happen to be valid utf-8 are decoded to str
+        return value.encode() if isinstance(value, str) else value
 
     def get_DHT(self):
+        """
+        :return: the compact peer list (see decode_peers) of the peers of the torrent found in the DHT,
+                 other than this peer
+        """
+        peers = self._found_peers + self._swarm_addresses(self.torrent.info_hash, self.MAX_VALUES)
+        own = self._server_address()
+        return self.encode_peers(peer for peer in OrderedDict.fromkeys(peers) if peer != own)
+
+    def get_routing_table(self):
         return self._routing_table
 
     def encode(self, message):
@@ -124,7 +330,7 @@ class Tracker:
 
     def decode(self, bencoded_message):
         # decodes a bencode message
-        bc = bencodepy.Bencode(encoding='utf-8')
+        bc = bencodepy.Bencode(encoding='utf-8', encoding_fallback='value')
         return bc.decode(bencoded_message)
 
     def set_total_uploaded(self, peer_id):
@@ -156,20 +362,38 @@ class Tracker:
 
     def ping(self, t, y, q, a=None):
         # create the ping dictionary
-        a = {"id": self.encode(self.torrent.create_info_hash())}
+        a = {"id": self.node_id}
         ping_query = {"t": t, "y": y, "q": q, "a": a}
         # pass the dictionary
         self.broadcast(ping_query, self_broadcast_enabled=True)
-        # self.process_response()
+
+    def bootstrap(self):
+        """
+        Fills the routing table with the nodes answering a ping broadcast, then looks up the nodes close to
+        this node so the buckets near it are filled too
+        :return: True if at least one node answered
+        """
+        for _ in range(self.BOOTSTRAP_RETRIES):
+            self.ping("aa", "q", "ping")
+            time.sleep(self.BOOTSTRAP_TIMEOUT)
+            if len(self._routing_table):
+                self.find_node(self.node_id)
+                return True
+        return False
 
     def run(self):  # mod if start with broad casr
         """
-        TODO: This function is called from the peer.py to start this tracker
+        This function is called from the peer.py to start this tracker
         :return: VOID
         """
+        threading.Thread(target=self.broadcast_listerner).start()
+        self.endpoint.wait_ready()
         if self.announce:
             print("Broadcasting to DHT Port: ", self.DHT_PORT)
-            self.ping("aa", "q", "ping")
-            self.broadcast_listerner()
-        else:
-            threading.Thread(target=self.broadcast_listerner).start()
+            if self.bootstrap():
+                # announced again before the TTL of the swarm registries of the other nodes expires
+                while True:
+                    self.get_peers()
+                    self.started.set()
+                    time.sleep(self.ANNOUNCE_INTERVAL)
+        self.started.set()
@@ -0,0 +1,296 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import os
+import random
+import socket
+import struct
+import time
+from urllib.parse import urlparse
+
+from config import Config
+from custom_exception import ProtocolException
+from swarm import SwarmRegistry
+from tracker import Tracker
+
+
+class UDPTracker(asyncio.DatagramProtocol):
+    """
+    Standalone UDP tracker (BEP 15): announce and scrape
+    The swarms are kept in memory in a SwarmRegistry, so the peers that stop announcing expire on their own.
+    No state is kept per client between the connect and the announce: the connection id is a cookie, an HMAC
+    of the address of the client and of the current time window, so any connection id can be verified from
+    the request alone. A connection id is valid for CONNECTION_ID_LIFETIME to 2 * CONNECTION_ID_LIFETIME
+    seconds. The peer lists of the announce responses use the compact format of Tracker.encode_peers.
+    The ip field of the announces is only used for requests from a local or trusted address (i.e a proxy).
+    Otherwise, any client could add another host to the swarms, so the address of the request is used.
+    USAGE: python3 udp_tracker.py  # serves the address of the tracker announce url in conf.ini
+           tracker = UDPTracker()
+           tracker.run("127.0.0.1", 1337)  # blocks, run it in its own thread
+    """
+    PROTOCOL_ID = 0x41727101980
+    CONNECT, ANNOUNCE, SCRAPE, ERROR = 0, 1, 2, 3
+    NONE, COMPLETED, STARTED, STOPPED = 0, 1, 2, 3  # announce events
+    CONNECTION_ID_LIFETIME = 60  # seconds
+    INTERVAL = 30 * 60  # seconds between announces, requested from the peers
+    DEFAULT_NUM_WANT = 50
+    MAX_NUM_WANT = 200  # 1220 bytes responses, they fit in a single datagram
+    MAX_SCRAPE = 74  # info hashes per scrape request
+
+    CONNECT_REQUEST = struct.Struct("!QII")  # protocol id, action, transaction id
+    HEADER = struct.Struct("!QII")  # connection id, action, transaction id
+    ANNOUNCE_REQUEST = struct.Struct("!QII20s20sQQQIIIiH")  # 98 bytes
+    RESPONSE_HEADER = struct.Struct("!II")  # action, transaction id
+    CONNECT_RESPONSE = struct.Struct("!IIQ")
+    ANNOUNCE_RESPONSE = struct.Struct("!IIIII")  # action, transaction id, interval, leechers, seeders
+    SCRAPE_ENTRY = struct.Struct("!III")  # seeders, completed, leechers
+
+    ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in udp_tracker.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
+
+    def __init__(self, interval=None, swarms=None, trusted_ips=()):
+        """
+        Class constructor
+        :param interval: seconds between announces. By default, the tracker interval in conf.ini
+        :param swarms: the SwarmRegistry of the tracker. By default, peers expire after two intervals
+        :param trusted_ips: addresses allowed to announce another ip than their own. Loopback addresses
+                            are always allowed
+        """
+        self.trusted_ips = set(trusted_ips)
+        self.interval = interval if interval is not None else Config().snapshot().tracker.interval
+        self.swarms = swarms if swarms is not None else SwarmRegistry(ttl=2 * self.interval)
+        self.completed = {}  # info hash -> number of completed events (downloads) received
+        self._secret = os.urandom(20)
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            response = self.process_request(data, addr)
+        except Exception as ex:
+            print(self.ERROR_TEMPLATE.format(
+                "datagram_received()", type(ex).__name__, ex.args))
+            return
+        if response is not None:
+            self.transport.sendto(response, addr)
+
+    def process_request(self, data, addr, now=None):
+        """
+        :param data: the request datagram
+        :param addr: (ip, port) of the client
+        :param now: time.time() of the request. By default, now
+        :return: the response datagram, or None if the request is not a BEP 15 request
+        """
+        now = time.time() if now is None else now
+        if len(data) < self.HEADER.size:
+            return None
+        connection_id, action, transaction_id = self.HEADER.unpack_from(data)
+        if action == self.CONNECT:
+            if connection_id != self.PROTOCOL_ID:
+                return None
+            return self.CONNECT_RESPONSE.pack(self.CONNECT, transaction_id, self.connection_id(addr, now))
+        if not self.valid_connection_id(connection_id, addr, now):
+            return self._error(transaction_id, "Invalid connection id")
+        if action == self.ANNOUNCE:
+            return self._announce(data, addr, transaction_id)
+        if action == self.SCRAPE:
+            return self._scrape(data, transaction_id)
+        return self._error(transaction_id, "Unknown action")
+
+    def connection_id(self, addr, now, window=0):
+        """
+        :param addr: (ip, port) of the client
+        :param now: time.time()
+        :param window: 0 for the current time window, -1 for the previous one
+        :return: the connection id of the client (64 bits)
+        """
+        period = int(now // self.CONNECTION_ID_LIFETIME) + window
+        digest = hmac.new(self._secret, ("%s/%d/%d" % (addr[0], addr[1], period)).encode(), hashlib.sha1).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def valid_connection_id(self, connection_id, addr, now):
+        return any(hmac.compare_digest(connection_id.to_bytes(8, "big"),
+                                       self.connection_id(addr, now, window).to_bytes(8, "big"))
+                   for window in (0, -1))
+
+    def _announce(self, data, addr, transaction_id):
+        if len(data) < self.ANNOUNCE_REQUEST.size:
+            return self._error(transaction_id, "Announce request too short")
+        (_, _, _, info_hash, peer_id, downloaded, left, uploaded, event, ip, key, num_want,
+         port) = self.ANNOUNCE_REQUEST.unpack_from(data)
+        ip = socket.inet_ntoa(struct.pack("!I", ip)) if ip and self.trusted(addr[0]) else addr[0]
+        if event == self.STOPPED:
+            self.swarms.remove(info_hash, peer_id)
+        else:
+            self.swarms.add(info_hash, peer_id, ip, port, seeder=left == 0)
+            if event == self.COMPLETED:
+                self.completed[info_hash] = self.completed.get(info_hash, 0) + 1
+        num_want = self.DEFAULT_NUM_WANT if num_want < 0 else min(num_want, self.MAX_NUM_WANT)
+        peers = []
+        if event != self.STOPPED and num_want:
+            # one more, in case the announcing peer is sampled
+            peers = [(peer.ip, peer.port) for peer in self.swarms.sample(info_hash, num_want + 1)
+                     if peer.peer_id != peer_id][:num_want]
+        seeders, leechers = self.swarms.counts(info_hash)
+        # +-10% of the interval, so the announces of the peers that started together are spread
+        interval = int(self.interval * random.uniform(0.9, 1.1))
+        return self.ANNOUNCE_RESPONSE.pack(self.ANNOUNCE, transaction_id, interval, leechers, seeders) + \
+            Tracker.encode_peers(peers)
+
+    def trusted(self, ip):
+        """
+        :param ip: the address a request comes from
+        :return: True if the ip field of its announces can be used
+        """
+        try:
+            return ip in self.trusted_ips or ipaddress.ip_address(ip).is_loopback
+        except ValueError:
+            return False
+
+    def _scrape(self, data, transaction_id):
+        info_hashes = data[self.HEADER.size:]
+        count = min(len(info_hashes) // 20, self.MAX_SCRAPE)
+        response = bytearray(self.RESPONSE_HEADER.pack(self.SCRAPE, transaction_id))
+        for i in range(count):
+            info_hash = info_hashes[i * 20:(i + 1) * 20]
+            seeders, leechers = self.swarms.counts(info_hash)
+            response += self.SCRAPE_ENTRY.pack(seeders, self.completed.get(info_hash, 0), leechers)
+        return bytes(response)
+
+    def _error(self, transaction_id, message):
+        return self.RESPONSE_HEADER.pack(self.ERROR, transaction_id) + message.encode()
+
+    def run(self, host=None, port=None):
+        """
+        Runs the event loop of this tracker until it is stopped
+        :param host: by default, the host of the tracker announce url in conf.ini
+        :param port: by default, the port of the tracker announce url in conf.ini
+        :return: VOID
+        """
+        default_host, default_port = UDPTrackerClient.address()
+        try:
+            asyncio.run(self._serve(host or default_host, port or default_port))
+        except socket.error as ex:
+            print(self.ERROR_TEMPLATE.format(
+                "run()", type(ex).__name__, ex.args))
+
+    async def _serve(self, host, port):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port))
+        print("UDP tracker listening at ", host, "/", port)
+        try:
+            await loop.create_future()  # forever
+        finally:
+            transport.close()
+
+
+class UDPTrackerClient:
+    """
+    Client of a UDP tracker (BEP 15)
+    Requests are sent again after TIMEOUT * 2^n seconds (n = 0..RETRIES). The connection id is kept and
+    reused until it is one minute old, as the protocol requires.
+    USAGE: client = UDPTrackerClient("127.0.0.1", 1337)  # or UDPTrackerClient(*UDPTrackerClient.address())
+           announce = dict(message.tracker, port=5000, uploaded=0, downloaded=0, left=file_length,
+                           event="started")
+           interval, leechers, seeders, peers = client.announce(announce)  # peers: compact peer list
+           stats = client.scrape([info_hash])  # [(seeders, completed, leechers)]
+    """
+    TIMEOUT = 1  # seconds, doubled at each retry
+    RETRIES = 3
+    CONNECTION_ID_LIFETIME = 60  # seconds
+    EVENTS = {None: UDPTracker.NONE, -1: UDPTracker.NONE, "": UDPTracker.NONE, "completed": UDPTracker.COMPLETED,
+              "started": UDPTracker.STARTED, "stopped": UDPTracker.STOPPED}
+
+    def __init__(self, host, port):
+        self.tracker_address = (socket.gethostbyname(host), int(port))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._connection_id = None
+        self._connected_at = 0
+        self.key = random.getrandbits(32)
+
+    @staticmethod
+    def address(url=None):
+        """
+        :param url: a tracker url (udp://host:port/announce). By default, the tracker announce url in conf.ini
+        :return: (host, port)
+        """
+        url = urlparse(url or Config().snapshot().tracker.announce)
+        return url.hostname, url.port
+
+    def _request(self, data, transaction_id):
+        for attempt in range(self.RETRIES + 1):
+            self.socket.settimeout(self.TIMEOUT * 2 ** attempt)
+            self.socket.sendto(data, self.tracker_address)
+            try:
+                while True:
+                    response, addr = self.socket.recvfrom(65536)
+                    if addr == self.tracker_address and len(response) >= UDPTracker.RESPONSE_HEADER.size and \
+                            UDPTracker.RESPONSE_HEADER.unpack_from(response)[1] == transaction_id:
+                        break
+            except socket.timeout:
+                continue
+            action, _ = UDPTracker.RESPONSE_HEADER.unpack_from(response)
+            if action == UDPTracker.ERROR:
+                raise ProtocolException(response[UDPTracker.RESPONSE_HEADER.size:].decode(errors="replace"))
+            return response
+        raise socket.timeout("no response from the tracker %s/%d" % self.tracker_address)
+
+    def _connect(self):
+        if self._connection_id is not None and time.monotonic() - self._connected_at < self.CONNECTION_ID_LIFETIME:
+            return self._connection_id
+        transaction_id = random.getrandbits(32)
+        response = self._request(UDPTracker.CONNECT_REQUEST.pack(UDPTracker.PROTOCOL_ID, UDPTracker.CONNECT,
+                                                                 transaction_id), transaction_id)
+        _, _, self._connection_id = UDPTracker.CONNECT_RESPONSE.unpack_from(response)
+        self._connected_at = time.monotonic()
+        return self._connection_id
+
+    def announce(self, announce, num_want=-1):
+        """
+        :param announce: dict with the fields of Message.tracker (info hash hex or raw 20 bytes, peer id of
+                         up to 20 bytes, or any other value hashed into 20 bytes)
+        :param num_want: max peers returned, -1 for the default of the tracker
+        :return: the announce interval (seconds), the number of leechers, the number of seeders, and the
+                 compact peer list (see Tracker.decode_peers)
+        :raise ProtocolException: if the tracker answers an error. socket.timeout if it does not answer
+        """
+        info_hash = announce['torrent_info_hash']
+        if isinstance(info_hash, str):
+            info_hash = bytes.fromhex(info_hash)
+        peer_id = announce['peer_id']
+        if not isinstance(peer_id, bytes) or len(peer_id) > 20:
+            peer_id = hashlib.sha1(str(peer_id).encode()).digest()
+        ip = announce.get('ip', -1)
+        ip = struct.unpack("!I", socket.inet_aton(ip))[0] if isinstance(ip, str) else 0
+        transaction_id = random.getrandbits(32)
+        data = UDPTracker.ANNOUNCE_REQUEST.pack(
+            self._connect(), UDPTracker.ANNOUNCE, transaction_id, info_hash, peer_id,
+            max(announce['downloaded'], 0), max(announce['left'], 0), max(announce['uploaded'], 0),
+            self.EVENTS[announce.get('event')], ip, self.key, num_want, announce['port'])
+        response = self._request(data, transaction_id)
+        _, _, interval, leechers, seeders = UDPTracker.ANNOUNCE_RESPONSE.unpack_from(response)
+        return interval, leechers, seeders, response[UDPTracker.ANNOUNCE_RESPONSE.size:]
+
+    def scrape(self, info_hashes):
+        """
+        :param info_hashes: list of info hashes (hex or raw 20 bytes), up to UDPTracker.MAX_SCRAPE
+        :return: list of (seeders, completed, leechers), one per info hash
+        """
+        info_hashes = [bytes.fromhex(info_hash) if isinstance(info_hash, str) else info_hash
+                       for info_hash in info_hashes[:UDPTracker.MAX_SCRAPE]]
+        transaction_id = random.getrandbits(32)
+        response = self._request(UDPTracker.HEADER.pack(self._connect(), UDPTracker.SCRAPE, transaction_id) +
+                                 b"".join(info_hashes), transaction_id)
+        entries = response[UDPTracker.RESPONSE_HEADER.size:]
+        return list(UDPTracker.SCRAPE_ENTRY.iter_unpack(entries[:len(entries) - len(entries) %
+                                                                 UDPTracker.SCRAPE_ENTRY.size]))
+
+    def close(self):
+        self.socket.close()
+
+
+# main execution
+if __name__ == '__main__':
+    UDPTracker().run()
@@ -1,31 +1,301 @@
-import pickle
+import asyncio
+from collections import deque
+import socket
+import threading
+
 from file_manager import FileManager
 from config import Config
+from message import Message, MessageDecoder
+from custom_exception import ClientClosedException, ProtocolException
 
 
 class Uploader:
+    MAX_QUEUED_REQUESTS = 256  # requests pipelined by the downloader that are not served yet
+    ERROR_TEMPLATE = "\033[1m\033[91mEXCEPTION in uploader.py {0}:\033[0m {1} occurred.\nArguments:\n{2!r}"
 
-    def __init__(self, peer_id, server, peer_uploader, address, torrent):
+    def __init__(self, peer_id, server, peer_uploader, address, torrent, decoder=None):
         self.peer_id = peer_id
+        self.downloader_id = peer_id  # peer id sent by the downloader in the handshake
         self.config = Config()
         self.torrent = torrent
-        self.file_manager = FileManager(peer_id=peer_id, torrent=torrent)
+        self.file_manager = FileManager(peer_id=peer_id, torrent=torrent, piece_cache=server.piece_cache)
         self.peer_uploader = peer_uploader  # aka client socket
         self.server = server
         self.address = address
+        # listen port of the downloader peer, advertised with peer exchange (None if not sent)
+        self.listen_port = server.listen_ports.pop(peer_id, None)
         self.peer_id = -1
         self.uploaded = 0  # bytes
         self.downloaded = 0  # bytes
+        self.requests_dropped = 0  # requests for pieces that are not available
+        # keeps any bytes the server already buffered during the handshake
+        self.decoder = decoder or MessageDecoder()
+        self.interested = True  # the downloader sent interested during the handshake
+        self.choked = False  # the handshake unchokes the downloader. Then, the choker of the server decides
+        self._upload_file = None  # blocks are sent from this file with sendfile()
+        self.requests = deque()  # (index, begin, length) pipelined by the downloader, served in order
+        # the choker thread clears the requests while this connection serves them
+        self._requests_lock = threading.Lock()
+        # this connection share of the upload and download rates of the server
+        self.upload_rate = server.upload_limiter.connection()
+        self.download_rate = server.download_limiter.connection()
+        # choke and unchoke are sent by the choker thread while this uploader sends blocks
+        self._send_lock = threading.Lock()
+        self._send_lock_async = None
+        self._loop = None  # event loop and writer of the connection, asyncio engine only
+        self._writer = None
 
         #### implement this ####
         self.uploader_bitfield = None
         self.downloader_bitfield = None
 
     def send(self, data):
-        serialized_data = pickle.dumps(data)
-        self.peer_uploader.send(serialized_data)
+        if data.get('id') == Message.PIECE:
+            header = Message.piece_header(data['index'], data['begin'], data['length'])
+            self.upload_rate.throttle(len(header) + data['length'])
+            with self._send_lock:
+                self.peer_uploader.sendall(header)
+                if data['block'] is None:
+                    # the block is streamed from the file right after the header
+                    self.peer_uploader.sendfile(self._file(), data['file_offset'], data['length'])
+                else:
+                    self.peer_uploader.sendall(data['block'])
+        else:
+            data = Message.encode(data)
+            self.upload_rate.throttle(len(data))
+            with self._send_lock:
+                self.peer_uploader.sendall(data)
 
     def receive(self, max_alloc_mem=4096):
-        serialized_data = self.peer_uploader.recv(max_alloc_mem)
-        data = pickle.loads(serialized_data)
-        return data
+        return self.decoder.receive(self.peer_uploader, max_alloc_mem, self.download_rate.throttle)
+
+    def run(self):
+        """
+        Serves the downloader in this thread until it closes the connection
+        :return: VOID
+        """
+        try:
+            # piece headers and blocks are small writes sent back-to-back. Without this, each one waits
+            # for the ack of the previous one (the asyncio engine already sets it)
+            self.peer_uploader.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # the downloader picks the pieces to request from the pieces this peer has
+            self.send(self.server.message.get_bitfield_message())
+            while True:
+                data = self.receive()
+                if data is None:
+                    break
+                for response in self._handle_received(data):
+                    self.send(response)
+        except ClientClosedException:
+            pass
+        except Exception as ex:
+            print(self.ERROR_TEMPLATE.format(
+                "run()", type(ex).__name__, ex.args))
+        finally:
+            self.close()
+
+    async def run_async(self, reader, writer):
+        """
+        Coroutine version of run() used by the asyncio server engine
+        :param reader: asyncio StreamReader of the connection
+        :param writer: asyncio StreamWriter of the connection
+        :return: VOID
+        """
+        if self._writer is None:
+            self.attach(writer)
+        try:
+            await self.send_async(writer, self.server.message.get_bitfield_message())
+            while True:
+                data = await self.decoder.receive_async(reader, throttle=self.download_rate.throttle_async)
+                if data is None:
+                    break
+                for response in self._handle_received(data):
+                    await self.send_async(writer, response)
+                # waits while the socket buffer is full, so slow downloaders do not grow memory
+                await writer.drain()
+        except ClientClosedException:
+            pass
+        finally:
+            self.close()
+
+    def attach(self, writer):
+        """
+        Binds this uploader to the event loop of the asyncio engine, so choke and unchoke sent from the
+        choker thread are written by the event loop
+        :param writer: asyncio StreamWriter of the connection
+        :return: VOID
+        """
+        self._loop = asyncio.get_running_loop()
+        self._writer = writer
+        self._send_lock_async = asyncio.Lock()
+
+    async def send_async(self, writer, data):
+        """
+        Coroutine version of send()
+        :param writer: asyncio StreamWriter of the connection
+        :param data: the message
+        :return: VOID
+        """
+        if data.get('id') == Message.PIECE:
+            header = Message.piece_header(data['index'], data['begin'], data['length'])
+            await self.upload_rate.throttle_async(len(header) + data['length'])
+            async with self._send_lock_async:
+                writer.write(header)
+                if data['block'] is None:
+                    await asyncio.get_running_loop().sendfile(
+                        writer.transport, self._file(), data['file_offset'], data['length'])
+                else:
+                    writer.write(data['block'])
+        else:
+            data = Message.encode(data)
+            await self.upload_rate.throttle_async(len(data))
+            async with self._send_lock_async:
+                writer.write(data)
+
+    def set_choked(self, choked):
+        """
+        Chokes or unchokes the downloader. Called by the choker of the server, from its own thread
+        :param choked: True to choke
+        :return: VOID
+        """
+        with self._requests_lock:
+            if choked == self.choked:
+                return
+            self.choked = choked
+            if choked:
+                self.requests.clear()
+        self._send_from_thread(self.server.message.choke if choked else self.server.message.unchoke)
+
+    def send_pex(self, added, dropped):
+        """
+        Sends a peer exchange message. Called by the PeerExchange thread of the peer
+        :param added: compact peer list
+        :param dropped: compact peer list
+        :return: VOID
+        """
+        self._send_from_thread(dict(self.server.message.pex, added=added, dropped=dropped))
+
+    def send_have(self, have):
+        """
+        Sends a have message. Called by the download scheduler of the peer when a piece is available
+        :param have: the have message, with the piece index set
+        :return: VOID
+        """
+        self._send_from_thread(have)
+
+    def listen_address(self):
+        """
+        :return: (ip, listen port) of the downloader peer, or None if it did not send its listen port
+        """
+        return (self.address[0], self.listen_port) if self.listen_port else None
+
+    def _send_from_thread(self, message):
+        """
+        Sends a message from a thread other than the thread (or event loop) of this connection
+        """
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._send_control_async(message), self._loop)
+        else:
+            self.send(message)
+
+    async def _send_control_async(self, data):
+        await self.send_async(self._writer, data)
+        await self._writer.drain()
+
+    def _handle_received(self, data):
+        """
+        Handles a message and the messages received together with it, then serves all the requests queued
+        back-to-back. Cancels received in the same batch remove their requests before they are served.
+        :param data: the decoded message
+        :return: a list with the messages to send back to the downloader
+        """
+        responses = self.handle_message(data)
+        for data in self.decoder.drain():
+            responses.extend(self.handle_message(data))
+        while True:
+            with self._requests_lock:
+                if not self.requests:
+                    break
+                request = self.requests.popleft()
+            response = self._piece(*request)
+            if response is not None:
+                responses.append(response)
+        return responses
+
+    def handle_message(self, data):
+        """
+        Handles a message sent by the downloader. Requests are queued (see _handle_received())
+        :param data: the decoded message
+        :return: a list with the messages to send back to the downloader
+        """
+        if data.get('client-closed'):
+            raise ClientClosedException()
+        message_id = data.get('id')
+        if message_id == Message.INTERESTED:
+            # the choker unchokes the downloader if it gets a slot
+            self.interested = True
+        elif message_id == Message.NOT_INTERESTED:
+            self.interested = False
+        elif message_id == Message.REQUEST:
+            with self._requests_lock:
+                if self.choked:
+                    return []  # requests received while choked are dropped, the downloader requests them again
+                if len(self.requests) >= self.MAX_QUEUED_REQUESTS:
+                    raise ProtocolException('Too many requests queued')
+                self.requests.append((data['index'], data['begin'], data['length']))
+        elif message_id == Message.CANCEL:
+            with self._requests_lock:
+                try:
+                    self.requests.remove((data['index'], data['begin'], data['length']))
+                except ValueError:
+                    pass  # the block was already sent
+        elif message_id == Message.EXTENDED:
+            if self.server.pex:
+                self.server.pex.received(self, data['added'], data['dropped'])
+        return []
+
+    def _piece(self, index, begin, length):
+        """
+        Creates the piece message answering a request for a piece this peer has (see
+        Message.is_piece_available()). Blocks of pieces in the piece cache are served from memory.
+        Otherwise, the block is not read here, send() streams it from the file descriptor
+        with sendfile(), so the payload bytes never go through python.
+        :param index: the piece index
+        :param begin: the offset of the block in the piece
+        :param length: the length of the block
+        :return: the piece message, or None if the piece is not available (the request is dropped)
+        :raise ProtocolException: if the block is out of the piece
+        """
+        try:
+            file_offset, length = self.file_manager.block_file_range(index, begin, length)
+        except ValueError as ex:
+            raise ProtocolException('Invalid request: ' + str(ex))
+        # the tmp file holds zeros (or a piece being written) where the pieces are not available. The peer
+        # may still request the piece (i.e a have received before a recheck), so only the request is dropped
+        if not self.server.message.is_piece_available(index):
+            self.requests_dropped += 1
+            return None
+        self.uploaded += length
+        self.server.add_uploaded(length)
+        block = None
+        if self.file_manager.piece_cache is not None:
+            block = self.file_manager.get_cached_block(index, begin, length)
+        return dict(self.server.message.piece, index=index, begin=begin, block=block, length=length,
+                    file_offset=file_offset)
+
+    def _file(self):
+        if self._upload_file is None:
+            self._upload_file = open(self.file_manager.upload_path(), "rb")
+        return self._upload_file
+
+    def close(self):
+        """
+        Closes the files used to upload blocks, and gives the share of the rates of this connection back
+        :return: VOID
+        """
+        self.upload_rate.close()
+        self.download_rate.close()
+        if self._upload_file is not None:
+            self._upload_file.close()
+            self._upload_file = None
+        self.file_manager.close()
@@ -0,0 +1,91 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+
+from bitarray import bitarray
+
+
+class PieceVerifier:
+    """
+    Bulk verification of the pieces of a file against the piece hashes of the torrent
+    Used to build the initial bitfield of a seeder, and to force a recheck of a downloaded file.
+    The file is read sequentially in large chunks (READ_SIZE bytes), and the pieces of each chunk are hashed
+    in a thread pool. hashlib releases the GIL while hashing, so the pieces are hashed on all the cores.
+    At most 2 chunks per worker are in memory at any time.
+    USAGE: verifier = PieceVerifier(torrent, "resources/shared/age.txt")
+           bitfield = verifier.verify(progress=lambda done, total: print(done, "/", total))
+    """
+    READ_SIZE = 4 * 1024 * 1024  # bytes read at once, rounded down to whole pieces
+
+    def __init__(self, torrent, file_path, workers=None):
+        """
+        Class constructor
+        :param torrent:
+        :param file_path: the file to verify
+        :param workers: number of hashing threads. By default, the number of cores
+        """
+        self.torrent = torrent
+        self.file_path = file_path
+        self.workers = workers or os.cpu_count() or 1
+        self.num_pieces = torrent.num_pieces()
+        self.piece_size = torrent.piece_length()
+        self.pieces_per_read = max(1, self.READ_SIZE // self.piece_size)
+
+    def verify(self, pieces=None, progress=None):
+        """
+        Verifies the pieces of the file
+        :param pieces: optional bitarray with the pieces to verify set. By default, all the pieces
+        :param progress: optional callable(pieces_verified, pieces_to_verify) called after each chunk
+        :return: the bitfield (bitarray with one bit per piece, set for valid pieces)
+        """
+        if pieces is None:
+            pieces = bitarray(self.num_pieces)
+            pieces.setall(True)
+        bitfield = bitarray(self.num_pieces)
+        bitfield.setall(False)
+        total = pieces.count()
+        if not total or not os.path.exists(self.file_path):
+            return bitfield
+        done = 0
+        in_flight = deque()
+        with open(self.file_path, "rb") as file, ThreadPoolExecutor(self.workers) as executor:
+            for first in range(0, self.num_pieces, self.pieces_per_read):
+                last = min(first + self.pieces_per_read, self.num_pieces)
+                wanted = [piece_index for piece_index in range(first, last) if pieces[piece_index]]
+                if not wanted:
+                    continue  # nothing to verify in this chunk, skip the read
+                file.seek(first * self.piece_size)
+                chunk = file.read((last - first) * self.piece_size)
+                in_flight.append(executor.submit(self._verify_chunk, chunk, first, wanted))
+                if len(in_flight) >= 2 * self.workers:
+                    done += self._collect(in_flight.popleft(), bitfield)
+                    if progress:
+                        progress(done, total)
+            while in_flight:
+                done += self._collect(in_flight.popleft(), bitfield)
+                if progress:
+                    progress(done, total)
+        return bitfield
+
+    def _verify_chunk(self, chunk, first, wanted):
+        """
+        Hashes the wanted pieces of a chunk. Runs in the thread pool
+        :param chunk: the bytes read, starting at piece 'first'
+        :param first: index of the first piece in the chunk
+        :param wanted: indexes of the pieces to verify in this chunk
+        :return: a list of (piece index, True if valid)
+        """
+        view = memoryview(chunk)
+        results = []
+        for piece_index in wanted:
+            start = (piece_index - first) * self.piece_size
+            piece = view[start:start + self.piece_size]
+            results.append((piece_index, self.torrent.verify_piece(piece_index, piece)))
+        return results
+
+    def _collect(self, future, bitfield):
+        results = future.result()
+        for piece_index, valid in results:
+            bitfield[piece_index] = valid
+        return len(results)